@@ -9,8 +9,29 @@ Usage:
 
 Options:
     -h --help
-    -f --file	Input file (required)
-    -o --out	Output file (required)
+    -f --file	Input file (required unless --serve)
+    -o --out	Output file (required unless --serve)
+    --format	Input format json or ndjson (default by file extension)
+    --resume	Continue an interrupted run with the same input and output
+    -c --coalesce	Merge the rows of each user into the fewest actions
+    -t --tenant	Tenant of the rows that do not name one (see TENANTS)
+    -s --shards	Split the rows by user into this many processes (default 1)
+    -w --workers	Number of user actions to run in parallel (default 1)
+    -b --batch	Pack requests of the parallel workers into $batch requests
+    -p --prefetch	Load all o365 users once instead of looking up each user
+    -r --replica	Look up users in a local replica (see REPLICAFILE)
+    --resync	Fill the local replica from scratch (implies --replica)
+    --serve	Run as a daemon that runs the rows sent to this local socket
+    --send	Send the input to the daemon on this local socket and write
+    		the output it sends back, instead of running it
+    --config	Settings file to use (default o365settings.py)
+    -m --metrics	Write call metrics to this file, JSON if it ends with .json 
+    		and Prometheus text otherwise
+    --metrics-every	Also write the metrics every this many seconds
+    --log-level	debug/info/warning/error (default debug)
+    --log-format	text for o365.log or json for o365.jsonl (default text)
+    -q --quiet	Print only a progress line instead of a line per action
+    --progress-every	Seconds between progress lines (default 10)
 
 Environment specific script constants are stored in this 
 config file: o365settings.py
@@ -35,19 +56,59 @@ with these 10 required data fields:
         }
     ] 
 }
-where action can be create/update/delete/list and newusername is same old one 
-or a new value if renaming the user.
-
-Note that this script only deletes users and it cannot purge/restore 
-users from O365 RecycleBin where they stay for 30 days because
-this functionality is not implemented in Graph API (yet).
-You can use PowerShell to purge/restore deleted users with:
-Remove-MsolUser -UserPrincipalName testuser@office365.com -RemoveFromRecycleBin
-or to purge all of deleted users:
-Get-MsolUser -ReturnDeletedUsers | Remove-MsolUser -RemoveFromRecycleBin -Force
-and to restore a user:
-$DelUser = Get-MsolUser -UserPrincipalName testu@o365.com -ReturnDeletedUsers
-Restore-MsolUser -ObjectId $DelUser.ObjectId
+where action can be create/update/delete/list/audit-licenses/addgroup/
+removegroup/purge and newusername is same old one or a new value if renaming 
+the user.
+
+An addgroup or removegroup action adds the user in "username" to groups,
+or removes it from them, by their names in an optional field:
+            "groups": "Biology;Biology Students"
+or else the group named like the department in "primO". The changes of
+all rows are queued and sent BATCHSIZE to a $batch request, so they 
+finish (and their rows are written) a little later.
+
+A list action can have these optional fields:
+            "select": "userPrincipalName,department",
+            "filter": "accountEnabled eq false",
+            "outfile": "users.csv"
+to stream just the selected fields of the filtered users into a CSV
+file, or a JSONL file if the name does not end with .csv, instead of
+printing all user names. With LISTWORKERS above 1, the users of a 
+large tenant are listed in SEGMENTS by the first character of their 
+names, LISTWORKERS segments at a time, and come out sorted by name. 
+--prefetch lists them the same way.
+
+An audit-licenses action checks that every user of O365DOMAIN has just 
+the license of its type (STULICENSE or EMPLICENSE) with DISABLEDPLANS
+and repairs the ones that do not with batched assignLicense calls. 
+It can have these optional fields:
+            "filter": "department eq 'Biology'",
+            "repair": "False"
+to audit only some users, or to only report without repairing. The 
+output gets a line for every user audited before the line of the row.
+
+Input can also be newline-delimited JSON (e.g. input.jsonl) with one of 
+the user action objects above per line. Either way, rows are read from 
+the file one at a time, so large files do not have to fit in memory.
+
+Before the rows run, the free seats of STULICENSE and EMPLICENSE are 
+read from subscribedSkus and counted down as users are created (and up 
+as they are deleted). A create that would need a seat that is not left 
+fails right away with "ERROR: no free seats of license ...", and the 
+end of the run reports how many seats were short. Set SEATCHECK = False 
+to skip this.
+
+Deleted users stay in the O365 RecycleBin for 30 days and keep their 
+immutableId there. A create whose UDCid belongs to a deleted user 
+restores that user instead and gives it the name, attributes and 
+password of the row (the deleted users are listed once per run). 
+Set RESTOREDELETED = False to skip this. A purge action permanently 
+deletes all deleted users of O365DOMAIN once the rows before it are done
+(rows after it wait for it), with a line in the output for each before 
+the line of the row:
+            {"action": "purge", "username": "recyclebin"}
+Shards cannot wait for each other, so an input with a purge action 
+cannot be run with --shards.
     
 Output:
 
@@ -55,11 +116,53 @@ Output file (e.g. output.csv) will have these fields:
 
 action, username, result (ERROR/SUCCESS: reason)
 
+With --shards, the rows are split by user into that many input files 
+(output.csv.shard0.jsonl, ...) that run in their own processes, each 
+with its own connections and token, and their results are merged back 
+into the output in input order. Rows that act on the same user, also 
+through a rename, always go to the same shard. Settings like RATELIMIT
+and MAXWORKERS apply to each shard on its own, and with --metrics 
+each shard writes its own file, e.g. output.csv.shard0.metrics.json.
+
+Rows of several tenants (e.g. a main campus and affiliates) can be mixed
+in one input. A row names its tenant in an optional "tenant" field, rows
+without it go to the tenant given with --tenant, or to the one of the
+settings file itself. Each tenant in TENANTS in the settings file has 
+its own domain, app credentials, licenses and other settings, and the 
+rows of each tenant run in their own process (output.csv.affiliate.jsonl, 
+...) with their own token, connections and rate limit, all at the same 
+time, merged into the output like shards. With -r each tenant looks up
+users in its own replica (REPLICAFILE with the tenant name added), 
+which the shards of a tenant share, so --resync cannot be used with 
+--shards.
+
+Every row written to the output is also recorded in output.csv.journal 
+together with a fingerprint of the input file. If a run is interrupted,
+running it again with --resume skips the rows that are already done.
+A SIGTERM stops a run after the rows in flight, which are written and
+recorded first (a second SIGTERM stops it right away).
+
+For many small inputs, a daemon started once with 
+    python o365.py --serve /run/o365.sock -w 8 -b -r
+keeps the settings, token, connections and users warm. Each 
+    python o365.py -f input.json -o output.csv --send /run/o365.sock
+then only sends its rows (one JSON row per line) and gets back the
+output, with no journal. Other Python programs can use the same warm 
+state with O365Client. SIGTERM stops the daemon like it stops a run.
+
 Logging:
 
-Script creates a detailed o365.log
+Script creates a detailed o365.log, or o365.jsonl with one JSON object 
+per line with --log-format json.
 
-All errors are also printed to stdout.
+With --metrics, the count, status, latency histogram, re-tries and 
+bytes of every kind of call (findUser, create, patch, delete, 
+assignLicense, findGroup, member, listPage, deltaPage, batch and login)
+are written 
+to a file that Prometheus or other tools can read.
+
+All errors are also printed to stdout. The log and the console are 
+written by a background thread, so workers do not wait for them.
 
 Author: A. Ablovatski
 Email: ablovatskia@denison.edu
@@ -69,6 +172,7 @@ Date: 11/04/2016
 from __future__ import print_function
 import time
 import sys
+import os
 import traceback
 import json
 import csv
@@ -76,315 +180,3145 @@ import argparse
 import logging
 import httplib
 import urllib
+import socket
+import select
+import ssl
+import threading
+import Queue
+import collections
+import uuid
+import random
+import email.utils
+import hashlib
+import zlib
+import itertools
+import signal
+import subprocess
+import array
+import sqlite3
+import urlparse
+import stat
+
+
+# Hosts of the Graph API and the MSFT login service
+GRAPH_HOST = 'graph.windows.net'
+LOGIN_HOST = 'login.windows.net'
+USEHTTPS = True
+
+# Keep-alive connection pools, one per host
+POOLS = {}
+POOLS_LOCK = threading.Lock()
+
+# Serializes logins of parallel workers
+TOKEN_LOCK = threading.Lock()
+
+# Packs requests of parallel workers into $batch requests if enabled
+BATCHER = None
+
+# Prefetched index or local replica of the users in O365 if enabled
+DIRECTORY = None
+
+# Query string of every Graph API call, set by readConfig, and the 
+# headers of calls with a JSON body, graphRequest adds the token
+API_PARAMS = ''
+JSON_HEADERS = {'Content-Type': 'application/json; charset=utf-8'}
+
+# Deferred license assignments of new users
+LICENSES = None
+LICENSES_LOCK = threading.Lock()
+
+# Deferred group membership changes and groups looked up by name
+MEMBERS = None
+MEMBERS_LOCK = threading.Lock()
+GROUPS = {}
+GROUPS_LOCK = threading.Lock()
+
+# Other tenants from the settings file
+TENANTS = {}
+
+# Free seats of the subscribed licenses
+SEATS = None
+
+# Counters for the summary at the end of the run
+STATS = collections.Counter()
+STATS_LOCK = threading.Lock()
+
+# Writer of the call metrics during the run
+METRICS_WRITER = None
+
+# Background writer of the log and console, quiet mode and its progress
+LISTENER = None
+QUIET = False
+PROGRESS = None
+
+# Set by SIGTERM while the rows of a run go, so the rows in flight 
+# finish and are written before the run stops
+STOPPING = threading.Event()
+ROWS_RUNNING = False
 
 
 def main(argv):
     """This is the main body of the script"""
     
-    # Setup the log file
-    logging.basicConfig(
-        filename='o365.log',level=logging.DEBUG, 
-        format='%(asctime)s, %(levelname)s: %(message)s', 
-        datefmt='%Y-%m-%d %H:%M:%S')
+    global ROWS_RUNNING
 
-    # Get Azure creds and other constants from this settings file
-    config_file = 'o365settings.py'
-    
-    if not readConfig(config_file):
-        logging.error("unable to parse the settings file")
-        sys.exit()
-    
     # Parse script arguments
     parser = argparse.ArgumentParser()                                               
 
-    parser.add_argument("--file", "-f", type=str, required=True, 
+    parser.add_argument("--file", "-f", type=str, 
                         help="Input JSON file with user actions and params")
-    parser.add_argument("--out", "-o", type=str, required=True, 
+    parser.add_argument("--out", "-o", type=str, 
                         help="Output file with results of o365 user actions")
+    parser.add_argument("--format", type=str, choices=['json', 'ndjson'], 
+                        help="Input format, by default ndjson for .jsonl " \
+                        "and .ndjson files and json otherwise")
+    parser.add_argument("--resume", action="store_true", 
+                        help="Skip the rows an interrupted run already did " \
+                        "and add to its output")
+    parser.add_argument("--coalesce", "-c", action="store_true", 
+                        help="Merge the rows of each user into the fewest " \
+                        "actions before running them")
+    parser.add_argument("--tenant", "-t", type=str, 
+                        help="Tenant of the rows that do not name one")
+    parser.add_argument("--shards", "-s", type=int, default=1, 
+                        help="Split the rows by user into this many " \
+                        "processes")
+    parser.add_argument("--workers", "-w", type=int, default=1, 
+                        help="Number of user actions to run in parallel")
+    parser.add_argument("--batch", "-b", action="store_true", 
+                        help="Send requests of parallel workers as $batch")
+    parser.add_argument("--prefetch", "-p", action="store_true", 
+                        help="Load all o365 users once instead of looking " \
+                        "up each user")
+    parser.add_argument("--replica", "-r", action="store_true", 
+                        help="Look up users in the local replica kept " \
+                        "current with delta queries")
+    parser.add_argument("--resync", action="store_true", 
+                        help="Fill the local replica from scratch")
+    parser.add_argument("--serve", type=str, default='', 
+                        help="Run as a daemon that runs the rows sent to " \
+                        "this local socket")
+    parser.add_argument("--send", type=str, default='', 
+                        help="Send the input to the daemon on this local " \
+                        "socket instead of running it")
+    parser.add_argument("--config", type=str, default='o365settings.py', 
+                        help="Settings file to use instead of o365settings.py")
+    parser.add_argument("--metrics", "-m", type=str, default='', 
+                        help="Write call metrics to this file at the end, " \
+                        "JSON for .json and Prometheus text otherwise")
+    parser.add_argument("--metrics-every", type=float, default=0, 
+                        help="Also write the metrics every this many seconds")
+    parser.add_argument("--log-level", type=str, default='debug', 
+                        choices=['debug', 'info', 'warning', 'error'], 
+                        help="Least important messages that go to the log")
+    parser.add_argument("--log-format", type=str, default='text', 
+                        choices=['text', 'json'], 
+                        help="Write o365.log as text or o365.jsonl as JSONL")
+    parser.add_argument("--quiet", "-q", action="store_true", 
+                        help="Print only a progress line now and then")
+    parser.add_argument("--progress-every", type=float, default=10, 
+                        help="Seconds between progress lines in quiet mode")
 
     try:
         args = parser.parse_args()
+        # Only the daemon runs without files
+        if not args.serve and not (args.file and args.out):
+            parser.error("--file and --out are required")
         
     except SystemExit:
+        # The log is only set up once we know its format
+        setupLogging()
         logging.error("required arguments missing - " \
                         "provide input and output file names")
+        stopLogging()
         sys.exit()
 
+    # Write the log and the console from a background thread
+    # The shards and tenants print their own progress
+    every = args.progress_every if args.shards <= 1 else 0
+    setupLogging(args.log_level, args.log_format, args.quiet, every)
+
     # Read input from json file
     in_file = args.file
     # Write output to csv file
     out_file = args.out
     
+    # Input is either one JSON document or one JSON row per line
+    in_format = args.format
+    if not in_format and in_file:
+        if in_file.lower().endswith(('.jsonl', '.ndjson')):
+            in_format = 'ndjson'
+        else:
+            in_format = 'json'
+    
+    # A running daemon has the settings, token and connections already
+    if args.send:
+        try:
+            sendRows(args.send, in_file, in_format, out_file)
+        finally:
+            stopLogging()
+        return
+    
+    # Let a SIGTERM close the output and journal cleanly
+    try:
+        signal.signal(signal.SIGTERM, stopRun)
+    except ValueError:
+        # Not in the main thread
+        pass
+    
+    if args.serve:
+        try:
+            serveRows(args.serve, args)
+        finally:
+            stopLogging()
+        return
+
+    # Get Azure creds and other constants from this settings file
+    config_file = args.config
+    
+    if not readConfig(config_file, args.tenant):
+        logging.error("unable to parse the settings file")
+        stopLogging()
+        sys.exit()
+    
+    # Keep the number of parallel workers under the throttling limits
+    workers = max(1, args.workers)
+    if workers > MAXWORKERS:
+        logging.warning("limiting workers from {0} to {1}" \
+                        .format(workers, MAXWORKERS))
+        workers = MAXWORKERS
+    sizePools(workers)
+    
+    # Each shard and tenant is a run of this script on part of the input
+    if args.shards > 1 or (TENANTS and mixedTenants(in_file, in_format, 
+                                                    args.tenant)):
+        # Shards of a tenant share its replica, so they cannot all 
+        # fill it from scratch
+        if args.resync and args.shards > 1:
+            console("ERROR: --resync cannot be used with --shards, resync " \
+                    "the replica in a run without --shards first", True)
+            logging.error("--resync cannot be used with --shards")
+            stopLogging()
+            sys.exit()
+        try:
+            finished = runParts(args, in_format)
+        finally:
+            stopLogging()
+        if not finished:
+            sys.exit(1)
+        return
+    
+    # Opening the output empties it, so make sure the journal a run 
+    # resumes from is of this input first
+    journal_file = out_file + '.journal'
+    try:
+        fingerprint = fileFingerprint(in_file)
+    except IOError:
+        # Reported when the input is opened
+        fingerprint = None
+    if args.resume and fingerprint is not None \
+            and not journalMatches(journal_file, fingerprint):
+        console("ERROR: {0} is not a journal of this input file" \
+                .format(journal_file), True)
+        logging.critical("{0} is not a journal of {1}" \
+                .format(journal_file, in_file))
+        stopLogging()
+        sys.exit(1)
+    
+    # Write the metrics now and then while the run goes
+    if args.metrics and args.metrics_every > 0:
+        startMetrics(args.metrics, args.metrics_every)
+    
+    # Pack the requests of the workers into $batch requests
+    if args.batch:
+        startBatcher(workers)
+    
+    # Load the directory up front, look ups fall back to
+    # Graph API if this fails
+    if args.replica or args.resync:
+        openReplica(args.resync)
+    elif args.prefetch:
+        prefetchDirectory()
+    
+    # Count the free license seats, so creates fail fast without them
+    if SEATCHECK:
+        loadSeats()
+    
+    journal = None
+    # Rows waiting for their final result, e.g. licenses of new users
+    waiting = collections.deque()
+    
     try:
         f_in = open(in_file, 'rb')
         logging.info("opened input file: {0}".format(in_file))
         f_out = open(out_file, 'wb')
         logging.info("opened output file: {0}".format(out_file))
-        reader = json.load(f_in)
+        # Rows are read one at a time as they are needed
+        reader = readRows(f_in, in_format)
         writer = csv.writer(f_out)
         writer.writerow(['action','username','result'])
+        flushed = time.time()
+        
+        # Record finished rows, and on resume re-write the rows 
+        # that are done already and skip them in the input
+        done = 0
+        if args.resume:
+            done = replayJournal(journal_file, fingerprint, writer)
+            if done is None:
+                console("ERROR: {0} is not a journal of this input file" \
+                        .format(journal_file), True)
+                logging.critical("{0} is not a journal of {1}" \
+                        .format(journal_file, in_file))
+                sys.exit(1)
+            logging.info("resuming after {0} rows".format(done))
+            console("INFO: resuming after {0} rows".format(done))
+            reader = itertools.islice(reader, done, None)
+        journal = Journal(journal_file, fingerprint, done > 0)
 
-        for row in reader["useractions"]:
-            result = ''
-            # Select what needs to be done
-            if row["action"] == 'create':
-                result = create(str(row["username"]), str(row["loginDisabled"]), 
-                                str(row["UDCid"]), str(row["givenName"]), 
-                                str(row["fullName"]), str(row["sn"]),  
-                                str(row["primO"]), str(row["userPassword"]))
-            elif row["action"] == 'update':
-                result = update(str(row["username"]), str(row["newusername"]), 
-                                str(row["loginDisabled"]), 
-                                str(row["givenName"]), str(row["fullName"]), 
-                                str(row["sn"]), str(row["primO"]))
-            elif row["action"] == 'delete':
-                 result = delete(str(row["username"]))
-            elif row["action"] == 'list':
-                 result = list()
-            else:
-                print("ERROR: unrecognized action: {0}".format(row["action"]))
-                logging.error("unrecognized action: {0}".format(row["action"]))
-                result = "ERROR: Unrecognized action."
-            
+        # Merging rows needs the whole input, so only do it if asked
+        if args.coalesce:
+            results = coalesceRows(reader, workers)
+        else:
+            results = runRows(reader, workers)
+
+        # A SIGTERM from now on stops sending rows to the workers and 
+        # lets the rows in flight finish, so they are written too
+        ROWS_RUNNING = True
+        for row, result in results:
+            waiting.append((row, result))
             # Write the result to the output csv file
-            writer.writerow([row["action"], row["username"], result])
+            writeResults(writer, waiting, journal)
+            
+            # Flush now and then so the progress can be followed
+            if time.time() - flushed > 1:
+                f_out.flush()
+                journal.sync()
+                flushed = time.time()
+        ROWS_RUNNING = False
+        
+        if STOPPING.is_set():
+            raise SystemExit("stopped by a signal after the rows in flight")
+        
+        # Finish the deferred work and write the remaining rows
+        drainLicenses()
+        drainMembers()
+        writeResults(writer, waiting, journal, True)
             
     except IOError:
-        print("ERROR: Unable to open input/output file!")
+        console("ERROR: Unable to open input/output file!", True)
         logging.critical("file not found: {0} or {1}".format(in_file, out_file))
         
     except Exception as e:
         traceb = sys.exc_info()[-1]
         stk = traceback.extract_tb(traceb, 1)
         fname = stk[0][3]
-        print("ERROR: unknown error while processing line '{0}': " \
-                "{1}".format(fname,e))
+        console("ERROR: unknown error while processing line '{0}': " \
+                "{1}".format(fname,e), True)
         logging.critical("unknown error while processing line '{0}': " \
                 "{1}".format(fname,e))
         
     finally:
+        ROWS_RUNNING = False
+        # Keep the rows that were done before an error or a stop
+        drainLicenses()
+        drainMembers()
+        if journal is not None:
+            writeResults(writer, waiting, journal, True)
         f_in.close()
         logging.info("closed input file: {0}".format(in_file))
         f_out.close()
         logging.info("closed output file: {0}".format(out_file))
+        if journal is not None:
+            journal.close()
+        # Report connection re-use and close the pools
+        stopBatcher()
+        closeReplica()
+        runStats()
+        seatStats()
+        rateStats()
+        metricsStats()
+        poolStats()
+        closePools()
+        stopMetrics(args.metrics)
+        stopLogging()
         
     return
 
 
-def create(username, loginDisabled, UDCid, givenName, fullName, sn, ou, 
-            userPassword):
-    """This funtion adds users to O365"""
+def setupLogging(level='debug', logFormat='text', quiet=False, every=10):
+    """Send log records and console lines to a background thread 
+    that writes them, and start the progress line in quiet mode
+    unless every is 0"""
     
-    # Check if any of the parameters are missing
-    params = locals()
+    global LISTENER
+    global QUIET
+    global PROGRESS
     
-    for _item in params:
-        if str(params[_item]) == "":
-            print("ERROR: unable to create user {0} because {1} is missing " \
-                    "a value".format(username, _item))
-            logging.error("unable to create user {0} because {1} is missing " \
-                            "a value".format(username, _item))
-            result = "ERROR: Missing an expected input value for " + _item \
-                        + " in input file."
-            return result
+    if logFormat == 'json':
+        listener = LogListener('o365.jsonl', JsonFormatter())
+    else:
+        listener = LogListener('o365.log', logging.Formatter(
+                    '%(asctime)s, %(levelname)s: %(message)s', 
+                    '%Y-%m-%d %H:%M:%S'))
+    
+    # Replace any handlers set up before, only the listener writes the log
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(QueueHandler(listener.queue))
+    root.setLevel(getattr(logging, level.upper()))
+    
+    LISTENER = listener
+    QUIET = quiet
+    if quiet and every > 0:
+        PROGRESS = Progress(every)
+    
+    return
 
-    # Get the Graph API access_token and
-    # Catch any MSFT login failures
-    if not ACCESS_TOKEN:
-        graphConnect()
-        # Test again
-        if not ACCESS_TOKEN:
-            result = "ERROR: unable to authenticate to MSFT login service."
-            return result
+
+def stopLogging():
+    """Print the last progress line and write what is still queued"""
     
-    # Grab the access_token
-    access_token = ACCESS_TOKEN
+    global LISTENER
+    global PROGRESS
     
-    # Do a quick check if the user already exists
-    upn = username + "@" + O365DOMAIN
+    if PROGRESS is not None:
+        PROGRESS.stop()
+        PROGRESS = None
+    
+    if LISTENER is not None:
+        listener = LISTENER
+        LISTENER = None
+        logging.getLogger().handlers = []
+        listener.stop()
+    
+    return
 
-    if findUser(upn):
-        print("ERROR: cannot create user - user already exists: {0}" \
-                .format(username))
-        logging.error("cannot create user - user already exists: {0}" \
-                .format(username))
-        result = "ERROR: username already taken!"
-        return result
+
+def console(message, always=False):
+    """Print a line on the console, in quiet mode only if always is set"""
     
-    try:
-        # Set the bearer auth header
-        headers = {
-            'Authorization': 'Bearer ' + access_token,
-            'Content-Type': 'application/json; charset=utf-8',
-            'Connection': 'keep-alive'
-        }
+    if QUIET and not always:
+        return
+    
+    listener = LISTENER
+    if listener is None:
+        print(message)
+    else:
+        listener.queue.put(message)
+    
+    return
+
+
+class QueueHandler(logging.Handler):
+    """Logging handler that only queues the records for LogListener"""
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        """Queue a record with its message already filled in"""
         
-        # Set the required params
-        params = urllib.urlencode({
-            'api-version': API_VERSION,
-        })
+        try:
+            # The arguments could change before the record is written
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(
+                                    record.exc_info)
+                record.exc_info = None
+            self.queue.put(record)
+        except Exception:
+            self.handleError(record)
 
-        # Create body of the request                
-        body = {
-            "userPrincipalName": upn,
-            "accountEnabled": "true",
-            "givenName": givenName,
-            "displayName": fullName,
-            "surname": sn,
-            "mailNickname": username,
-            "department": ou,
-            "immutableId": UDCid,
-            "passwordProfile": {"password": userPassword, 
-                                "forceChangePasswordNextLogin": "false"},
-            "passwordPolicies": "DisablePasswordExpiration",
-            "usageLocation": "US"
+
+class LogListener(object):
+    """Background thread that writes queued log records to the log 
+    file and queued lines to the console, flushing once for all that 
+    are waiting instead of once per line"""
+
+    def __init__(self, path, formatter):
+        self.queue = Queue.Queue()
+        self.formatter = formatter
+        self.log = open(path, 'a')
+        self.stream = sys.stdout
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Write queued records and lines until stopped"""
+        
+        while True:
+            items = [self.queue.get()]
+            try:
+                while len(items) < 1000:
+                    items.append(self.queue.get_nowait())
+            except Queue.Empty:
+                pass
+            
+            stopping = False
+            for item in items:
+                if item is None:
+                    stopping = True
+                elif isinstance(item, logging.LogRecord):
+                    self.log.write(self.formatter.format(item) + "\n")
+                else:
+                    try:
+                        print(item, file=self.stream)
+                    except (IOError, UnicodeError):
+                        pass
+            
+            self.log.flush()
+            self.stream.flush()
+            
+            if stopping:
+                return
+
+    def stop(self):
+        """Write what is left and close the log file"""
+        
+        self.queue.put(None)
+        self.thread.join()
+        self.log.close()
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a log record as a JSON object on one line"""
+
+    def format(self, record):
+        entry = {
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "thread": record.threadName,
+            "message": record.getMessage()
         }
+        if record.exc_text:
+            entry["exception"] = record.exc_text
         
-        data = json.dumps(body)
+        return json.dumps(entry)
+
+
+class Progress(object):
+    """Counts the rows written to the output and prints a progress 
+    line every interval seconds, for quiet mode"""
+
+    def __init__(self, interval):
+        self.interval = max(1, interval)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.rows = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, result):
+        """Count a row with its result"""
+        
+        with self.lock:
+            self.rows += 1
+            if result.startswith("ERROR"):
+                self.errors += 1
+
+    def run(self):
+        """Print the progress line until stopped"""
         
-        # Connect to o365
-        conn = httplib.HTTPSConnection('graph.windows.net')
-        conn.request("POST", "/" + O365DOMAIN + "/users?" 
-                        + params, data, headers)
-        response = conn.getresponse()
-        response.read()
+        while not self.stopped.wait(self.interval):
+            self.report()
+
+    def report(self):
+        """Print the progress line"""
         
-        if response.status != 201:
-            # User was not created
-            logging.error("user could not be created in o365: {0}" \
-                        .format(username))
-            print("ERROR: User {0} could not be added to o365" \
-                        .format(username))
-            result = "ERROR: user could not be created in o365."
-        else:                
-            # Determine licenses based on user type
-            userType = getUserType(username)
-            
-            # Assign correct licenses for Stu/Emp users
-            # Disable MCOSTANDARD/EXCHANGE_S_STANDARD plans
-            if userType == "STU":
-                licenses = [{"disabledPlans":DISABLEDPLANS, "skuId":STULICENSE}]
+        with self.lock:
+            rows = self.rows
+            errors = self.errors
+        seconds = max(time.time() - self.started, 0.001)
+        
+        console("INFO: {0} rows done, {1:.1f} rows/s, {2} errors" \
+                .format(rows, rows / seconds, errors), True)
+
+    def stop(self):
+        """Stop the thread and print the last progress line"""
+        
+        self.stopped.set()
+        self.thread.join()
+        self.report()
+
+
+def writeResults(writer, waiting, journal, wait=False):
+    """Write the rows with final results to the output csv file 
+    and the journal, if there is one, in input order, optionally 
+    waiting for all of them"""
+    
+    while waiting and resultReady(waiting[0][1], wait):
+        row, result = waiting.popleft()
+        line = [row["action"], row["username"], resultText(result)]
+        
+        # A line for each user the row went through, then its own
+        if isinstance(result, RowLines):
+            lines = [[row["action"], upn.split("@")[0], text] 
+                        for upn, text in result.lines]
+            lines.append(line)
+            writer.writerows(lines)
+            if journal is not None:
+                journal.write(lines)
+        else:
+            writer.writerow(line)
+            if journal is not None:
+                journal.write(line)
+        
+        if PROGRESS is not None:
+            PROGRESS.add(line[2])
+    
+    return
+
+
+class Journal(object):
+    """Append-only record of the rows written to the output file.
+    
+    The first line has the fingerprint of the input file and every 
+    other line is one output row, in input order. Lines are flushed 
+    as they are written and synced to disk every second or so."""
+
+    def __init__(self, path, fingerprint, append=False):
+        self.path = path
+        
+        if append:
+            self.f = open(path, 'ab')
+        else:
+            self.f = open(path, 'wb')
+            self.f.write(json.dumps({"fingerprint": fingerprint}) + "\n")
+            self.f.flush()
+
+    def write(self, line):
+        """Record a row that was written to the output, as one line 
+        or a list of the lines it wrote"""
+        
+        self.f.write(json.dumps(line) + "\n")
+        self.f.flush()
+
+    def sync(self):
+        """Make sure the journal survives a crash of the machine"""
+        
+        os.fsync(self.f.fileno())
+
+    def close(self):
+        self.sync()
+        self.f.close()
+
+
+def replayJournal(path, fingerprint, writer):
+    """Write the rows recorded in a journal to the output again and 
+    return how many there are, or None if it is for another input"""
+    
+    if not os.path.exists(path):
+        logging.info("no journal to resume from: {0}".format(path))
+        return 0
+    
+    count = 0
+    
+    with open(path, 'r+b') as f_journal:
+        try:
+            header = json.loads(f_journal.readline())
+        except ValueError:
+            return None
+        if header.get("fingerprint") != fingerprint:
+            return None
+        
+        valid = f_journal.tell()
+        
+        for line in f_journal:
+            # The last line may be cut off if the run died writing it
+            if not line.endswith("\n"):
+                break
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            # A row with several output lines is one list of them
+            if row and isinstance(row[0], type([])):
+                writer.writerows([[csvValue(value) for value in item] 
+                                    for item in row])
             else:
-                licenses = [{"disabledPlans":DISABLEDPLANS, "skuId":EMPLICENSE}]
-            
-            # Now try assigning licenses
-            body = {
-                "addLicenses": licenses,
-                "removeLicenses": []
-            }
-            
-            data = json.dumps(body)
-            
-            count = 0
-            while count < 4:
-                # commented out to re-use existing TCP connection
-                # conn = httplib.HTTPSConnection('graph.windows.net')
-                conn.request("POST", "/" + O365DOMAIN + "/users/" + upn 
-                                + "/assignLicense?" + params, data, headers)
-                response = conn.getresponse()
-                response.read()
-                
-                if response.status != 200:
-                    count += 1
-                    # User was created with no licenses
-                    logging.error("user did not get licenses in o365: {0} " \
-                            "- re-try {1} in 5s".format(username, count))
-                    print("ERROR: User {0} did not get licenses in o365 " \
-                            "- re-try {1} in 5s".format(username, count))
-                    result = "SUCCESS: user added but with no licenses in o365."
-                    # Wait 5s for user to be fully created
-                    time.sleep(5)
-                else:
-                    count = 4
-                    # Log user creation
-                    logging.info("user added to o365: {0}".format(username))
-                    print("SUCCESS: User {0} added to o365".format(username))
-                    result = "SUCCESS: user was created in o365."
-                    
-            # close the TCP connection
-            conn.close()
+                writer.writerow([csvValue(value) for value in row])
+            valid += len(line)
+            count += 1
         
-    except Exception as e:
-        print("ERROR: Could not add user to o365: {0}".format(e))
-        logging.error("o365 add failed for user: {0}: {1}".format(username,e))
-        result = "ERROR: could not create o365 user."
-        return result
+        # Drop a cut off line so new rows start on a line of their own
+        f_journal.truncate(valid)
     
-    return result
+    return count
 
 
-def update(username, newusername, loginDisabled, givenName, fullName, sn, ou):
-    """This function updates user attributes, 
-    blocks and renames users if needed"""
+def journalMatches(path, fingerprint):
+    """Check that a journal, if there is one, is of the input file 
+    with this fingerprint"""
     
-    # Note: we can't change UDCid - it is an ImmutableId in O365!
+    if not os.path.exists(path):
+        return True
+    
+    with open(path, 'rb') as f_journal:
+        try:
+            header = json.loads(f_journal.readline())
+        except ValueError:
+            return False
+    
+    return isinstance(header, dict) \
+            and header.get("fingerprint") == fingerprint
 
-    # Check if any of the arguments are missing
-    params = locals()
+
+def fileFingerprint(path):
+    """Get a SHA-1 of a file, read in chunks to keep memory flat"""
     
-    for _item in params:
-        if str(params[_item]) == "":
-            print("ERROR: unable to update user {0} because {1} is missing " \
-                    "a value".format(username, _item))
-            logging.error("unable to update user {0} because {1} is missing " \
-                            "a value".format(username, _item))
-            result = "ERROR: Missing an expected input value for " \
-                        + _item + " in input file."
-            return result
+    digest = hashlib.sha1()
+    
+    with open(path, 'rb') as f_in:
+        for chunk in iter(lambda: f_in.read(1048576), ''):
+            digest.update(chunk)
+    
+    return digest.hexdigest()
 
-    # Get the Graph API access_token and
-    # Catch any MSFT login failures
-    if not ACCESS_TOKEN:
-        graphConnect()
-        if not ACCESS_TOKEN:
-            result = "ERROR: unable to authenticate to MSFT login service."
-            return result
+
+def stopRun(signum, frame):
+    """Signal handler that lets the rows in flight of a run finish and 
+    stops it after them, or stops it right away like an error would 
+    if no rows are running or it is signalled again"""
     
-    access_token = ACCESS_TOKEN
+    if ROWS_RUNNING and not STOPPING.is_set():
+        STOPPING.set()
+        return
     
-    # Do a quick check if the user already exists
-    upn = username + "@" + O365DOMAIN
+    raise SystemExit("stopped by signal {0}".format(signum))
+
+
+class O365Client(object):
+    """Warm session with O365 for other Python programs and the daemon.
     
-    if not findUser(upn):
-        print("ERROR: user does not exist in o365: {0}".format(username))
-        logging.error("user does not exist in o365: {0}".format(username))
-        result = "ERROR: user could not be found in o365!"
-        return result
+    The settings are read, the token is got and the users are loaded 
+    once, and the connections stay open between calls, so each call 
+    costs only its own requests. The prefetched users or the replica, 
+    the license seats and the deleted users are loaded again once they 
+    are CLIENTREFRESH seconds old. Settings and connections are globals 
+    of this module, so there can be only one client per process.
     
-    # rename if new username is diferent
-    # and does not already exist
-    if username != newusername:
-        newupn = newusername + "@" + O365DOMAIN
+        client = O365Client('o365settings.py', workers=8, batch=True)
+        print(client.delete('testuserj'))
+        client.close()
+    """
+
+    def __init__(self, config_file='o365settings.py', tenant=None, 
+                    workers=1, batch=False, prefetch=False, replica=False):
+        if not readConfig(config_file, tenant):
+            raise ValueError("unable to parse the settings file {0}" \
+                                .format(config_file))
         
-        # Check if the new user name already exists
-        if findUser(newupn):
-            print("ERROR: cannot rename user - user already exists: {0}" \
-                    .format(newusername))
-            logging.error("cannot rename user - user already exists: {0}" \
-                            .format(newusername))
-            result = "ERROR: username already taken!"
-            return result
-    else:
-        newupn = upn
+        self.workers = max(1, workers)
+        if self.workers > MAXWORKERS:
+            logging.warning("limiting workers from {0} to {1}" \
+                            .format(self.workers, MAXWORKERS))
+            self.workers = MAXWORKERS
+        sizePools(self.workers)
+        self.prefetch = prefetch
+        self.replica = replica
+        self.loaded = 0
         
-    # Rename, update attributes or disable
-    try:
-        # Set the bearer auth header
-        headers = {
-            'Authorization': 'Bearer ' + access_token,
-            'Content-Type': 'application/json; charset=utf-8'
-        }
+        if not graphConnect():
+            raise GraphError("unable to authenticate to MSFT login service")
         
-        # Set the required params
-        params = urllib.urlencode({
-            'api-version': API_VERSION,
-        })
+        if batch:
+            startBatcher(self.workers)
+        self.refresh()
+
+    def refresh(self):
+        """Load the users, seats and deleted users again if they are old"""
         
-        # Flip the loginDisabled value
-        if loginDisabled == "True":
-            accountEnabled = "False"
-        else:
-            accountEnabled = "True"
+        if time.time() - self.loaded < CLIENTREFRESH:
+            return
+        
+        if self.replica:
+            # The replica syncs on open once it is REPLICAMAXAGE old
+            closeReplica()
+            openReplica()
+        elif self.prefetch:
+            prefetchDirectory()
+        
+        if SEATCHECK:
+            loadSeats()
+        RECYCLED.clear()
+        self.loaded = time.time()
+
+    def run(self, rows, writer=None):
+        """Run rows like the ones of an input file and write their 
+        output lines to a csv writer, or return them as lists"""
+        
+        lines = None
+        if writer is None:
+            lines = writer = LineList()
+        
+        self.refresh()
+        waiting = collections.deque()
+        
+        try:
+            for row, result in runRows(iter(rows), self.workers):
+                waiting.append((row, result))
+                writeResults(writer, waiting, None)
+        finally:
+            # The deferred work of a call finishes with it
+            drainLicenses()
+            drainMembers()
+            writeResults(writer, waiting, None, True)
+        
+        return lines
+
+    def create(self, username, loginDisabled, UDCid, givenName, fullName, 
+                sn, primO, userPassword):
+        """Create a user and get the result"""
+        
+        return self.result({"action": "create", "username": username, 
+                            "newusername": username, 
+                            "loginDisabled": loginDisabled, "UDCid": UDCid, 
+                            "givenName": givenName, "fullName": fullName, 
+                            "sn": sn, "primO": primO, 
+                            "userPassword": userPassword})
+
+    def update(self, username, newusername, loginDisabled, givenName, 
+                fullName, sn, primO):
+        """Update or rename a user and get the result"""
+        
+        return self.result({"action": "update", "username": username, 
+                            "newusername": newusername, 
+                            "loginDisabled": loginDisabled, 
+                            "givenName": givenName, "fullName": fullName, 
+                            "sn": sn, "primO": primO})
+
+    def delete(self, username):
+        """Delete a user and get the result"""
+        
+        return self.result({"action": "delete", "username": username})
+
+    def list(self, select="", userFilter="", outfile=""):
+        """List the users like a list row and get the result"""
+        
+        return self.result({"action": "list", "username": "list", 
+                            "select": select, "filter": userFilter, 
+                            "outfile": outfile})
+
+    def result(self, row):
+        """Run one row and get the result of its own line"""
+        
+        return self.run([row])[-1][2]
+
+    def close(self):
+        """Finish the deferred work, report and close the connections"""
+        
+        drainLicenses()
+        drainMembers()
+        stopBatcher()
+        closeReplica()
+        runStats()
+        seatStats()
+        rateStats()
+        metricsStats()
+        poolStats()
+        closePools()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class LineList(type([])):
+    """Output lines kept in a list that can stand in for a csv writer"""
+    
+    def writerow(self, line):
+        self.append(line)
+
+    def writerows(self, lines):
+        self.extend(lines)
+
+
+def serveRows(address, args):
+    """Run as a daemon with one warm client that runs the rows sent to 
+    a local socket, one connection at a time, until it is stopped"""
+    
+    try:
+        client = O365Client(args.config, args.tenant, args.workers, 
+                            args.batch, args.prefetch, 
+                            args.replica or args.resync)
+    except (ValueError, GraphError) as e:
+        console("ERROR: could not start the daemon: {0}".format(e), True)
+        logging.critical("could not start the daemon: {0}".format(e))
+        return
+    
+    # Write the metrics now and then while the daemon runs
+    if args.metrics and args.metrics_every > 0:
+        startMetrics(args.metrics, args.metrics_every)
+    
+    # A socket left behind by a daemon that died is in the way
+    if os.path.exists(address) and stat.S_ISSOCK(os.stat(address).st_mode):
+        os.unlink(address)
+    
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner can connect
+    umask = os.umask(0o077)
+    try:
+        server.bind(address)
+    finally:
+        os.umask(umask)
+    server.listen(5)
+    logging.info("daemon listening on {0}".format(address))
+    console("INFO: daemon listening on {0}".format(address), True)
+    
+    try:
+        while True:
+            conn, _ = server.accept()
+            try:
+                serveBatch(client, conn)
+            except socket.error as e:
+                logging.error("lost the connection to a sender: {0}" \
+                                .format(e))
+            finally:
+                conn.close()
+            
+            # A SIGTERM during a batch stops the daemon after it
+            if STOPPING.is_set():
+                logging.warning("stopped by a signal after the rows " \
+                                "in flight")
+                break
+    
+    finally:
+        server.close()
+        os.unlink(address)
+        logging.info("daemon stopped")
+        client.close()
+        stopMetrics(args.metrics)
+    
+    return
+
+
+def serveBatch(client, conn):
+    """Run the rows of one sender, one JSON row per line until it shuts 
+    down its side, and send back the lines of an output file"""
+    
+    global ROWS_RUNNING
+    
+    f_conn = conn.makefile('rwb')
+    writer = csv.writer(f_conn)
+    writer.writerow(['action','username','result'])
+    
+    try:
+        # Read the whole batch first, so a sender that writes all rows 
+        # before it reads does not wait on us
+        rows = [row for row in readRows(f_conn, 'ndjson')]
+        logging.info("daemon got {0} rows".format(len(rows)))
+        # A SIGTERM from now on lets the rows in flight finish, so 
+        # their lines are sent back
+        ROWS_RUNNING = True
+        try:
+            client.run(rows, writer)
+        finally:
+            ROWS_RUNNING = False
+    
+    except Exception as e:
+        console("ERROR: unknown error while running a batch: {0}" \
+                .format(e), True)
+        logging.error("unknown error while running a batch: {0}".format(e))
+        writer.writerow(['', '', "ERROR: unknown error while running " \
+                        "the batch: {0}".format(e)])
+    
+    finally:
+        f_conn.close()
+    
+    return
+
+
+def sendRows(address, in_file, in_format, out_file):
+    """Send the rows of an input file to the daemon on a local socket 
+    and write the output it sends back"""
+    
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(address)
+        
+        with open(in_file, 'rb') as f_in:
+            for row in readRows(f_in, in_format):
+                conn.sendall(json.dumps(row) + "\n")
+        # The end of the rows
+        conn.shutdown(socket.SHUT_WR)
+        
+        with open(out_file, 'wb') as f_out:
+            for chunk in iter(lambda: conn.recv(65536), ''):
+                f_out.write(chunk)
+        conn.close()
+    
+    except IOError as e:
+        # socket.error is an IOError too
+        console("ERROR: could not send the rows to the daemon on {0}: " \
+                "{1}".format(address, e), True)
+        logging.critical("could not send {0} to the daemon on {1}: {2}" \
+                .format(in_file, address, e))
+        return False
+    
+    logging.info("the daemon on {0} ran {1}".format(address, in_file))
+    
+    return True
+
+
+def runParts(args, in_format):
+    """Split the input by tenant and by user into parts, run each part 
+    in its own process and merge their results into the output in 
+    input order"""
+    
+    shards = max(1, args.shards)
+    in_file = args.file
+    out_file = args.out
+    
+    # Users linked by renames have to stay in the same shard
+    with open(in_file, 'rb') as f_in:
+        groups = UserGroups()
+        for row in readRows(f_in, in_format):
+            # Shards run on their own, so nothing can wait for the rows 
+            # of all of them
+            if shards > 1 and row.get("action") in BARRIERS:
+                console("ERROR: {0} cannot be used with --shards, run it " \
+                        "without --shards".format(row["action"]), True)
+                logging.error("{0} cannot be used with --shards" \
+                                .format(row["action"]))
+                return False
+            groups.join(rowKeys(row))
+    
+    # Part of every input row in input order, -1 for unknown tenants
+    order = array.array('i')
+    unknown = {}
+    parts = {}
+    names = []
+    commands = []
+    files = []
+    
+    try:
+        with open(in_file, 'rb') as f_in:
+            for row in readRows(f_in, in_format):
+                tenant = rowTenant(row, args.tenant)
+                if tenant and tenant not in TENANTS:
+                    unknown[len(order)] = [row.get("action", ""), 
+                                            row.get("username", ""), 
+                                            "ERROR: unknown tenant {0}." \
+                                            .format(tenant)]
+                    order.append(-1)
+                    continue
+                
+                key = (tenant, groups.shard(rowKeys(row), shards))
+                if key not in parts:
+                    name = out_file
+                    if tenant:
+                        name += "." + tenant
+                    if shards > 1:
+                        name += ".shard{0}".format(key[1])
+                    parts[key] = len(names)
+                    names.append(name)
+                    commands.append(partCommand(args, name, tenant))
+                    files.append(open(name + ".jsonl", 'wb'))
+                
+                order.append(parts[key])
+                files[parts[key]].write(json.dumps(row) + "\n")
+    finally:
+        for f_part in files:
+            f_part.close()
+    
+    logging.info("split {0} rows into {1} parts".format(len(order), 
+                                                        len(names)))
+    console("INFO: split {0} rows into {1} parts".format(len(order), 
+                                                        len(names)))
+    
+    # Tenants run at the same time, so a slow one does not hold up 
+    # the others
+    processes = [subprocess.Popen(command) for command in commands]
+    failed = []
+    try:
+        for name, process in zip(names, processes):
+            if process.wait() != 0:
+                failed.append(name)
+    finally:
+        # Stop the other parts if this run is stopped
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+    
+    missing = mergeParts(out_file, names, order, unknown)
+    
+    if failed or missing:
+        logging.error("parts {0} did not finish, {1} rows have no " \
+                        "result".format(failed, missing))
+        console("ERROR: parts {0} did not finish, {1} rows have no " \
+                    "result, run again with --resume".format(failed, missing), 
+                    True)
+        return False
+    
+    # The part files are only needed to resume
+    for name in names:
+        for path in (name + ".jsonl", name + ".csv", name + ".csv.journal"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    return True
+
+
+def partCommand(args, name, tenant):
+    """Build the command line that runs one part"""
+    
+    script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    command = [sys.executable, script, "-f", name + ".jsonl", 
+                "--format", "ndjson", "-o", name + ".csv", 
+                "--config", args.config, "-w", str(args.workers), 
+                "--log-level", args.log_level, 
+                "--log-format", args.log_format, 
+                "--progress-every", str(args.progress_every)]
+    
+    if tenant:
+        command.extend(["--tenant", tenant])
+    
+    # Each tenant has its own replica file
+    for flag in ("resume", "coalesce", "batch", "prefetch", "replica", 
+                    "resync", "quiet"):
+        if getattr(args, flag):
+            command.append("--" + flag)
+    
+    if args.metrics:
+        command.extend(["--metrics", 
+                        name + "." + os.path.basename(args.metrics), 
+                        "--metrics-every", str(args.metrics_every)])
+    
+    return command
+
+
+def mergeParts(out_file, names, order, unknown):
+    """Write the results of the parts into the output in input order,
+    returns the number of rows that have no result.
+    
+    The results are read from the journals of the parts, which have 
+    one line for each row even if it wrote several output lines, like 
+    audit-licenses and purge do."""
+    
+    readers = [journalRows(name + ".csv.journal") for name in names]
+    missing = 0
+    
+    with open(out_file, 'wb') as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(['action','username','result'])
+        for index, part in enumerate(order):
+            if part < 0:
+                writer.writerow(unknown[index])
+                continue
+            lines = next(readers[part], None)
+            if lines is None:
+                missing += 1
+                lines = [['', '', "ERROR: {0} did not finish." \
+                            .format(names[part])]]
+            writer.writerows(lines)
+    
+    return missing
+
+
+def journalRows(path):
+    """Yield the output lines of each row recorded in a journal, up to 
+    a line cut off by a run that died writing it"""
+    
+    try:
+        f_journal = open(path, 'rb')
+    except IOError:
+        return
+    
+    with f_journal:
+        # Skip the fingerprint
+        f_journal.readline()
+        for line in f_journal:
+            if not line.endswith("\n"):
+                break
+            try:
+                row = json.loads(line)
+            except ValueError:
+                break
+            # A row with several output lines is one list of them
+            if not (row and isinstance(row[0], type([]))):
+                row = [row]
+            yield [[csvValue(value) for value in item] for item in row]
+    
+    return
+
+
+def rowTenant(row, tenant=None):
+    """Get the tenant a row goes to, None for the one of the settings 
+    file itself"""
+    
+    return str(row.get("tenant") or tenant or "") or None
+
+
+def mixedTenants(in_file, in_format, tenant=None):
+    """Check if any row of the input goes to another tenant"""
+    
+    with open(in_file, 'rb') as f_in:
+        for row in readRows(f_in, in_format):
+            if rowTenant(row, tenant) != (tenant or None):
+                return True
+    
+    return False
+
+
+class UserGroups(object):
+    """Groups of user names that are linked by renames, kept as a 
+    union-find with the smallest name of each group as its root, 
+    so the shard of a group does not depend on the row order"""
+
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, name):
+        """Get the root name of the group of a name"""
+        
+        root = name
+        while self.parents.get(root, root) != root:
+            root = self.parents[root]
+        
+        # Point the names on the way straight to the root
+        while name != root:
+            name, self.parents[name] = self.parents[name], root
+        
+        return root
+
+    def join(self, names):
+        """Put names into the same group"""
+        
+        roots = set(self.find(name) for name in names)
+        if not roots:
+            return
+        
+        first = min(roots)
+        for root in roots:
+            self.parents[root] = first
+
+    def shard(self, names, shards):
+        """Get the shard of the group of names"""
+        
+        if not names:
+            return 0
+        
+        root = self.find(min(names))
+        
+        return int(hashlib.md5(root).hexdigest(), 16) % shards
+
+
+def readRows(f_in, in_format='json', size=65536):
+    """Yield the user actions of an input file one at a time"""
+    
+    if in_format == 'ndjson':
+        for line in f_in:
+            if line.strip():
+                yield json.loads(line)
+        return
+    
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+    
+    def more(buf, pos):
+        # Drop what was parsed already and read the next chunk
+        chunk = f_in.read(size)
+        return buf[pos:] + chunk, 0, not chunk
+    
+    # Skip ahead to the start of the useractions array
+    while True:
+        start = buf.find('"useractions"')
+        if start >= 0:
+            bracket = buf.find('[', start)
+            if bracket >= 0:
+                pos = bracket + 1
+                break
+        if eof:
+            raise ValueError("no useractions in the input file")
+        buf, pos, eof = more(buf, 0)
+    
+    while True:
+        # Skip the separators between rows
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        
+        if pos == len(buf):
+            if eof:
+                raise ValueError("unexpected end of the input file")
+            buf, pos, eof = more(buf, pos)
+            continue
+        
+        if buf[pos] == ']':
+            break
+        
+        try:
+            row, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # The row is cut off at the end of the chunk
+            if eof:
+                raise
+            buf, pos, eof = more(buf, pos)
+            continue
+        
+        pos = end
+        yield row
+    
+    return
+
+
+def processRow(row):
+    """Run the action of a single input row and return its result"""
+    
+    result = ''
+    # Select what needs to be done
+    if row["action"] == 'create':
+        result = create(str(row["username"]), str(row["loginDisabled"]), 
+                        str(row["UDCid"]), str(row["givenName"]), 
+                        str(row["fullName"]), str(row["sn"]),  
+                        str(row["primO"]), str(row["userPassword"]))
+    elif row["action"] == 'update':
+        result = update(str(row["username"]), str(row["newusername"]), 
+                        str(row["loginDisabled"]), 
+                        str(row["givenName"]), str(row["fullName"]), 
+                        str(row["sn"]), str(row["primO"]))
+    elif row["action"] == 'delete':
+         result = delete(str(row["username"]))
+    elif row["action"] == 'list':
+         result = list(str(row.get("select", "")), 
+                        row.get("filter", ""), str(row.get("outfile", "")))
+    elif row["action"] in ('addgroup', 'removegroup'):
+         result = changeGroups(str(row["username"]), rowGroups(row), 
+                                row["action"] == 'removegroup')
+    elif row["action"] == 'purge':
+         result = purge()
+    elif row["action"] == 'audit-licenses':
+         result = auditLicenses(row.get("filter", ""), 
+                                str(row.get("repair", "True")) != "False")
+    else:
+        console("ERROR: unrecognized action: {0}".format(row["action"]))
+        logging.error("unrecognized action: {0}".format(row["action"]))
+        result = "ERROR: Unrecognized action."
+    
+    return result
+
+
+def runRows(rows, workers=1):
+    """Run the input rows and yield each row with its result 
+    in input order, using a pool of worker threads if asked"""
+    
+    if workers <= 1:
+        for row in rows:
+            if STOPPING.is_set():
+                logging.warning("stopping, no more rows are run")
+                break
+            yield row, processRow(row)
+        return
+    
+    # Rows waiting for a worker - bounded so we do not read too far ahead
+    tasks = Queue.Queue(workers * 2)
+    # Rows in input order that were not written out yet
+    pending = collections.deque()
+    # Last row that touched each user, so actions on 
+    # one user run one after another in input order
+    last = {}
+    # Last row that acts on all users, e.g. purge
+    barrier = None
+    # UDCids of the users the rows so far created or deleted
+    UDCids = {}
+    
+    threads = []
+    for _ in range(workers):
+        thread = threading.Thread(target=rowWorker, args=(tasks,))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    
+    for row in rows:
+        # Stop sending rows once the run is stopped
+        if STOPPING.is_set():
+            break
+        
+        task = {
+            "row": row,
+            "keys": linkUDCids(rowKeys(row), UDCids),
+            "done": threading.Event(),
+            "result": None,
+            "error": None
+        }
+        task["after"] = [last[key]["done"] for key in task["keys"] 
+                            if key in last]
+        if row.get("action") in BARRIERS:
+            # It waits for all rows before it and all rows after it wait
+            task["after"] = [earlier["done"] for earlier in pending]
+            barrier = task
+        elif barrier is not None:
+            task["after"].append(barrier["done"])
+        for key in task["keys"]:
+            last[key] = task
+        
+        tasks.put(task)
+        pending.append(task)
+        
+        # Hand back finished rows as soon as all rows before them are done
+        while pending and pending[0]["done"].is_set():
+            yield finishTask(pending.popleft(), last)
+    
+    # Rows no worker took yet are the last ones sent, they are not 
+    # run, and the rows in flight are waited for
+    if STOPPING.is_set():
+        dropped = dropTasks(tasks)
+        for _ in dropped:
+            pending.pop()
+        logging.warning("stopping, {0} rows in flight are finished " \
+                        "first".format(len(pending)))
+    
+    for _ in threads:
+        tasks.put(None)
+    
+    while pending:
+        pending[0]["done"].wait()
+        yield finishTask(pending.popleft(), last)
+    
+    for thread in threads:
+        thread.join()
+    
+    return
+
+
+# Actions that act on all users and run between the rows around them
+BARRIERS = ('purge',)
+
+
+def rowWorker(tasks):
+    """Worker thread that runs rows from the task queue"""
+    
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        
+        # Wait for earlier actions on the same user
+        for done in task["after"]:
+            done.wait()
+        
+        try:
+            task["result"] = processRow(task["row"])
+        except Exception as e:
+            task["error"] = e
+        finally:
+            task["done"].set()
+    
+    return
+
+
+def dropTasks(tasks):
+    """Take the tasks no worker took yet off the task queue"""
+    
+    dropped = []
+    
+    while True:
+        try:
+            dropped.append(tasks.get_nowait())
+        except Queue.Empty:
+            break
+    
+    return dropped
+
+
+def finishTask(task, last):
+    """Forget a finished task and return its row and result"""
+    
+    for key in task["keys"]:
+        if last.get(key) is task:
+            del last[key]
+    
+    # Let the caller handle errors just like in the single-threaded run
+    if task["error"] is not None:
+        raise task["error"]
+    
+    return task["row"], task["result"]
+
+
+def coalesceRows(rows, workers=1):
+    """Merge the rows of each user into the fewest equal actions, run 
+    those and yield each input row with the result of its action"""
+    
+    rows = [row for row in rows]
+    actions, owners = planRows(rows)
+    
+    results = {}
+    running = runRows(actions, workers)
+    
+    for row, owner in zip(rows, owners):
+        if owner is None:
+            yield row, "SUCCESS: no change, user created and deleted " \
+                        "in the same run."
+            continue
+        
+        # Actions finish in the order of their first row, a stopped 
+        # run ends before the actions it did not run
+        while owner not in results:
+            action = next(running, None)
+            if action is None:
+                return
+            results[action[0]["index"]] = action[1]
+        
+        yield row, results[owner]
+    
+    for _ in running:
+        pass
+    
+    return
+
+
+def planRows(rows):
+    """Merge the rows of each user into the fewest equal actions.
+    
+    Returns the actions to run and for each row the index of the action
+    that does its work, or None if its work cancels out. A row is only 
+    merged into the last action on its user if no action in between 
+    touched any of the user names involved, so renames stay correct."""
+    
+    actions = []
+    owners = []
+    # Last action that touched each user name
+    last = {}
+    saved = 0
+    
+    for row in rows:
+        old, new = rowNames(row)
+        target = last.get(old)
+        
+        if target is not None and mergeable(target, row, last):
+            # Work of the row goes into the earlier action
+            if target["action"] == 'create' and row["action"] == 'update':
+                target["username"] = target["newusername"] = new
+                for field in MERGEFIELDS:
+                    target[field] = row[field]
+                owner = target["index"]
+                saved += 2
+            elif row["action"] == 'delete' and target["action"] == 'create':
+                # The user never has to exist
+                target["cancelled"] = True
+                owners = [None if owner == target["index"] else owner 
+                            for owner in owners]
+                owner = None
+                saved += 5
+            elif target["action"] == 'update' and row["action"] == 'update':
+                target["newusername"] = row["newusername"]
+                for field in MERGEFIELDS:
+                    target[field] = row[field]
+                owner = target["index"]
+                saved += 2
+            else:
+                # An update followed by a delete is just a delete
+                target["action"] = 'delete'
+                target["newusername"] = target["username"]
+                owner = target["index"]
+                saved += 2
+            
+            for name in (old, new):
+                last[name] = target
+            owners.append(owner)
+            continue
+        
+        action = dict(row)
+        action["index"] = len(actions)
+        actions.append(action)
+        owners.append(action["index"])
+        for name in (old, new):
+            last[name] = action
+    
+    # Drop the actions that cancelled out and renumber the owners
+    kept = [planned for planned in actions if not planned.get("cancelled")]
+    number = dict((action["index"], index) 
+                    for index, action in enumerate(kept))
+    for index, action in enumerate(kept):
+        action["index"] = index
+    owners = [number.get(owned) for owned in owners]
+    
+    merged = len(rows) - len(kept)
+    if merged:
+        logging.info("coalesced {0} rows into {1} actions, saving about " \
+                    "{2} o365 calls".format(len(rows), len(kept), saved))
+        console("INFO: coalesced {0} rows into {1} actions, saving about " \
+                    "{2} o365 calls".format(len(rows), len(kept), saved))
+        countStat("rows coalesced", merged)
+        countStat("calls saved by coalescing", saved)
+    
+    return kept, owners
+
+
+# Fields a later update changes in an earlier create or update
+MERGEFIELDS = ("loginDisabled", "givenName", "fullName", "sn", "primO")
+
+# Fields each action needs, rows missing any are never merged
+ACTIONFIELDS = {
+    "create": ("username", "loginDisabled", "UDCid", "givenName", 
+                "fullName", "sn", "primO", "userPassword"),
+    "update": ("username", "newusername", "loginDisabled", "givenName", 
+                "fullName", "sn", "primO"),
+    "delete": ("username",)
+}
+
+
+def mergeable(target, row, last):
+    """Check if a row can be merged into an earlier action"""
+    
+    if target.get("cancelled") or row.get("action") not in ACTIONFIELDS \
+            or target.get("action") not in ACTIONFIELDS:
+        return False
+    
+    # The earlier action has to end with the user name the row starts with
+    old, new = rowNames(row)
+    if rowNames(target)[1] != old:
+        return False
+    
+    # create ignores loginDisabled, so it cannot take over a block
+    if target["action"] == 'create' and row["action"] == 'update' \
+            and str(row["loginDisabled"]) == "True":
+        return False
+    
+    # Nothing merges into a delete
+    if target["action"] == 'delete' or row["action"] == 'create':
+        return False
+    
+    # No other action may have touched the names since
+    for name in (old, new):
+        if name in last and last[name]["index"] > target["index"]:
+            return False
+    
+    # Both rows need all their values, so no error gets lost
+    for action in (target, row):
+        for field in ACTIONFIELDS[action["action"]]:
+            if str(action.get(field, "")) == "":
+                return False
+    
+    return True
+
+
+def rowNames(row):
+    """Get the lower case user names a row starts and ends with"""
+    
+    old = str(row.get("username", "")).strip().lower()
+    new = old
+    if row.get("action") == 'update':
+        new = str(row.get("newusername", "")).strip().lower() or old
+    
+    return old, new
+
+
+def rowKeys(row):
+    """Get the user names that a row acts on, and the UDCid of a create 
+    or delete row, as a deleted user keeps its UDCid and a create with 
+    it restores that user under another name"""
+    
+    keys = set()
+    for field in ("username", "newusername"):
+        value = str(row.get(field, "")).strip().lower()
+        if value:
+            keys.add(value)
+    
+    if row.get("action") in ('create', 'delete'):
+        UDCid = str(row.get("UDCid", "")).strip()
+        if UDCid:
+            keys.add("UDCid:" + UDCid)
+    
+    return keys
+
+
+def linkUDCids(keys, UDCids):
+    """Add the UDCids of the users a row acts on to its keys and 
+    remember the UDCids of its users, so e.g. a delete row with no 
+    UDCid still runs before a create that restores the deleted user"""
+    
+    ids = set(key for key in keys if key.startswith("UDCid:"))
+    for key in keys:
+        ids.update(UDCids.get(key, ()))
+    
+    if ids:
+        for key in keys:
+            if not key.startswith("UDCid:"):
+                UDCids[key] = ids
+    
+    return keys | ids
+
+
+def create(username, loginDisabled, UDCid, givenName, fullName, sn, ou, 
+            userPassword):
+    """This funtion adds users to O365"""
+    
+    # Check if any of the parameters are missing
+    params = locals()
+    
+    for _item in params:
+        if str(params[_item]) == "":
+            console("ERROR: unable to create user {0} because {1} is missing " \
+                    "a value".format(username, _item))
+            logging.error("unable to create user {0} because {1} is missing " \
+                            "a value".format(username, _item))
+            result = "ERROR: Missing an expected input value for " + _item \
+                        + " in input file."
+            return result
+
+    # Get the Graph API access_token and
+    # Catch any MSFT login failures
+    if not ACCESS_TOKEN:
+        graphConnect()
+        # Test again
+        if not ACCESS_TOKEN:
+            result = "ERROR: unable to authenticate to MSFT login service."
+            return result
+    
+    # Do a quick check if the user already exists
+    upn = username + "@" + O365DOMAIN
+    user = getUser(upn)
+
+    if user == {}:
+        # Graph API kept failing, so we do not know
+        result = "ERROR: could not check if the user exists in o365."
+        return result
+    
+    if user is not None:
+        console("ERROR: cannot create user - user already exists: {0}" \
+                .format(username))
+        logging.error("cannot create user - user already exists: {0}" \
+                .format(username))
+        result = "ERROR: username already taken!"
+        return result
+    
+    # Determine licenses based on user type
+    userType = getUserType(username)
+    
+    # Assign correct licenses for Stu/Emp users
+    # Disable MCOSTANDARD/EXCHANGE_S_STANDARD plans
+    if userType == "STU":
+        licenses = [{"disabledPlans":DISABLEDPLANS, "skuId":STULICENSE}]
+    else:
+        licenses = [{"disabledPlans":DISABLEDPLANS, "skuId":EMPLICENSE}]
+    
+    # Do not create a user that cannot get a license
+    if SEATS is not None and not SEATS.reserve(upn, licenses[0]["skuId"]):
+        name = SEATS.name(licenses[0]["skuId"])
+        console("ERROR: cannot create user {0} - no free seats of license " \
+                "{1}".format(username, name))
+        logging.error("cannot create user {0} - no free seats of license " \
+                "{1}".format(username, name))
+        result = "ERROR: no free seats of license {0} in o365.".format(name)
+        return result
+    
+    # A returning user is restored from the recycle bin, 
+    # its immutableId would make the POST fail anyway
+    if RESTOREDELETED:
+        try:
+            deleted = RECYCLED.find(UDCid)
+        except GraphError as e:
+            logging.warning("unable to list deleted users in o365: {0}" \
+                            .format(e))
+            deleted = None
+        if deleted is not None:
+            return restore(username, deleted, givenName, fullName, sn, ou, 
+                            userPassword, licenses)
+    
+    # The replica also knows if the immutableId is taken,
+    # which would make the POST fail
+    if isinstance(DIRECTORY, DirectoryReplica):
+        owner = DIRECTORY.getUpnByImmutableId(UDCid)
+        if owner:
+            console("ERROR: cannot create user {0} - UDCid already used by " \
+                    "{1}".format(username, owner))
+            logging.error("cannot create user {0} - UDCid already used by " \
+                    "{1}".format(username, owner))
+            if SEATS is not None:
+                SEATS.release(upn)
+            result = "ERROR: UDCid already used by another o365 user!"
+            return result
+    
+    try:
+        # Create body of the request                
+        body = {
+            "userPrincipalName": upn,
+            "accountEnabled": "true",
+            "givenName": givenName,
+            "displayName": fullName,
+            "surname": sn,
+            "mailNickname": username,
+            "department": ou,
+            "immutableId": UDCid,
+            "passwordProfile": {"password": userPassword, 
+                                "forceChangePasswordNextLogin": "false"},
+            "passwordPolicies": "DisablePasswordExpiration",
+            "usageLocation": "US"
+        }
+        
+        data = json.dumps(body)
+        
+        # Send it over a pooled connection to o365
+        response, data = graphRequest("POST", graphUrl("/users"), data, 
+                                    JSON_HEADERS, "create")
+        
+        if response.status != 201:
+            # User was not created
+            if SEATS is not None:
+                SEATS.release(upn)
+            logging.error("user could not be created in o365: {0}" \
+                        .format(username))
+            console("ERROR: User {0} could not be added to o365" \
+                        .format(username))
+            result = "ERROR: user could not be created in o365."
+        else:                
+            user = json.loads(data) if data else body
+            
+            # Keep the prefetched directory current
+            if DIRECTORY is not None:
+                DIRECTORY.add(upn, user)
+            
+            # The new user takes a while to show up for assignLicense,
+            # so queue the licenses and move on to the next row, the 
+            # result is filled in once the licenses are assigned
+            result = queueLicense(username, upn, user.get('objectId'), 
+                                    licenses)
+        
+    except Exception as e:
+        if SEATS is not None:
+            SEATS.release(upn)
+        console("ERROR: Could not add user to o365: {0}".format(e))
+        logging.error("o365 add failed for user: {0}: {1}".format(username,e))
+        result = "ERROR: could not create o365 user."
+        return result
+    
+    return result
+
+
+class PendingResult(object):
+    """Result of a row that is only known once deferred work is done"""
+
+    def __init__(self, result):
+        self.result = result
+        self.done = threading.Event()
+
+    def finish(self, result):
+        self.result = result
+        self.done.set()
+
+
+def resultReady(result, wait=False):
+    """Check if a row result is final, optionally waiting for it"""
+    
+    if not isinstance(result, PendingResult):
+        return True
+    
+    if wait:
+        result.done.wait()
+    
+    return result.done.is_set()
+
+
+def resultText(result):
+    """Get the text of a final row result"""
+    
+    if isinstance(result, (PendingResult, RowLines)):
+        return result.result
+    
+    return result
+
+
+class LicenseQueue(object):
+    """Deferred license assignments of new users.
+    
+    Right after a POST the new user is often not ready for assignLicense 
+    yet, so instead of making the worker wait, assignments are queued 
+    and a background thread sends the ones that are due in $batch 
+    requests, trying failed ones again with a growing backoff."""
+
+    def __init__(self, delay, retries):
+        self.delay = delay
+        self.retries = retries
+        self.items = []
+        # Items being assigned right now
+        self.sending = []
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, username, upn, userId, licenses, 
+            done="SUCCESS: user was created in o365.", remove=None):
+        """Queue licenses of a new user and return its pending result"""
+        
+        add = [item["skuId"] for item in licenses]
+        remove = remove or []
+        item = {
+            "username": username,
+            "upn": upn,
+            # The objectId still works if the user is renamed meanwhile
+            "userId": userId or upn,
+            "add": add,
+            "remove": remove,
+            "body": licenseBody(add, remove),
+            "due": time.time() + self.delay,
+            # Tries while the user was not ready and throttled or 
+            # failed tries, each with its own budget
+            "attempt": 0,
+            "tries": 0,
+            "done": done,
+            "pending": PendingResult("SUCCESS: user added but with no " \
+                                    "licenses in o365.")
+        }
+        
+        with self.cond:
+            self.items.append(item)
+            self.cond.notify()
+        
+        return item["pending"]
+
+    def cancel(self, upn):
+        """Drop the licenses of a user that is deleted before it got them"""
+        
+        with self.cond:
+            for item in [item for item in self.items if item["upn"] == upn]:
+                self.items.remove(item)
+                self.finish(item, False, True)
+            # Do not try these again if they fail
+            for item in self.sending:
+                if item["upn"] == upn:
+                    item["cancelled"] = True
+
+    def run(self):
+        """Background thread that assigns the licenses that are due"""
+        
+        while True:
+            with self.cond:
+                while True:
+                    if not self.items and self.stopping:
+                        return
+                    now = time.time()
+                    due = [item for item in self.items if item["due"] <= now]
+                    if due:
+                        break
+                    wait = None
+                    if self.items:
+                        wait = min(item["due"] for item in self.items) - now
+                    self.cond.wait(wait)
+                
+                for item in due:
+                    self.items.remove(item)
+                self.sending = due
+            
+            # Many users share each $batch request
+            for start in range(0, len(due), BATCHSIZE):
+                try:
+                    self.assign(due[start:start + BATCHSIZE])
+                except Exception as e:
+                    logging.error("o365 license assignment failed: {0}" \
+                                    .format(e))
+                    for item in due[start:start + BATCHSIZE]:
+                        self.retry(item, True)
+
+    def assign(self, items):
+        """Send assignLicense for a group of users"""
+        
+        requests = [licenseRequest(item["userId"], item["body"]) 
+                    for item in items]
+        postRequests(requests, "assignLicense")
+        
+        for item, request in zip(items, requests):
+            response = request["response"]
+            if item["attempt"] or item["tries"]:
+                METRICS.retried("assignLicense")
+            if response is not None and response[0].status == 200:
+                self.finish(item, True)
+            elif item.get("cancelled"):
+                self.finish(item, False, True)
+            elif response is not None and response[0].status == 400:
+                # E.g. no seats left, trying again does not help
+                logging.error("o365 refused licenses of {0}: {1}" \
+                                .format(item["username"], response[1]))
+                self.finish(item, False)
+            elif response is None or response[0].status in RETRYSTATUS:
+                self.retry(item, True, parseRetryAfter(response and 
+                                    response[0].getheader('Retry-After')))
+            else:
+                self.retry(item)
+
+    def retry(self, item, failed=False, retryAfter=None):
+        """Try an assignment again later or give up. Throttled and 
+        failed calls go again after the pause of the rate limiter or 
+        a backoff, up to MAXRETRIES times, and a user that is not ready 
+        for licenses yet is tried up to retries times on top of that"""
+        
+        if failed:
+            item["tries"] += 1
+            exhausted = item["tries"] > MAXRETRIES
+        else:
+            item["attempt"] += 1
+            exhausted = item["attempt"] > self.retries
+        
+        if item.get("cancelled"):
+            self.finish(item, False, True)
+            return
+        
+        if exhausted:
+            self.finish(item, False)
+            return
+        
+        if failed:
+            # The limiter holds the next batch until a Retry-After is over
+            delay = 0 if retryAfter is not None \
+                        else backoffDelay(item["tries"])
+            logging.warning("licenses of {0} were not assigned in o365 " \
+                    "- re-try {1} in {2:.1f}s".format(item["username"], 
+                                                item["tries"], delay))
+        else:
+            # Give the new user longer to show up after each try
+            delay = self.delay + backoffDelay(item["attempt"])
+            logging.warning("user did not get licenses in o365 yet: {0} " \
+                    "- re-try {1} in {2:.1f}s".format(item["username"], 
+                                                item["attempt"], delay))
+        
+        with self.cond:
+            item["due"] = time.time() + delay
+            self.items.append(item)
+            self.cond.notify()
+
+    def finish(self, item, assigned, cancelled=False):
+        """Fill in the final result of the row that created the user, 
+        cancelled if the user was deleted before it got its licenses"""
+        
+        if cancelled:
+            # The delete gives back the seat, and this is no failure
+            logging.info("dropped licenses of user deleted in o365: {0}" \
+                            .format(item["username"]))
+            countStat("licenses of deleted users dropped")
+            item["pending"].finish(item["done"].rstrip(".") 
+                                    + ", deleted before it got licenses.")
+        elif assigned:
+            # Log user creation
+            logging.info("user added to o365: {0}".format(item["username"]))
+            console("SUCCESS: User {0} added to o365".format(item["username"]))
+            countStat("licenses assigned")
+            recordLicenses(item["upn"], item["add"], item["remove"])
+            item["pending"].finish(item["done"])
+        else:
+            # User was created with no licenses
+            if SEATS is not None:
+                SEATS.release(item["upn"])
+            logging.error("user did not get licenses in o365: {0}" \
+                            .format(item["username"]))
+            console("ERROR: User {0} did not get licenses in o365" \
+                            .format(item["username"]))
+            countStat("licenses not assigned")
+            item["pending"].finish("SUCCESS: user added but with no " \
+                                    "licenses in o365.")
+
+    def drain(self):
+        """Wait until every queued assignment is done"""
+        
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+
+
+def licenseRequest(userId, body):
+    """Build an assignLicense request for postRequests"""
+    
+    return {
+        "method": "POST",
+        "url": graphUrl("/users/" + userId + "/assignLicense"),
+        "body": body,
+        "headers": authHeaders(),
+        "response": None
+    }
+
+
+def licenseBody(add, remove=()):
+    """Get the assignLicense body that adds the licenses add with the 
+    DISABLEDPLANS and removes the licenses remove, it is the same for 
+    many users so it is built once"""
+    
+    key = (tuple(add), tuple(remove))
+    body = LICENSEBODIES.get(key)
+    
+    if body is None:
+        body = json.dumps({
+            "addLicenses": [{"disabledPlans": DISABLEDPLANS, "skuId": skuId} 
+                            for skuId in add],
+            "removeLicenses": [skuId for skuId in remove]
+        })
+        LICENSEBODIES[key] = body
+    
+    return body
+
+
+# assignLicense bodies by the licenses they add and remove
+LICENSEBODIES = {}
+
+
+def postRequests(requests, op):
+    """Send a group of queued change requests, as one $batch request 
+    if there are several, and fill in their responses. Like graphRequest,
+    the ones the access token was rejected for go once more after 
+    logging in again"""
+    
+    sendRequests(requests, op)
+    
+    rejected = [request for request in requests 
+                if request["response"] is not None 
+                and request["response"][0].status == 401]
+    if not rejected:
+        return
+    
+    # The token expired early or was revoked
+    logging.warning("o365 rejected the access token, logging in again")
+    token = rejected[0]["headers"].get('Authorization', '')
+    graphConnect(token[len('Bearer '):])
+    for request in rejected:
+        request["headers"] = dict(request["headers"], 
+                        Authorization='Bearer ' + (ACCESS_TOKEN or ''))
+        request["response"] = None
+    sendRequests(rejected, op)
+    
+    return
+
+
+def sendRequests(requests, op):
+    """Send a group of requests for postRequests"""
+    
+    LIMITER.acquire()
+    started = time.time()
+    if len(requests) == 1:
+        requests[0]["response"] = httpRequest(GRAPH_HOST, 
+                            requests[0]["method"], requests[0]["url"], 
+                            requests[0]["body"], requests[0]["headers"])
+    else:
+        sendBatch(requests)
+    seconds = time.time() - started
+    
+    for request in requests:
+        response = request["response"]
+        if response is None:
+            continue
+        METRICS.observe(op, response[0].status, seconds, 
+                        len(request["body"]), getattr(response[0], 
+                                            'received', len(response[1])))
+        paceResponse(response[0], started)
+    
+    return
+
+
+def auditLicenses(userFilter="", repair=True):
+    """This function checks that every user has the license of its type
+    with the DISABLEDPLANS, and repairs the ones that do not"""
+    
+    # Get the Graph API access_token and
+    # Catch any MSFT login failures
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            result = "ERROR: unable to authenticate to MSFT login service."
+            return result
+    
+    # Only the fields the audit needs, a page as large as allowed
+    query = {
+        '$select': 'objectId,userPrincipalName,assignedLicenses',
+        '$top': '999'
+    }
+    if userFilter:
+        query['$filter'] = userFilter
+    params = graphParams(query)
+    
+    lines = []
+    fixes = []
+    domain = "@" + O365DOMAIN.lower()
+    
+    try:
+        for page in getUserPages(params, JSON_HEADERS):
+            for user in page:
+                upn = user.get("userPrincipalName") or ""
+                # Leave users of other domains alone, e.g. admins
+                if not upn.lower().endswith(domain):
+                    continue
+                
+                add, remove = licenseChanges(user)
+                if add is None and not remove:
+                    lines.append([upn, "SUCCESS: licenses are correct."])
+                    continue
+                if not repair:
+                    lines.append([upn, "ERROR: licenses are not correct."])
+                    continue
+                
+                lines.append([upn, ""])
+                fixes.append([lines[-1], user, add, remove, 0])
+                if len(fixes) >= BATCHSIZE:
+                    # Throttled ones go again with the next group
+                    fixes = repairLicenses(fixes[:BATCHSIZE]) \
+                            + fixes[BATCHSIZE:]
+            
+            console("INFO: audited licenses of {0} o365 users" \
+                    .format(len(lines)))
+        
+        while fixes:
+            retry = repairLicenses(fixes[:BATCHSIZE])
+            fixes = fixes[BATCHSIZE:]
+            if retry and not fixes:
+                LIMITER.backoff(max(fix[4] for fix in retry))
+            fixes = retry + fixes
+        
+    except GraphError as e:
+        logging.error("did not get the licenses of o365 users: {0}" \
+                        .format(e))
+        console("ERROR: did not get the licenses of o365 users")
+        return RowLines(lines, "ERROR: did not get the licenses of all " \
+                        "o365 users.")
+    
+    counts = collections.Counter(line[1] for line in lines)
+    repaired = counts["SUCCESS: licenses repaired."]
+    wrong = len(lines) - counts["SUCCESS: licenses are correct."]
+    
+    logging.info("audited licenses of {0} o365 users, {1} were not " \
+                "correct, {2} repaired".format(len(lines), wrong, repaired))
+    console("SUCCESS: audited licenses of {0} o365 users, {1} were not " \
+                "correct, {2} repaired".format(len(lines), wrong, repaired))
+    countStat("licenses audited", len(lines))
+    countStat("licenses repaired", repaired)
+    
+    result = "SUCCESS: audited {0} users, {1} not correct, {2} repaired." \
+                .format(len(lines), wrong, repaired)
+    if wrong > repaired and repair:
+        result = "ERROR: audited {0} users, {1} not correct, only {2} " \
+                    "repaired.".format(len(lines), wrong, repaired)
+    
+    return RowLines(lines, result)
+
+
+def licenseChanges(user):
+    """Get the license to add and the ones to remove so a user has just 
+    the license of its type with the DISABLEDPLANS, licenses other than 
+    STULICENSE and EMPLICENSE are left alone"""
+    
+    username = user["userPrincipalName"].split("@")[0]
+    if getUserType(username) == "STU":
+        expected, other = STULICENSE, EMPLICENSE
+    else:
+        expected, other = EMPLICENSE, STULICENSE
+    
+    plans = sorted(plan for plan in DISABLEDPLANS if plan)
+    held = dict((item.get("skuId"), sorted(plan for plan 
+                    in item.get("disabledPlans") or [] if plan)) 
+                for item in user.get("assignedLicenses") or [])
+    
+    add = None
+    if held.get(expected) != plans:
+        add = {"disabledPlans": DISABLEDPLANS, "skuId": expected}
+    
+    remove = []
+    if other in held and other != expected:
+        remove.append(other)
+    
+    return add, remove
+
+
+def repairLicenses(fixes):
+    """Send the license changes of a group of users in one $batch 
+    request and fill in their lines, returns the ones to try again"""
+    
+    pending = []
+    requests = []
+    for fix in fixes:
+        line, user, add, remove, attempt = fix
+        upn = user["userPrincipalName"]
+        # A new license needs a free seat, once
+        if not attempt and add is not None and SEATS is not None and \
+                not any(item.get("skuId") == add["skuId"] 
+                        for item in user.get("assignedLicenses") or []) \
+                and not SEATS.reserve(upn, add["skuId"]):
+            line[1] = "ERROR: no free seats of license {0} in o365." \
+                        .format(SEATS.name(add["skuId"]))
+            continue
+        if attempt:
+            METRICS.retried("assignLicense")
+        pending.append(fix)
+        requests.append(licenseRequest(user["objectId"], 
+                        licenseBody([add["skuId"]] if add else [], remove)))
+    
+    if not pending:
+        return []
+    
+    postRequests(requests, "assignLicense")
+    
+    retry = []
+    for fix, request in zip(pending, requests):
+        line, user, add, remove, attempt = fix
+        response = request["response"]
+        status = response[0].status if response is not None else 0
+        
+        if status == 200:
+            logging.info("repaired licenses of {0}" \
+                            .format(user["userPrincipalName"]))
+            line[1] = "SUCCESS: licenses repaired."
+            recordLicenses(user["userPrincipalName"], 
+                            [add["skuId"]] if add else [], remove)
+            if SEATS is not None:
+                SEATS.giveBack(remove)
+        elif (status in RETRYSTATUS or status == 0) \
+                and attempt < MAXRETRIES:
+            fix[4] += 1
+            retry.append(fix)
+        else:
+            logging.error("could not repair licenses of {0}: {1}" \
+                            .format(user["userPrincipalName"], status))
+            line[1] = "ERROR: could not repair licenses."
+            if SEATS is not None:
+                SEATS.release(user["userPrincipalName"])
+    
+    return retry
+
+
+class RowLines(object):
+    """Result of a row that writes a line for each user it went 
+    through before its own line, e.g. audit-licenses"""
+
+    def __init__(self, lines, result):
+        # Lines of [userPrincipalName, result]
+        self.lines = lines
+        self.result = result
+
+
+def queueLicense(username, upn, userId, licenses, 
+                done="SUCCESS: user was created in o365.", remove=None):
+    """Queue the licenses of a new user, starting the queue if needed"""
+    
+    global LICENSES
+    
+    with LICENSES_LOCK:
+        if LICENSES is None:
+            LICENSES = LicenseQueue(LICENSEDELAY, LICENSERETRIES)
+    
+    return LICENSES.add(username, upn, userId, licenses, done, remove)
+
+
+class SeatPool(object):
+    """Free seats of the subscribed licenses.
+    
+    The seats are read once from subscribedSkus and then counted here 
+    as users are created and deleted, so a create that would go over 
+    the capacity fails fast instead of failing assignLicense over and 
+    over. A license the tenant does not subscribe has no seats."""
+
+    def __init__(self, skus):
+        self.lock = threading.Lock()
+        self.free = {}
+        self.names = {}
+        # Seats each user took in this run
+        self.holders = {}
+        # Creates refused for lack of seats
+        self.short = collections.Counter()
+        
+        for sku in skus:
+            units = sku.get("prepaidUnits") or {}
+            self.free[sku["skuId"]] = int(units.get("enabled", 0)) \
+                                        - int(sku.get("consumedUnits", 0))
+            self.names[sku["skuId"]] = sku.get("skuPartNumber") \
+                                        or sku["skuId"]
+
+    def name(self, skuId):
+        """Get the readable name of a license"""
+        
+        return self.names.get(skuId, skuId)
+
+    def reserve(self, upn, skuId):
+        """Take a seat for a new user, returns False if none is left"""
+        
+        with self.lock:
+            if self.free.get(skuId, 0) <= 0:
+                self.short[skuId] += 1
+                return False
+            self.free[skuId] -= 1
+            self.holders[upn.lower()] = skuId
+        
+        return True
+
+    def release(self, upn, skuIds=None):
+        """Give back the seat a user took in this run, or else the 
+        seats of the licenses skuIds it had"""
+        
+        with self.lock:
+            held = self.holders.pop(upn.lower(), None)
+        if held:
+            skuIds = [held]
+        self.giveBack(skuIds)
+
+    def giveBack(self, skuIds):
+        """Count the seats of licenses that were taken away as free"""
+        
+        with self.lock:
+            for skuId in skuIds or []:
+                if skuId in self.free:
+                    self.free[skuId] += 1
+
+
+def loadSeats():
+    """Read the seats of the subscribed licenses once"""
+    
+    global SEATS
+    
+    try:
+        response, data = graphRequest("GET", graphUrl("/subscribedSkus", 
+                                    {'$select': 'skuId,skuPartNumber,' \
+                                    'consumedUnits,prepaidUnits'}), "", 
+                                    JSON_HEADERS, "subscribedSkus")
+        if response.status != 200:
+            raise GraphError("o365 returned {0} for the subscribed " \
+                            "licenses".format(response.status))
+        SEATS = SeatPool(json.loads(data)['value'])
+    except Exception as e:
+        # Without the counts, assignLicense finds out on its own
+        console("ERROR: could not get the free license seats: {0}" \
+                .format(e))
+        logging.error("could not get the free license seats: {0}" \
+                .format(e))
+        return False
+    
+    for skuId in (STULICENSE, EMPLICENSE):
+        logging.info("license {0} has {1} free seats".format(
+                        SEATS.name(skuId), SEATS.free.get(skuId, 0)))
+    
+    return True
+
+
+def seatStats():
+    """Log and print the free seats left and how many are short"""
+    
+    if SEATS is None:
+        return
+    
+    for skuId in sorted(set([STULICENSE, EMPLICENSE])):
+        logging.info("license {0}: {1} free seats left".format(
+                        SEATS.name(skuId), SEATS.free.get(skuId, 0)))
+        console("INFO: license {0}: {1} free seats left".format(
+                        SEATS.name(skuId), SEATS.free.get(skuId, 0)))
+    
+    for skuId, count in sorted(SEATS.short.items()):
+        logging.error("license {0} is short of {1} seats".format(
+                        SEATS.name(skuId), count))
+        console("ERROR: license {0} is short of {1} seats, {1} users " \
+                "were not created".format(SEATS.name(skuId), count), True)
+    
+    return
+
+
+def drainLicenses():
+    """Wait for the queued license assignments to finish"""
+    
+    global LICENSES
+    
+    with LICENSES_LOCK:
+        queue = LICENSES
+        LICENSES = None
+    
+    if queue is not None:
+        queue.drain()
+    
+    return
+
+
+def changeGroups(username, groups, remove=False):
+    """This function adds a user to groups, or removes it from them, 
+    the changes are queued so many users share each $batch request"""
+    
+    # Check if any of the arguments are missing
+    if str(username) == "" or not groups:
+        field = "username" if str(username) == "" else "groups"
+        console("ERROR: unable to change groups of user {0} because {1} " \
+                "is missing a value".format(username, field))
+        logging.error("unable to change groups of user {0} because {1} " \
+                        "is missing a value".format(username, field))
+        result = "ERROR: Missing an expected input value for " + field \
+                    + " in input file."
+        return result
+    
+    # Get the Graph API access_token and
+    # Catch any MSFT login failures
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            result = "ERROR: unable to authenticate to MSFT login service."
+            return result
+    
+    upn = username + "@" + O365DOMAIN
+    user = getUser(upn)
+    
+    if user is None:
+        console("ERROR: user does not exist in o365: {0}".format(username))
+        logging.error("user does not exist in o365: {0}".format(username))
+        result = "ERROR: user could not be found in o365!"
+        return result
+    
+    if not user.get('objectId'):
+        console("ERROR: unable to look up user {0} in o365" \
+                .format(username))
+        logging.error("unable to look up user {0} in o365" \
+                        .format(username))
+        result = "ERROR: could not look up user in o365."
+        return result
+    
+    # All groups have to exist before any change is queued
+    found = []
+    for group in groups:
+        try:
+            groupId = findGroup(group)
+        except GraphError as e:
+            logging.error("unable to look up group {0} in o365: {1}" \
+                            .format(group, e))
+            console("ERROR: unable to look up group {0} in o365" \
+                    .format(group))
+            result = "ERROR: could not look up group {0} in o365." \
+                        .format(group)
+            return result
+        
+        if groupId is None:
+            logging.error("group does not exist in o365: {0}".format(group))
+            console("ERROR: group does not exist in o365: {0}".format(group))
+            result = "ERROR: group {0} could not be found in o365!" \
+                        .format(group)
+            return result
+        found.append((group, groupId))
+    
+    return queueMembers(username, upn, user['objectId'], found, remove)
+
+
+def rowGroups(row):
+    """Get the group names of a row, from "groups" (separated by ;) or 
+    "group", or else the department in "primO" """
+    
+    value = row.get("groups") or row.get("group") or row.get("primO") or ""
+    if isinstance(value, type([])):
+        names = [str(name).strip() for name in value]
+    else:
+        names = [name.strip() for name in str(value).split(";")]
+    
+    groups = []
+    for name in names:
+        if name and name not in groups:
+            groups.append(name)
+    
+    return groups
+
+
+def findGroup(name):
+    """Get the objectId of a group by its displayName, 
+    or None if there is no such group"""
+    
+    with GROUPS_LOCK:
+        if name in GROUPS:
+            return GROUPS[name]
+    
+    response, data = graphRequest("GET", graphUrl("/groups", {
+                        '$filter': "displayName eq '{0}'" \
+                                    .format(name.replace("'", "''")),
+                        '$select': 'objectId'
+                    }), "", JSON_HEADERS, "findGroup")
+    if response.status != 200:
+        raise GraphError("o365 returned {0}".format(response.status))
+    
+    groups = json.loads(data)['value']
+    if len(groups) > 1:
+        logging.warning("{0} groups are named {1} in o365, using the " \
+                        "first one".format(len(groups), name))
+    
+    groupId = groups[0]['objectId'] if groups else None
+    with GROUPS_LOCK:
+        GROUPS[name] = groupId
+    
+    return groupId
+
+
+class MemberQueue(object):
+    """Deferred group membership changes.
+    
+    AAD Graph adds or removes one member per $links call, so the changes
+    of all rows are queued and a background thread sends them sorted by 
+    group, BATCHSIZE to a $batch request, once there are enough to fill 
+    one or they waited GROUPDELAY seconds, trying failed ones again."""
+
+    def __init__(self, delay, retries):
+        self.delay = delay
+        self.retries = retries
+        self.items = []
+        # Order of the changes, so two changes of one member of a group
+        # never pass each other
+        self.order = itertools.count()
+        self.stopping = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, username, upn, userId, groups, remove):
+        """Queue the changes of one row and return its pending result"""
+        
+        # The row is done once all of its groups are
+        row = {
+            "username": username,
+            "remove": remove,
+            "left": len(groups),
+            "failed": [],
+            "pending": PendingResult("ERROR: could not change groups " \
+                                    "in o365.")
+        }
+        
+        with self.cond:
+            for group, groupId in groups:
+                self.items.append({
+                    "username": username,
+                    "upn": upn,
+                    "userId": userId,
+                    "group": group,
+                    "groupId": groupId,
+                    "remove": remove,
+                    "due": time.time() + self.delay,
+                    "attempt": 0,
+                    "order": next(self.order),
+                    "row": row
+                })
+            self.cond.notify()
+        
+        return row["pending"]
+
+    def cancel(self, upn):
+        """Drop the changes of a user that is deleted before they ran"""
+        
+        with self.cond:
+            for item in [item for item in self.items if item["upn"] == upn]:
+                self.items.remove(item)
+                self.finish(item, False)
+
+    def run(self):
+        """Background thread that sends the changes that are ready"""
+        
+        while True:
+            with self.cond:
+                while True:
+                    if not self.items and self.stopping:
+                        return
+                    now = time.time()
+                    # No need to wait for a $batch that is full
+                    full = self.stopping or len([item for item in self.items
+                                        if not item["attempt"]]) >= BATCHSIZE
+                    ready = []
+                    waiting = set()
+                    for item in sorted(self.items, 
+                                        key=lambda item: item["order"]):
+                        member = (item["groupId"], item["userId"])
+                        if member not in waiting and (item["due"] <= now 
+                                    or (full and not item["attempt"])):
+                            ready.append(item)
+                        waiting.add(member)
+                    if ready:
+                        break
+                    # Changes held back by an earlier one wait for it
+                    later = [item["due"] for item in self.items 
+                                if item["due"] > now]
+                    wait = min(later) - now if later else None
+                    self.cond.wait(wait)
+                
+                for item in ready:
+                    self.items.remove(item)
+            
+            # Changes of one group go together
+            ready.sort(key=lambda item: item["groupId"])
+            for start in range(0, len(ready), BATCHSIZE):
+                try:
+                    self.send(ready[start:start + BATCHSIZE])
+                except Exception as e:
+                    logging.error("o365 group change failed: {0}" \
+                                    .format(e))
+                    for item in ready[start:start + BATCHSIZE]:
+                        self.retry(item)
+
+    def send(self, items):
+        """Send the $links calls of a group of changes"""
+        
+        requests = [memberRequest(item) for item in items]
+        postRequests(requests, "member")
+        
+        for item, request in zip(items, requests):
+            response = request["response"]
+            status = response[0].status if response is not None else 0
+            if item["attempt"]:
+                METRICS.retried("member")
+            
+            if status == 204:
+                self.finish(item, True)
+            elif item["remove"] and status == 404:
+                # Not a member anyway
+                self.finish(item, True)
+            elif not item["remove"] and status == 400 \
+                    and "already exist" in response[1]:
+                # Already a member
+                self.finish(item, True)
+            elif status in RETRYSTATUS or status == 0 \
+                    or (not item["remove"] and status == 404):
+                # A new user may not show up for $links right away
+                self.retry(item)
+            else:
+                logging.error("o365 refused group change of {0} in {1}: " \
+                                "{2}".format(item["username"], item["group"], 
+                                            response[1]))
+                self.finish(item, False)
+
+    def retry(self, item):
+        """Try a failed change again later or give up"""
+        
+        item["attempt"] += 1
+        
+        if item["attempt"] > self.retries:
+            self.finish(item, False)
+            return
+        
+        delay = backoffDelay(item["attempt"])
+        logging.warning("group change of {0} in {1} did not go through " \
+                "yet - re-try {2} in {3:.1f}s".format(item["username"], 
+                                item["group"], item["attempt"], delay))
+        
+        with self.cond:
+            item["due"] = time.time() + delay
+            self.items.append(item)
+            self.cond.notify()
+
+    def finish(self, item, changed):
+        """Count a change as done and fill in the result of its row 
+        once all changes of the row are done"""
+        
+        row = item["row"]
+        if item["remove"]:
+            countStat("group members removed" if changed 
+                        else "group members not removed")
+        else:
+            countStat("group members added" if changed 
+                        else "group members not added")
+        
+        with self.cond:
+            if not changed:
+                row["failed"].append(item["group"])
+            row["left"] -= 1
+            if row["left"]:
+                return
+        
+        verb = "removed from" if row["remove"] else "added to"
+        if not row["failed"]:
+            logging.info("user {0} groups in o365: {1}" \
+                            .format(verb, row["username"]))
+            console("SUCCESS: User {0} {1} groups in o365" \
+                    .format(row["username"], verb))
+            row["pending"].finish("SUCCESS: user was {0} groups in o365." \
+                                    .format(verb))
+        else:
+            groups = ", ".join(row["failed"])
+            logging.error("user was not {0} groups in o365: {1} ({2})" \
+                            .format(verb, row["username"], groups))
+            console("ERROR: User {0} was not {1} groups in o365: {2}" \
+                    .format(row["username"], verb, groups))
+            row["pending"].finish("ERROR: user was not {0} groups in " \
+                                    "o365: {1}.".format(verb, groups))
+
+    def drain(self):
+        """Wait until every queued change is done"""
+        
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join()
+
+
+def memberRequest(item):
+    """Build the $links request of a queued group change"""
+    
+    path = "/groups/" + item["groupId"] + "/$links/members"
+    
+    if item["remove"]:
+        return {
+            "method": "DELETE",
+            "url": graphUrl(path + "/" + item["userId"]),
+            "body": "",
+            "headers": authHeaders(),
+            "response": None
+        }
+    
+    return {
+        "method": "POST",
+        "url": graphUrl(path),
+        "body": json.dumps({
+            "url": "https://" + GRAPH_HOST + "/" + O365DOMAIN 
+                    + "/directoryObjects/" + item["userId"]
+        }),
+        "headers": authHeaders(),
+        "response": None
+    }
+
+
+def queueMembers(username, upn, userId, groups, remove):
+    """Queue the group changes of a row, starting the queue if needed"""
+    
+    global MEMBERS
+    
+    with MEMBERS_LOCK:
+        if MEMBERS is None:
+            MEMBERS = MemberQueue(GROUPDELAY, MAXRETRIES)
+    
+    return MEMBERS.add(username, upn, userId, groups, remove)
+
+
+def drainMembers():
+    """Wait for the queued group changes to finish"""
+    
+    global MEMBERS
+    
+    with MEMBERS_LOCK:
+        queue = MEMBERS
+        MEMBERS = None
+    
+    if queue is not None:
+        queue.drain()
+    
+    return
+
+
+def restore(username, deleted, givenName, fullName, sn, ou, userPassword, 
+            licenses):
+    """This function restores a deleted user from the O365 RecycleBin 
+    and gives it the name and attributes of the create row"""
+    
+    upn = username + "@" + O365DOMAIN
+    
+    try:
+        response, data = graphRequest("POST", graphUrl(
+                                    "/deletedDirectoryObjects/" 
+                                    + deleted["objectId"] + "/restore"), 
+                                    "", JSON_HEADERS, "restore")
+        
+        if response.status not in (200, 204):
+            if SEATS is not None:
+                SEATS.release(upn)
+            logging.error("user could not be restored in o365: {0} ({1})" \
+                            .format(username, response.status))
+            console("ERROR: User {0} could not be restored in o365" \
+                    .format(username))
+            result = "ERROR: user could not be restored in o365."
+            return result
+        RECYCLED.remove(deleted["immutableId"])
+        
+        # The user comes back as it was, so give it the new values
+        body = {
+            "userPrincipalName": upn,
+            "accountEnabled": "true",
+            "givenName": givenName,
+            "displayName": fullName,
+            "surname": sn,
+            "mailNickname": username,
+            "department": ou,
+            "passwordProfile": {"password": userPassword, 
+                                "forceChangePasswordNextLogin": "false"}
+        }
+        
+        response, _ = graphRequest("PATCH", graphUrl("/users/" 
+                                    + deleted["objectId"]), 
+                                    json.dumps(body), JSON_HEADERS, "patch")
+        
+        if response.status != 204:
+            if SEATS is not None:
+                SEATS.release(upn)
+            logging.error("user was restored but not updated in o365: " \
+                            "{0} as {1}".format(username, 
+                                            deleted["userPrincipalName"]))
+            console("ERROR: User {0} was restored but not updated in o365" \
+                    .format(username))
+            result = "ERROR: user restored in o365 as {0} but not " \
+                        "updated.".format(deleted["userPrincipalName"])
+            return result
+        
+    except Exception as e:
+        if SEATS is not None:
+            SEATS.release(upn)
+        console("ERROR: Could not restore user in o365: {0}".format(e))
+        logging.error("o365 restore failed for: {0}: {1}".format(username,e))
+        result = "ERROR: Could not restore o365 user."
+        return result
+    
+    logging.info("user restored in o365: {0}".format(username))
+    countStat("users restored")
+    
+    user = dict(body, objectId=deleted["objectId"], 
+                immutableId=deleted["immutableId"], 
+                assignedLicenses=deleted.get("assignedLicenses") or [])
+    if DIRECTORY is not None:
+        DIRECTORY.add(upn, user)
+    
+    # It keeps its old licenses, it only needs another one 
+    # if its type changed
+    held = [item.get("skuId") for item 
+            in deleted.get("assignedLicenses") or []]
+    if licenses[0]["skuId"] not in held:
+        remove = [skuId for skuId in (STULICENSE, EMPLICENSE) 
+                    if skuId in held]
+        return queueLicense(username, upn, deleted["objectId"], licenses, 
+                            "SUCCESS: user was restored in o365.", remove)
+    
+    console("SUCCESS: User {0} restored in o365".format(username))
+    result = "SUCCESS: user was restored in o365."
+    
+    return result
+
+
+class RecycleBin(object):
+    """Deleted users in the O365 RecycleBin by immutableId.
+    
+    They are listed once, the first time a create or purge needs them,
+    and kept current as users are deleted, restored and purged."""
+
+    def __init__(self):
+        self.users = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """List the deleted users in pages of projected reads"""
+        
+        params = graphParams({
+            '$select': 'objectId,objectType,userPrincipalName,' \
+                        'immutableId,assignedLicenses',
+            '$top': '999'
+        })
+        
+        users = {}
+        for page in getUserPages(params, JSON_HEADERS, 
+                                    "deletedDirectoryObjects"):
+            for user in page:
+                if user.get("objectType", "User") == "User" \
+                        and user.get("immutableId"):
+                    users[user["immutableId"]] = user
+        
+        logging.info("listed {0} deleted users in o365".format(len(users)))
+        
+        return users
+
+    def find(self, immutableId):
+        """Get the deleted user with an immutableId or None"""
+        
+        with self.lock:
+            # One listing for all workers
+            if self.users is None:
+                self.users = self.load()
+            return self.users.get(immutableId)
+
+    def list(self):
+        """Get all deleted users"""
+        
+        with self.lock:
+            if self.users is None:
+                self.users = self.load()
+            return self.users.values()
+
+    def add(self, user):
+        """Keep a user deleted in this run"""
+        
+        with self.lock:
+            if self.users is not None and user.get("immutableId"):
+                self.users[user["immutableId"]] = user
+
+    def remove(self, immutableId):
+        """Forget a user that was restored or purged"""
+        
+        with self.lock:
+            if self.users is not None:
+                self.users.pop(immutableId, None)
+
+    def clear(self):
+        """Forget all deleted users, so they are listed again"""
+        
+        with self.lock:
+            self.users = None
+
+
+RECYCLED = RecycleBin()
+
+
+def purge():
+    """This function permanently deletes all deleted users of O365DOMAIN 
+    from the O365 RecycleBin, BATCHSIZE to a $batch request"""
+    
+    # Get the Graph API access_token and
+    # Catch any MSFT login failures
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            result = "ERROR: unable to authenticate to MSFT login service."
+            return result
+    
+    try:
+        users = RECYCLED.list()
+    except GraphError as e:
+        logging.error("did not get the deleted users in o365: {0}" \
+                        .format(e))
+        console("ERROR: did not get the deleted users in o365")
+        result = "ERROR: could not list deleted users in o365."
+        return result
+    
+    domain = "@" + O365DOMAIN.lower()
+    lines = []
+    pending = []
+    for user in sorted(users, key=lambda user: user["userPrincipalName"][32:]):
+        # Deleted users get their objectId in front of their UPN
+        if not user["userPrincipalName"].lower().endswith(domain):
+            continue
+        lines.append([user["userPrincipalName"][32:], ""])
+        pending.append([lines[-1], user, 0])
+    
+    while pending:
+        group = pending[:BATCHSIZE]
+        pending = pending[BATCHSIZE:]
+        requests = [purgeRequest(user["objectId"]) 
+                    for line, user, attempt in group]
+        postRequests(requests, "purge")
+        
+        retry = []
+        for fix, request in zip(group, requests):
+            line, user, attempt = fix
+            response = request["response"]
+            status = response[0].status if response is not None else 0
+            if attempt:
+                METRICS.retried("purge")
+            
+            if status in (204, 404):
+                # Gone either way
+                logging.info("user purged from o365: {0}" \
+                                .format(user["userPrincipalName"]))
+                line[1] = "SUCCESS: user purged from o365."
+                RECYCLED.remove(user["immutableId"])
+            elif (status in RETRYSTATUS or status == 0) \
+                    and attempt < MAXRETRIES:
+                fix[2] += 1
+                retry.append(fix)
+            else:
+                logging.error("user could not be purged from o365: {0} " \
+                                "({1})".format(user["userPrincipalName"], 
+                                                status))
+                line[1] = "ERROR: could not purge user from o365."
+        
+        # Throttled ones go again with the next group
+        if retry and not pending:
+            LIMITER.backoff(max(fix[2] for fix in retry))
+        pending = retry + pending
+    
+    purged = sum(1 for item in lines if item[1].startswith("SUCCESS"))
+    logging.info("purged {0} of {1} deleted users from o365" \
+                    .format(purged, len(lines)))
+    console("SUCCESS: purged {0} of {1} deleted users from o365" \
+            .format(purged, len(lines)))
+    countStat("users purged", purged)
+    
+    result = "SUCCESS: purged {0} deleted users.".format(purged)
+    if purged < len(lines):
+        result = "ERROR: purged only {0} of {1} deleted users." \
+                    .format(purged, len(lines))
+    
+    return RowLines(lines, result)
+
+
+def purgeRequest(objectId):
+    """Build the request that purges a deleted user for postRequests"""
+    
+    return {
+        "method": "DELETE",
+        "url": graphUrl("/deletedDirectoryObjects/" + objectId),
+        "body": "",
+        "headers": authHeaders(),
+        "response": None
+    }
+
+
+def update(username, newusername, loginDisabled, givenName, fullName, sn, ou):
+    """This function updates user attributes, 
+    blocks and renames users if needed"""
+    
+    # Note: we can't change UDCid - it is an ImmutableId in O365!
+
+    # Check if any of the arguments are missing
+    params = locals()
+    
+    for _item in params:
+        if str(params[_item]) == "":
+            console("ERROR: unable to update user {0} because {1} is missing " \
+                    "a value".format(username, _item))
+            logging.error("unable to update user {0} because {1} is missing " \
+                            "a value".format(username, _item))
+            result = "ERROR: Missing an expected input value for " \
+                        + _item + " in input file."
+            return result
+
+    # Get the Graph API access_token and
+    # Catch any MSFT login failures
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            result = "ERROR: unable to authenticate to MSFT login service."
+            return result
+    
+    # Check if the user already exists and get its 
+    # current attributes in the same call
+    upn = username + "@" + O365DOMAIN
+    user = getUser(upn)
+    
+    if user is None:
+        console("ERROR: user does not exist in o365: {0}".format(username))
+        logging.error("user does not exist in o365: {0}".format(username))
+        result = "ERROR: user could not be found in o365!"
+        return result
+    
+    if user == {}:
+        # Graph API kept failing, so we do not know what to change
+        result = "ERROR: could not look up user in o365."
+        return result
+    
+    # rename if new username is diferent
+    # and does not already exist
+    if username != newusername:
+        newupn = newusername + "@" + O365DOMAIN
+        
+        # Check if the new user name already exists
+        taken = getUser(newupn, "objectId")
+        
+        if taken == {}:
+            result = "ERROR: could not check if the new username is " \
+                        "taken in o365."
+            return result
+        
+        if taken is not None:
+            console("ERROR: cannot rename user - user already exists: {0}" \
+                    .format(newusername))
+            logging.error("cannot rename user - user already exists: {0}" \
+                            .format(newusername))
+            result = "ERROR: username already taken!"
+            return result
+    else:
+        newupn = upn
+        
+    # Rename, update attributes or disable
+    try:
+        # Flip the loginDisabled value
+        if loginDisabled == "True":
+            accountEnabled = "False"
+        else:
+            accountEnabled = "True"
         
         body = {
             "userPrincipalName": newupn,
@@ -395,312 +3329,2257 @@ def update(username, newusername, loginDisabled, givenName, fullName, sn, ou):
             "mailNickname": newusername,
             "department": ou
         }
- 
-        data = json.dumps(body)
         
-        conn = httplib.HTTPSConnection('graph.windows.net')
-        conn.request("PATCH", "/" + O365DOMAIN + "/users/" + upn + "?" 
-                        + params, data, headers)
-        response = conn.getresponse()
+        # Only send the attributes that changed
+        changes = diffUser(user, body)
+        
+        if not changes:
+            logging.info("user not changed in o365: {0}".format(username))
+            countStat("updates skipped")
+            result = "SUCCESS: no change."
+            return result
+        
+        if len(changes) < len(body):
+            countStat("updates partial")
+        body = changes
+ 
+        data = json.dumps(body)
+        
+        response, _ = graphRequest("PATCH", graphUrl("/users/" + upn), data, 
+                                    JSON_HEADERS, "patch")
+        
+        if response.status != 204:
+            logging.error("user was not updated in o365: {0}" \
+                    .format(username))
+            console("ERROR: User {0} was not updated in o365" \
+                    .format(username))
+            result = "ERROR: could not update user in o365."
+        else:
+            logging.info("user updated o365: {0}".format(username))
+            if DIRECTORY is not None:
+                DIRECTORY.update(upn, newupn, body)
+            console("SUCCESS: User {0} updated in o365".format(username))
+            result = "SUCCESS: user was updated in o365."
+        
+    except Exception as e:
+        console("ERROR: Could not update user in o365: {0}".format(e))
+        logging.error("o365 update failed for: {0}: {1}".format(username,e))
+        result = "ERROR: Could not update o365 user."
+        return result
+    
+    return result
+
+
+def delete(username):
+    """This function deletes a user from O365"""
+
+    # Check if the argument is missing
+    if str(username) == "":
+        console("ERROR: unable to delete user because username argument " \
+                "is missing a value")
+        logging.error("unable to delete user because username argument " \
+                        "is missing a value")
+        result = "ERROR: Missing an expected input value for username " \
+                    "in input file."
+        return result
+
+    # Get the Graph API access_token and
+    # Catch any MSFT login failures
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            result = "ERROR: unable to authenticate to MSFT login service."
+            return result
+    
+    # Do a quick check if the user exists
+    upn = username + "@" + O365DOMAIN
+    user = getUser(upn)
+
+    if user is None:
+        console("ERROR: user does not exist in o365: {0}".format(username))
+        logging.error("user does not exist in o365: {0}".format(username))
+        result = "ERROR: user could not be found in o365!"
+        return result
+        
+    # Delete the user if all is OK
+    try:
+        # Send it over a pooled connection to Graph API
+        response, _ = graphRequest("DELETE", graphUrl("/users/" + upn), "", 
+                                    JSON_HEADERS, "delete")
+
+        if response.status != 204:
+            logging.error("user was not deleted in o365: {0}" \
+                    .format(username))
+            console("ERROR: User {0} was not deleted in o365" \
+                    .format(username))
+            result = "ERROR: could not delete user in o365."
+        else:
+            logging.info("user deleted in o365: {0}".format(username))
+            if DIRECTORY is not None:
+                DIRECTORY.remove(upn)
+            # No point in licensing a user that is gone
+            if LICENSES is not None:
+                LICENSES.cancel(upn)
+            if MEMBERS is not None:
+                MEMBERS.cancel(upn)
+            # It can be restored or purged later in this run
+            RECYCLED.add(dict(user, userPrincipalName=user.get('objectId', 
+                                        '').replace('-', '') + upn))
+            # Its seats are free again
+            if SEATS is not None:
+                SEATS.release(upn, [item.get("skuId") for item 
+                                    in user.get("assignedLicenses") or []])
+            console("SUCCESS: User {0} deleted in o365".format(username))
+            result = "SUCCESS: user deleted in o365."
+
+    except Exception as e:
+        console("ERROR: unknown error while deleting user: {0}".format(e))
+        logging.error("unknown error while deleting user {0}: {1}" \
+                        .format(username,e))
+        result = "ERROR: Could not delete o365 user."
+    
+    return result
+
+
+def list(select="", userFilter="", outfile=""):
+    """This function lists all users in O365, or just the selected 
+    fields of the filtered users streamed into a CSV or JSONL file"""
+
+    # Get the Graph API access_token and
+    # Catch any MSFT login failures
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            result = "ERROR: unable to authenticate to MSFT login service."
+            return result
+    
+    # Get the list of all users in O365 sorted by username
+    try:
+        # Optional filters, like 'accountEnabled eq false', and 
+        # projections, like 'userPrincipalName,department', 
+        # are done by Graph API, with no fields just the names
+        fields = [field.strip() for field in select.split(',') 
+                    if field.strip()]
+        query = {
+            '$select': ",".join(fields or ["userPrincipalName"]),
+            '$top': '999'
+        }
+        if userFilter:
+            query['$filter'] = userFilter.encode('utf-8')
+        
+        try:
+            # The replica already has all users, unless we need 
+            # a filter or fields it does not have, of assignedLicenses 
+            # it has only the skuIds
+            if isinstance(DIRECTORY, DirectoryReplica) and not userFilter \
+                    and set(fields) <= set(("userPrincipalName",) 
+                                            + DirUser._fields) \
+                                        - set(("assignedLicenses",)):
+                pages = DIRECTORY.getUserPages()
+            else:
+                pages = getSegmentPages(query, JSON_HEADERS)
+            
+            if outfile:
+                count = writeUserList(pages, fields or ["userPrincipalName"], 
+                                        outfile)
+            else:
+                count = 0
+                for page in pages:
+                    for userPrincipal in page:
+                        console(userPrincipal['userPrincipalName'], True)
+                    count += len(page)
+          
+            logging.info("got the list of {0} o365 users".format(count))
+            result = "SUCCESS: got the list of o365 users."
+            
+        except GraphError:
+            logging.error("did not get list of o365 users")
+            console("ERROR: did not get list of o365 users")
+            result = "ERROR: did not get list of o365 users."
+
+    except Exception as e:
+        console("ERROR: unknown error while getting the list of o365 users")
+        logging.error("unknown error while getting the list of o365 " \
+                        "users: {0}".format(e))
+        result = "ERROR: Could not get the list of o365 users."
+    
+    return result
+
+
+def writeUserList(pages, fields, outfile):
+    """Stream the selected fields of the users into a CSV file, 
+    or a JSONL file if its name does not end with .csv"""
+    
+    count = 0
+    
+    with open(outfile, 'wb') as f_list:
+        if outfile.lower().endswith('.csv'):
+            writer = csv.writer(f_list)
+            writer.writerow(fields)
+        else:
+            writer = None
+        
+        for page in pages:
+            for user in page:
+                if writer:
+                    writer.writerow([csvValue(user.get(field)) 
+                                    for field in fields])
+                else:
+                    f_list.write(json.dumps(dict((field, user.get(field)) 
+                                            for field in fields)) + "\n")
+            
+            # Report progress after each page
+            count += len(page)
+            f_list.flush()
+            logging.info("listed {0} o365 users into {1}" \
+                            .format(count, outfile))
+            console("INFO: listed {0} o365 users into {1}" \
+                            .format(count, outfile))
+    
+    return count
+
+
+def csvValue(value):
+    """Turn a Graph API value into a CSV field"""
+    
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, (dict, type([]))):
+        return json.dumps(value)
+    
+    return value
+
+
+class GraphError(Exception):
+    """Graph API returned an unexpected status"""
+    pass
+
+
+def getSegmentPages(query, headers):
+    """Page through the users in O365 like getUserPages, or with 
+    LISTWORKERS above 1 split them by the first characters of 
+    userPrincipalName into SEGMENTS that are paged LISTWORKERS at a 
+    time, and yield their users in UPN order without duplicates"""
+    
+    segments = sorted(set(SEGMENTS))
+    
+    if LISTWORKERS <= 1 or len(segments) < 2:
+        for page in getUserPages(graphParams(query), headers):
+            yield page
+        return
+    
+    # Segments are merged and de-duplicated by their names
+    fields = query.get('$select', '').split(',')
+    if query.get('$select') and 'userPrincipalName' not in fields:
+        query = dict(query, **{'$select': query['$select'] 
+                                            + ',userPrincipalName'})
+    
+    todo = Queue.Queue()
+    for index, prefix in enumerate(segments):
+        todo.put((index, prefix))
+    
+    # Segments read and not yielded yet, at most two per worker
+    # are held in memory
+    done = {}
+    cond = threading.Condition()
+    window = threading.Semaphore(LISTWORKERS * 2)
+    stopped = threading.Event()
+    
+    def reader():
+        while True:
+            # Taking the window first keeps the next segment to 
+            # yield from waiting for one
+            window.acquire()
+            if stopped.is_set():
+                return
+            try:
+                index, prefix = todo.get_nowait()
+            except Queue.Empty:
+                window.release()
+                return
+            try:
+                users = getSegment(query, headers, prefix, stopped)
+            except Exception as e:
+                users = e
+            with cond:
+                done[index] = users
+                cond.notify_all()
+    
+    threads = []
+    for _ in range(min(LISTWORKERS, len(segments))):
+        thread = threading.Thread(target=reader)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    
+    try:
+        for index in range(len(segments)):
+            with cond:
+                while index not in done:
+                    cond.wait()
+                users = done.pop(index)
+            window.release()
+            
+            if isinstance(users, Exception):
+                raise users
+            for start in range(0, len(users), 999):
+                yield users[start:start + 999]
+    finally:
+        # Also when the caller stops early, let the readers go
+        stopped.set()
+        for _ in threads:
+            window.release()
+        for thread in threads:
+            thread.join()
+    
+    return
+
+
+def getSegment(query, headers, prefix, stopped):
+    """Get the users whose userPrincipalName starts with prefix, 
+    sorted by it and without the ones a page change showed twice, 
+    or stop early once stopped is set"""
+    
+    test = "startswith(userPrincipalName,'{0}')" \
+            .format(prefix.replace("'", "''"))
+    if query.get('$filter'):
+        query = dict(query, **{'$filter': "(" + query['$filter'] + ") and " 
+                                            + test})
+    else:
+        query = dict(query, **{'$filter': test})
+    
+    users = {}
+    for page in getUserPages(graphParams(query), headers):
+        if stopped.is_set():
+            return []
+        for user in page:
+            users[user['userPrincipalName'].lower()] = user
+    
+    return [users[name] for name in sorted(users)]
+
+
+def getUserPages(params, headers, resource="users"):
+    """Page through the users in O365, or the deleted ones with 
+    resource deletedDirectoryObjects, and yield each page"""
+    
+    # Need to check if we need to get next page of results
+    skipToken = '1'
+    
+    while skipToken:
+        # All pages go over the same pooled connection
+        if skipToken == '1':
+            response, data = graphRequest("GET", "/" + O365DOMAIN 
+                                + "/" + resource + "?" + params, "", 
+                                headers, "listPage")
+        else:
+            response, data = graphRequest("GET", "/" + O365DOMAIN + "/" 
+                                + skipToken + "&" + params, "", headers, 
+                                "listPage")
+        
+        if response.status != 200:
+            raise GraphError("o365 returned {0} for a page of users" \
+                                .format(response.status))
+        
+        jsondata = json.loads(data)
+        yield jsondata['value']
+        
+        if 'odata.nextLink' not in jsondata:
+            skipToken = ''
+        else:
+            skipToken = jsondata['odata.nextLink']
+    
+    return
+
+
+# Compact record of a user in the directory index, assignedLicenses 
+# is kept as the skuIds joined by ;
+DirUser = collections.namedtuple('DirUser', ['objectId', 'immutableId', 
+                        'accountEnabled', 'givenName', 'displayName', 
+                        'surname', 'mailNickname', 'department', 
+                        'assignedLicenses'])
+
+
+class DirectoryIndex(object):
+    """In-memory index of the users in O365 keyed by lower case UPN.
+    
+    Users are kept as DirUser tuples of UTF-8 strings, which take a 
+    fraction of the memory of the JSON objects they come from."""
+
+    def __init__(self):
+        self.users = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.users)
+
+    def get(self, upn):
+        """Get the record of a user or None if the user does not exist"""
+        
+        return self.users.get(packKey(upn))
+
+    def add(self, upn, user):
+        """Add a user from its Graph API object"""
+        
+        record = DirUser(*[packValue(field, user.get(field)) 
+                            for field in DirUser._fields])
+        
+        with self.lock:
+            self.users[packKey(upn)] = record
+
+    def update(self, upn, newupn, changes):
+        """Apply changed attributes and a possible rename to a user"""
+        
+        changes = dict((field, packValue(field, changes[field])) 
+                        for field in DirUser._fields if field in changes)
+        
+        with self.lock:
+            record = self.users.pop(packKey(upn), None)
+            if record is not None:
+                self.users[packKey(newupn)] = record._replace(**changes)
+
+    def remove(self, upn):
+        """Drop a deleted user"""
+        
+        with self.lock:
+            self.users.pop(packKey(upn), None)
+
+
+def packKey(upn):
+    """Turn a UPN into its index key"""
+    
+    if isinstance(upn, unicode):
+        upn = upn.encode('utf-8')
+    
+    return upn.lower()
+
+
+def packValue(field, value):
+    """Turn a Graph API value into its compact form for the index"""
+    
+    # accountEnabled comes as a bool from Graph API 
+    # but we send it as a string
+    if field == 'accountEnabled':
+        return str(value).lower() == 'true'
+    
+    # Only the skuIds count for seats, and few sets of them repeat a lot
+    if field == 'assignedLicenses':
+        return intern(";".join(sorted(str(item.get("skuId")) 
+                                        for item in value or [])))
+    
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    
+    # Share the strings that repeat a lot, like departments
+    if isinstance(value, str) and len(value) < 32:
+        return intern(value)
+    
+    return value
+
+
+def unpackLicenses(value):
+    """Turn the skuIds of a user in the index back into assignedLicenses"""
+    
+    return [{"skuId": skuId} for skuId in (value or "").split(";") if skuId]
+
+
+def recordLicenses(upn, add, remove=()):
+    """Keep the licenses of a user in the prefetched directory current 
+    after its licenses were changed"""
+    
+    if DIRECTORY is None:
+        return
+    
+    user = DIRECTORY.get(upn)
+    if user is None:
+        return
+    
+    held = [item["skuId"] for item in unpackLicenses(user.assignedLicenses)
+            if item["skuId"] not in remove and item["skuId"] not in add]
+    DIRECTORY.update(upn, upn, {"assignedLicenses": 
+                                [{"skuId": skuId} for skuId in held + add]})
+
+
+def prefetchDirectory():
+    """Page through all users in O365 once and build the directory index
+    that is used instead of a findUser round trip for each row"""
+    
+    global DIRECTORY
+    
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            return False
+    
+    # Only the fields the index keeps
+    query = {
+        '$select': ",".join(("userPrincipalName",) + DirUser._fields),
+        '$top': '999'
+    }
+    
+    index = DirectoryIndex()
+    
+    try:
+        for page in getSegmentPages(query, JSON_HEADERS):
+            for user in page:
+                index.add(user['userPrincipalName'], user)
+    
+    except Exception as e:
+        console("ERROR: could not prefetch o365 users: {0}".format(e))
+        logging.error("could not prefetch o365 users: {0}".format(e))
+        return False
+    
+    DIRECTORY = index
+    logging.info("prefetched {0} o365 users".format(len(index)))
+    console("INFO: prefetched {0} o365 users".format(len(index)))
+    
+    return True
+
+
+class DirectoryReplica(object):
+    """Local SQLite replica of the users in O365 with the same look ups 
+    as DirectoryIndex. It is filled once and then kept current with 
+    delta queries, the deltaLink is kept in the replica between runs."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # Workers share the connection, the lock serializes them
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.changes = 0
+        
+        with self.lock:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS users (" \
+                            "upnKey TEXT PRIMARY KEY, " \
+                            "userPrincipalName TEXT, " + 
+                            ", ".join(field + " TEXT" 
+                                        for field in DirUser._fields) + ")")
+            self.db.execute("CREATE INDEX IF NOT EXISTS users_objectId " \
+                            "ON users (objectId)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS users_immutableId " \
+                            "ON users (immutableId)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS meta (" \
+                            "name TEXT PRIMARY KEY, value TEXT)")
+            # A replica of an older version lacks new fields, so it is 
+            # filled again from scratch
+            columns = [row[1] for row 
+                        in self.db.execute("PRAGMA table_info(users)")]
+            missing = [field for field in DirUser._fields 
+                        if field not in columns]
+            for field in missing:
+                self.db.execute("ALTER TABLE users ADD COLUMN " + field 
+                                + " TEXT")
+            if missing:
+                logging.info("added {0} to the o365 replica, it is " \
+                                "synced again".format(", ".join(missing)))
+                self.db.execute("DELETE FROM users")
+                self.db.execute("DELETE FROM meta")
+            self.db.commit()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def getMeta(self, name):
+        """Get a value from the meta table"""
+        
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE name = ?", 
+                                    (name,)).fetchone()
+        return row[0] if row else None
+
+    def setMeta(self, name, value):
+        """Store a value in the meta table"""
+        
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", 
+                            (name, value))
+
+    def get(self, upn):
+        """Get the record of a user or None if the user does not exist"""
+        
+        with self.lock:
+            row = self.db.execute("SELECT " + ", ".join(DirUser._fields) 
+                                + " FROM users WHERE upnKey = ?", 
+                                (packKey(upn),)).fetchone()
+        if row is None:
+            return None
+        
+        return DirUser(*[unpackValue(field, value) 
+                        for field, value in zip(DirUser._fields, row)])
+
+    def getUpnByImmutableId(self, immutableId):
+        """Get the UPN of the user with an immutableId"""
+        
+        with self.lock:
+            row = self.db.execute("SELECT userPrincipalName FROM users " \
+                                "WHERE immutableId = ?", 
+                                (immutableId,)).fetchone()
+        return row[0] if row else None
+
+    def getUserPages(self, size=999):
+        """Yield the users sorted by UPN in pages like getUserPages()"""
+        
+        fields = ("userPrincipalName",) + DirUser._fields
+        last = ''
+        
+        while True:
+            with self.lock:
+                rows = self.db.execute("SELECT upnKey, " + ", ".join(fields) 
+                                    + " FROM users WHERE upnKey > ? " \
+                                    "ORDER BY upnKey LIMIT ?", 
+                                    (last, size)).fetchall()
+            if not rows:
+                break
+            
+            last = rows[-1][0]
+            yield [dict((field, unpackValue(field, value)) 
+                        for field, value in zip(fields, row[1:])) 
+                    for row in rows]
+        
+        return
+
+    def add(self, upn, user):
+        """Add a user from its Graph API object"""
+        
+        values = [packKey(upn), packValue('userPrincipalName', upn)] 
+        values += [packValue(field, user.get(field)) 
+                    for field in DirUser._fields]
+        
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO users VALUES (" 
+                            + ", ".join(["?"] * len(values)) + ")", values)
+            self.commitLater()
+
+    def update(self, upn, newupn, changes):
+        """Apply changed attributes and a possible rename to a user"""
+        
+        fields = [field for field in DirUser._fields if field in changes]
+        values = [packKey(newupn), packValue('userPrincipalName', newupn)]
+        values += [packValue(field, changes[field]) for field in fields]
+        values.append(packKey(upn))
+        
+        with self.lock:
+            # A user that had the new name before is gone from O365, 
+            # e.g. renamed or deleted by another tool, so it makes room
+            if packKey(newupn) != packKey(upn):
+                self.db.execute("DELETE FROM users WHERE upnKey = ?", 
+                                (packKey(newupn),))
+            self.db.execute("UPDATE users SET upnKey = ?, " \
+                            "userPrincipalName = ?" 
+                            + "".join(", " + field + " = ?" for field in fields)
+                            + " WHERE upnKey = ?", values)
+            self.commitLater()
+
+    def remove(self, upn):
+        """Drop a deleted user"""
+        
+        with self.lock:
+            self.db.execute("DELETE FROM users WHERE upnKey = ?", 
+                            (packKey(upn),))
+            self.commitLater()
+
+    def applyDelta(self, user):
+        """Apply one changed or deleted user from a delta query"""
+        
+        with self.lock:
+            if user.get('aad.isDeleted'):
+                self.db.execute("DELETE FROM users WHERE objectId = ?", 
+                                (user.get('objectId'),))
+                return
+        
+            row = self.db.execute("SELECT userPrincipalName FROM users " \
+                                "WHERE objectId = ?", 
+                                (user.get('objectId'),)).fetchone()
+        
+        if row is None:
+            self.add(user['userPrincipalName'], user)
+        else:
+            # Delta queries may return only the changed attributes
+            self.update(row[0], user.get('userPrincipalName', row[0]), user)
+
+    def clear(self):
+        """Drop all users and the deltaLink before a full resync"""
+        
+        with self.lock:
+            self.db.execute("DELETE FROM users")
+            self.db.execute("DELETE FROM meta")
+            self.db.commit()
+
+    def commitLater(self):
+        """Commit local changes every now and then, the next delta query
+        brings back anything that is lost if the run dies"""
+        
+        self.changes += 1
+        if self.changes % 100 == 0:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def unpackValue(field, value):
+    """Turn a value from the replica back into its index form"""
+    
+    if field == 'accountEnabled':
+        return value == '1'
+    
+    return value
+
+
+def syncReplica(replica):
+    """Bring the replica up to date with a delta query, starting 
+    with a full load if it has no deltaLink yet"""
+    
+    if not ACCESS_TOKEN:
+        graphConnect()
+        if not ACCESS_TOKEN:
+            return False
+    
+    deltaLink = replica.getMeta('deltaLink') or ''
+    count = 0
+    
+    while True:
+        response, data = graphRequest("GET", graphUrl("/users", 
+                                        {'deltaLink': deltaLink}), "", 
+                                        JSON_HEADERS, "deltaPage")
+        if response.status != 200:
+            raise GraphError("o365 returned {0} for a delta query" \
+                                .format(response.status))
+        
+        jsondata = json.loads(data)
+        for user in jsondata['value']:
+            replica.applyDelta(user)
+            count += 1
+        
+        # Follow the next pages until Graph API gives the deltaLink 
+        # for the next sync
+        if 'aad.nextLink' in jsondata:
+            deltaLink = getDeltaToken(jsondata['aad.nextLink'])
+        else:
+            deltaLink = getDeltaToken(jsondata['aad.deltaLink'])
+            break
+    
+    replica.setMeta('deltaLink', deltaLink)
+    replica.setMeta('synced', str(time.time()))
+    replica.db.commit()
+    logging.info("applied {0} changes to the o365 replica".format(count))
+    
+    return True
+
+
+def getDeltaToken(link):
+    """Get the deltaLink token out of an aad.nextLink/aad.deltaLink URL"""
+    
+    query = urlparse.parse_qs(urlparse.urlparse(link).query)
+    
+    return query.get('deltaLink', [''])[0]
+
+
+def openReplica(resync=False):
+    """Open the local replica, sync it if it is older than 
+    REPLICAMAXAGE and use it for all user look ups"""
+    
+    global DIRECTORY
+    
+    try:
+        replica = DirectoryReplica(REPLICAFILE)
+        
+        if resync:
+            logging.info("full resync of the o365 replica")
+            replica.clear()
+        
+        synced = float(replica.getMeta('synced') or 0)
+        if time.time() - synced > REPLICAMAXAGE:
+            try:
+                syncReplica(replica)
+            except GraphError as e:
+                # The deltaLink may have expired, so start over
+                logging.warning("delta query failed, doing a full resync " \
+                                "of the o365 replica: {0}".format(e))
+                replica.clear()
+                syncReplica(replica)
+        
+        if not replica.getMeta('deltaLink'):
+            raise GraphError("the o365 replica was never synced")
+    
+    except Exception as e:
+        console("ERROR: could not open the o365 replica: {0}".format(e))
+        logging.error("could not open the o365 replica: {0}".format(e))
+        return False
+    
+    DIRECTORY = replica
+    logging.info("using o365 replica with {0} users".format(len(replica)))
+    console("INFO: using o365 replica with {0} users".format(len(replica)))
+    
+    return True
+
+
+def closeReplica():
+    """Save and close the local replica"""
+    
+    global DIRECTORY
+    
+    if isinstance(DIRECTORY, DirectoryReplica):
+        DIRECTORY.close()
+        DIRECTORY = None
+    
+    return
+
+
+def readConfig(config_file, tenant=None):
+    """Function to import the config file"""
+    
+    # A settings file in another directory is imported from there
+    if os.path.isfile(config_file):
+        config_file = os.path.abspath(config_file)
+    config_dir, config_file = os.path.split(config_file)
+    if config_dir and config_dir not in sys.path:
+        sys.path.insert(0, config_dir)
+    
+    if config_file[-3:] == ".py":
+        config_file = config_file[:-3]
+    o365settings = __import__(config_file, globals(), locals(), [])
+    
+    # Read settings and set globals
+    try: 
+        # A tenant uses its own values over the shared ones
+        global TENANTS
+        TENANTS = getattr(o365settings, 'TENANTS', {})
+        
+        if tenant:
+            if tenant not in TENANTS:
+                raise ValueError("unknown tenant {0}".format(tenant))
+            o365settings = TenantSettings(o365settings, TENANTS[tenant])
+        
+        global API_VERSION
+        global CLIENT_ID
+        global CLIENT_KEY
+        global O365DOMAIN
+        global STUPATTERN
+        global STULICENSE
+        global EMPLICENSE
+        global DISABLEDPLANS
+
+        API_VERSION = o365settings.API_VERSION
+        CLIENT_ID = o365settings.CLIENT_ID
+        CLIENT_KEY = o365settings.CLIENT_KEY
+        O365DOMAIN = o365settings.O365DOMAIN
+        STUPATTERN = o365settings.STUPATTERN
+        STULICENSE = o365settings.STULICENSE
+        EMPLICENSE = o365settings.EMPLICENSE
+        DISABLEDPLANS = o365settings.DISABLEDPLANS
+        
+        # Query string every Graph API call starts with
+        global API_PARAMS
+        API_PARAMS = urllib.urlencode({'api-version': API_VERSION})
+        
+        # Optional hosts, e.g. to run against o365mock.py
+        global GRAPH_HOST
+        global LOGIN_HOST
+        global USEHTTPS
+        
+        GRAPH_HOST = getattr(o365settings, 'GRAPHHOST', GRAPH_HOST)
+        LOGIN_HOST = getattr(o365settings, 'LOGINHOST', LOGIN_HOST)
+        USEHTTPS = getattr(o365settings, 'USEHTTPS', True)
+        
+        # Optional connection pool settings
+        global POOLSIZE
+        global POOLIDLE
+        global POOLTIMEOUT
+        
+        POOLSIZE = getattr(o365settings, 'POOLSIZE', 4)
+        POOLIDLE = getattr(o365settings, 'POOLIDLE', 60)
+        POOLTIMEOUT = getattr(o365settings, 'POOLTIMEOUT', 60)
+        
+        # Upper limit for parallel workers
+        global MAXWORKERS
+        MAXWORKERS = getattr(o365settings, 'MAXWORKERS', 8)
+        
+        # Batch mode settings
+        global BATCHSIZE
+        global BATCHWAIT
+        BATCHSIZE = getattr(o365settings, 'BATCHSIZE', 5)
+        BATCHWAIT = getattr(o365settings, 'BATCHWAIT', 0.05)
+        
+        # Local replica settings
+        global REPLICAFILE
+        global REPLICAMAXAGE
+        REPLICAFILE = getattr(o365settings, 'REPLICAFILE', 'o365replica.db')
+        REPLICAMAXAGE = getattr(o365settings, 'REPLICAMAXAGE', 300)
+        
+        # Age of the loaded users and seats of a client or the daemon
+        global CLIENTREFRESH
+        CLIENTREFRESH = getattr(o365settings, 'CLIENTREFRESH', 300)
+        
+        global ACCESS_TOKEN
+        global TOKEN_EXPIRES
+        ACCESS_TOKEN = None
+        TOKEN_EXPIRES = 0
+        
+        # Token renewal and cache settings
+        global TOKENMARGIN
+        global TOKENCACHE
+        TOKENMARGIN = getattr(o365settings, 'TOKENMARGIN', 300)
+        TOKENCACHE = getattr(o365settings, 'TOKENCACHE', '')
+        
+        # Rate limiter and re-try settings
+        global MAXRETRIES
+        global BACKOFFBASE
+        global BACKOFFMAX
+        global LIMITER
+        MAXRETRIES = getattr(o365settings, 'MAXRETRIES', 5)
+        BACKOFFBASE = getattr(o365settings, 'BACKOFFBASE', 1)
+        BACKOFFMAX = getattr(o365settings, 'BACKOFFMAX', 60)
+        
+        # Deferred license assignment settings
+        global LICENSEDELAY
+        global LICENSERETRIES
+        LICENSEDELAY = getattr(o365settings, 'LICENSEDELAY', 2)
+        LICENSERETRIES = getattr(o365settings, 'LICENSERETRIES', 5)
+        
+        # Group membership settings
+        global GROUPDELAY
+        GROUPDELAY = getattr(o365settings, 'GROUPDELAY', 1)
+        
+        # Listing of all users in segments that are paged in parallel
+        global LISTWORKERS
+        global SEGMENTS
+        LISTWORKERS = getattr(o365settings, 'LISTWORKERS', 1)
+        SEGMENTS = getattr(o365settings, 'SEGMENTS', 
+                            "abcdefghijklmnopqrstuvwxyz0123456789'.-_!#^~")
+        
+        # License seat pre-check
+        global SEATCHECK
+        SEATCHECK = getattr(o365settings, 'SEATCHECK', True)
+        
+        # Restore returning users from the recycle bin
+        global RESTOREDELETED
+        RESTOREDELETED = getattr(o365settings, 'RESTOREDELETED', True)
+        LIMITER = RateLimiter(getattr(o365settings, 'RATELIMIT', 10), 
+                                getattr(o365settings, 'RATEMIN', 1), 
+                                getattr(o365settings, 'RATEMAX', 100))
+        
+        # Tenants keep their token and replica apart unless they 
+        # name their own files
+        if tenant:
+            if TOKENCACHE and 'TOKENCACHE' not in TENANTS[tenant]:
+                TOKENCACHE += '.' + tenant
+            if 'REPLICAFILE' not in TENANTS[tenant]:
+                REPLICAFILE += '.' + tenant
+
+    except Exception as e:
+        logging.error("unable to parse settings file")
+        console("ERROR: unable to parse the settings file: {0}" \
+                .format(e), True)
+        return False
+        
+    return True
+
+
+class TenantSettings(object):
+    """Settings of one tenant, its own values in TENANTS first and 
+    the shared ones of the settings file otherwise"""
+
+    def __init__(self, settings, values):
+        self.settings = settings
+        self.values = values
+
+    def __getattr__(self, name):
+        if name in self.values:
+            return self.values[name]
+        return getattr(self.settings, name)
+
+
+def getUserType(username):
+    """ Function to determine the type of a user"""
+
+    if STUPATTERN in username:
+        userType = "STU"
+    else:
+        userType = "EMP"
+
+    return userType
+
+
+def graphConnect(rejected=None):
+    """This function gets auth token for Graph API, it logs in again
+    shortly before the token expires or if Graph API rejected it"""
+
+    # Most calls find a good token and do not need the lock
+    if tokenValid(rejected):
+        return True
+    
+    # Only one worker logs in, the others wait for its token
+    with TOKEN_LOCK:
+        if tokenValid(rejected):
+            return True
+        
+        # A token saved by an earlier run saves the login round trip
+        if not ACCESS_TOKEN and loadToken():
+            return True
+        
+        getAccessToken()
+    
+    return bool(ACCESS_TOKEN)
+
+
+def tokenValid(rejected=None):
+    """Check if we have a token that is not about to expire"""
+    
+    return bool(ACCESS_TOKEN) and ACCESS_TOKEN != rejected \
+            and time.time() < TOKEN_EXPIRES - TOKENMARGIN
+
+
+def getAccessToken():
+    """Request a new auth token from the MSFT login service"""
+    
+    # Use global ACCESS_TOKEN variable
+    global ACCESS_TOKEN
+    global TOKEN_EXPIRES
+    
+    # Set the connecton parameters
+    params = urllib.urlencode({
+        'api-version': API_VERSION,
+    })
+
+    # Create the request body
+    body = urllib.urlencode({
+        "redirect_uri" : "http://127.0.0.1:8000",
+        "grant_type": "client_credentials",
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_KEY,
+        "resource": "https://graph.windows.net/"
+    })
+
+    # Create the request headers
+    headers = {
+    }
+
+    try:
+        # Use a pooled connection to the MSFT login service
+        started = time.time()
+        response, data = httpRequest(LOGIN_HOST, "POST", "/" + O365DOMAIN 
+                                    + "/oauth2/token?" + params, body, headers)
+        METRICS.observe("login", response.status, time.time() - started, 
+                        len(body), len(data))
+
+        # Get the auth token
+        if response.status == 200:
+            jsondata = json.loads(data)
+            ACCESS_TOKEN = str(jsondata['access_token'])
+            # Remember when the token expires so it can be renewed in time
+            TOKEN_EXPIRES = time.time() + int(jsondata.get('expires_in', 3600))
+            logging.info("got a new access token")
+            saveToken()
+        else:
+            console("ERROR: MSFT login service did not respond correctly")
+            logging.error("MSFT login service returned: {0}" \
+                            .format(response.status))
+        
+    except Exception as e:
+        console("ERROR: Could not connect to MSFT login service: {0}".format(e))
+        logging.error("problem connecting to MSFT login service: {0}".format(e))
+     
+    return
+
+
+def loadToken():
+    """Use the access token saved in TOKENCACHE by an earlier run"""
+    
+    global ACCESS_TOKEN
+    global TOKEN_EXPIRES
+    
+    if not TOKENCACHE or not os.path.exists(TOKENCACHE):
+        return False
+    
+    try:
+        # Do not trust a cache file that others can read or change
+        info = os.stat(TOKENCACHE)
+        if info.st_uid != os.getuid() or info.st_mode & 0o077:
+            logging.warning("ignoring unprotected token cache: {0}" \
+                            .format(TOKENCACHE))
+            return False
+        
+        with open(TOKENCACHE, 'rb') as f_cache:
+            cache = json.load(f_cache)
+        
+        # The token has to be for the same tenant and app user
+        if cache.get('domain') != O365DOMAIN \
+                or cache.get('client_id') != CLIENT_ID \
+                or time.time() >= cache['expires_on'] - TOKENMARGIN:
+            return False
+        
+        ACCESS_TOKEN = str(cache['access_token'])
+        TOKEN_EXPIRES = cache['expires_on']
+    
+    except (IOError, OSError, ValueError, KeyError) as e:
+        logging.warning("could not read token cache: {0}".format(e))
+        return False
+    
+    logging.info("using the cached access token")
+    
+    return True
+
+
+def saveToken():
+    """Save the access token to TOKENCACHE for the next runs"""
+    
+    if not TOKENCACHE:
+        return
+    
+    try:
+        # Only the owner can read the token
+        fd = os.open(TOKENCACHE, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'wb') as f_cache:
+            json.dump({
+                'domain': O365DOMAIN,
+                'client_id': CLIENT_ID,
+                'access_token': ACCESS_TOKEN,
+                'expires_on': TOKEN_EXPIRES
+            }, f_cache)
+    
+    except (IOError, OSError) as e:
+        logging.warning("could not save token cache: {0}".format(e))
+    
+    return
+
+
+def findUser(upn):
+    """Do a quick check if the user already exists"""
+    
+    return getUser(upn, "objectId") is not None
+
+
+# Fields of a user that the actions look at
+USERSELECT = ",".join(("userPrincipalName",) + DirUser._fields)
+
+
+def getUser(upn, select=USERSELECT):
+    """Get the attributes of a user or None if the user does not exist,
+    an empty dict means the user may exist but we could not check, 
+    only the select fields are read from Graph API"""
+    
+    # The prefetched directory saves a round trip
+    if DIRECTORY is not None:
+        user = DIRECTORY.get(upn)
+        if user is None:
+            return None
+        # The index is keyed by the UPN that found the user
+        user = user._asdict()
+        user['userPrincipalName'] = upn
+        user['assignedLicenses'] = unpackLicenses(user['assignedLicenses'])
+        return user
+    
+    try:
+        # Re-use a pooled connection to Graph API
+        response, data = graphRequest("GET", graphUrl("/users/" + upn, 
+                                    {'$select': select}), "", JSON_HEADERS, 
+                                    "findUser")
+        
+        # Check if the user does not exist
+        if response.status == 404:
+            logging.info("user {0} does not exist in o365".format(upn))
+            return None
+        
+        # Throttling or server errors do not tell us anything
+        if response.status != 200:
+            raise GraphError("o365 returned {0}".format(response.status))
+        
+        return json.loads(data)
+
+    except Exception as e:
+        console("ERROR: problem with user search in O365: {0}".format(e))
+        logging.error("problem searching for {0} in O365: {1}".format(upn,e))
+        
+    return {}
+
+
+def diffUser(user, body):
+    """Get the attributes of the body that differ from the user"""
+    
+    # Without the current attributes everything has to be sent
+    if not user:
+        return dict(body)
+    
+    return dict((field, value) for field, value in body.items() 
+                if packValue(field, value) != packValue(field, user.get(field)))
+
+
+def countStat(name, count=1):
+    """Add to a counter of the run summary"""
+    
+    with STATS_LOCK:
+        STATS[name] += count
+    
+    return
+
+
+def runStats():
+    """Log and print the counters of the run summary"""
+    
+    for name in sorted(STATS):
+        logging.info("{0}: {1}".format(name, STATS[name]))
+        console("INFO: {0}: {1}".format(name, STATS[name]))
+    
+    return
+
+
+# Upper bounds in seconds of the call latency histogram buckets
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 
+            1, 2.5, 5, 10, 30, 60)
+
+# Latencies kept of each operation and of all calls for the percentiles
+SAMPLES = 4096
+
+
+class Metrics(object):
+    """Counters and latency histograms of the Graph API and login 
+    calls by operation, e.g. findUser, create or assignLicense.
+    
+    Every try of a call is recorded with its HTTP status, or "error" 
+    if the connection failed, the seconds it took and the bytes sent
+    and received. Re-tries are counted on their own. The percentiles 
+    come from a random sample of SAMPLES latencies, as the buckets 
+    are too coarse for them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.ops = {}
+        # Sample of the latencies of all calls
+        self.samples = []
+        self.calls = 0
+
+    def getOp(self, op):
+        """Get the counters of an operation, the lock must be held"""
+        
+        if op not in self.ops:
+            self.ops[op] = {
+                "status": collections.Counter(),
+                "buckets": [0] * (len(BUCKETS) + 1),
+                "samples": [],
+                "seconds": 0.0,
+                "calls": 0,
+                "retries": 0,
+                "sent": 0,
+                "received": 0
+            }
+        
+        return self.ops[op]
+
+    def observe(self, op, status, seconds, sent=0, received=0):
+        """Record one try of a call"""
+        
+        index = len(BUCKETS)
+        for number, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                index = number
+                break
+        
+        with self.lock:
+            counters = self.getOp(op)
+            counters["status"][str(status)] += 1
+            counters["buckets"][index] += 1
+            counters["seconds"] += seconds
+            counters["calls"] += 1
+            counters["sent"] += sent
+            counters["received"] += received
+            sample(counters["samples"], counters["calls"], seconds)
+            self.calls += 1
+            sample(self.samples, self.calls, seconds)
+
+    def retried(self, op):
+        """Count a call that is tried again"""
+        
+        with self.lock:
+            self.getOp(op)["retries"] += 1
+
+    def snapshot(self):
+        """Get a copy of all counters as a dict that can go to JSON"""
+        
+        result = {
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "ops": {}
+        }
+        samples = {}
+        
+        with self.lock:
+            for op, counters in self.ops.items():
+                result["ops"][op] = {
+                    "calls": counters["calls"],
+                    "status": dict(counters["status"]),
+                    "seconds": counters["seconds"],
+                    "buckets": [[bound, count] for bound, count 
+                                in zip(BUCKETS + ("+Inf",), 
+                                        counters["buckets"])],
+                    "retries": counters["retries"],
+                    "bytesSent": counters["sent"],
+                    "bytesReceived": counters["received"]
+                }
+                samples[op] = counters["samples"][:]
+            result["calls"] = self.calls
+            total = self.samples[:]
+        
+        # Sorting is done outside the lock, so workers do not wait
+        for op, latencies in samples.items():
+            latencies.sort()
+            result["ops"][op]["p50"] = percentile(latencies, 0.5)
+            result["ops"][op]["p99"] = percentile(latencies, 0.99)
+        total.sort()
+        result["p50"] = percentile(total, 0.5)
+        result["p99"] = percentile(total, 0.99)
+        
+        return result
+
+    def prometheus(self):
+        """Get all counters in the Prometheus text format"""
+        
+        snapshot = self.snapshot()
+        ops = sorted(snapshot["ops"].items())
+        lines = []
+        
+        lines.append("# HELP o365_calls_total Calls by operation and status")
+        lines.append("# TYPE o365_calls_total counter")
+        for op, counters in ops:
+            for status, count in sorted(counters["status"].items()):
+                lines.append('o365_calls_total{{op="{0}",status="{1}"}} ' \
+                            '{2}'.format(op, status, count))
+        
+        lines.append("# HELP o365_call_seconds Latency of calls")
+        lines.append("# TYPE o365_call_seconds histogram")
+        for op, counters in ops:
+            count = 0
+            for bound, number in counters["buckets"]:
+                count += number
+                lines.append('o365_call_seconds_bucket{{op="{0}",' \
+                            'le="{1}"}} {2}'.format(op, bound, count))
+            lines.append('o365_call_seconds_sum{{op="{0}"}} {1:.6f}' \
+                            .format(op, counters["seconds"]))
+            lines.append('o365_call_seconds_count{{op="{0}"}} {1}' \
+                            .format(op, counters["calls"]))
+        
+        for name, key, text in (
+                ("o365_retries_total", "retries", "Calls tried again"), 
+                ("o365_sent_bytes_total", "bytesSent", "Bytes sent"), 
+                ("o365_received_bytes_total", "bytesReceived", 
+                    "Bytes received")):
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} counter".format(name))
+            for op, counters in ops:
+                lines.append('{0}{{op="{1}"}} {2}'.format(name, op, 
+                                                            counters[key]))
+        
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        """Write a snapshot to a file, JSON if the name ends with .json 
+        and Prometheus text otherwise"""
+        
+        if path.lower().endswith('.json'):
+            data = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+        else:
+            data = self.prometheus()
+        
+        # Readers never see a half written file
+        temp = path + '.tmp'
+        with open(temp, 'w') as f_metrics:
+            f_metrics.write(data)
+        os.rename(temp, path)
+
+
+def sample(samples, count, value):
+    """Keep a value in a sample of at most SAMPLES of the count values 
+    seen so far, each of them equally likely"""
+    
+    if len(samples) < SAMPLES:
+        samples.append(value)
+        return
+    
+    slot = random.randrange(count)
+    if slot < SAMPLES:
+        samples[slot] = value
+
+
+def percentile(samples, share):
+    """Get a percentile of sorted samples by nearest rank"""
+    
+    if not samples:
+        return 0.0
+    
+    return samples[min(len(samples) - 1, int(len(samples) * share))]
+
+
+# Metrics of all calls of the run
+METRICS = Metrics()
+
+
+class MetricsWriter(object):
+    """Background thread that writes a metrics snapshot every interval 
+    seconds, so a long run can be watched while it goes"""
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Write snapshots until stopped"""
+        
+        while not self.stopped.wait(self.interval):
+            try:
+                METRICS.write(self.path)
+            except (IOError, OSError) as e:
+                logging.error("could not write metrics: {0}".format(e))
+
+    def stop(self):
+        """Stop the thread"""
+        
+        self.stopped.set()
+        self.thread.join()
+
+
+def startMetrics(path, interval):
+    """Start writing the metrics to a file every interval seconds"""
+    
+    global METRICS_WRITER
+    
+    METRICS_WRITER = MetricsWriter(path, interval)
+    
+    return
+
+
+def stopMetrics(path):
+    """Stop the periodic writer and write the final metrics"""
+    
+    global METRICS_WRITER
+    
+    if METRICS_WRITER is not None:
+        METRICS_WRITER.stop()
+        METRICS_WRITER = None
+    
+    if path:
+        try:
+            METRICS.write(path)
+            logging.info("wrote metrics to {0}".format(path))
+        except (IOError, OSError) as e:
+            console("ERROR: could not write metrics to {0}: {1}" \
+                    .format(path, e))
+            logging.error("could not write metrics to {0}: {1}" \
+                    .format(path, e))
+    
+    return
+
+
+def metricsStats():
+    """Log and print the calls, latency and re-tries of each operation"""
+    
+    snapshot = METRICS.snapshot()
+    
+    for op, counters in sorted(snapshot["ops"].items()):
+        message = "{0} calls: {1}, p50: {2:.1f}ms, p99: {3:.1f}ms, " \
+                    "re-tries: {4}, sent: {5} bytes, received: {6} bytes" \
+                    .format(op, counters["calls"], counters["p50"] * 1000, 
+                            counters["p99"] * 1000, counters["retries"], 
+                            counters["bytesSent"], counters["bytesReceived"])
+        logging.info(message)
+        console("INFO: " + message)
+    
+    return
+
+
+class ConnectionPool(object):
+    """Keep-alive connections to a single host that are shared 
+    by all API calls, so TLS sessions survive from row to row"""
+
+    def __init__(self, host, size):
+        self.host = host
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+        # Limit the number of connections open at the same time
+        self.slots = threading.BoundedSemaphore(size)
+        # Counters of connection re-use
+        self.created = 0
+        self.reused = 0
+        self.reconnects = 0
+
+    def connect(self):
+        """Open a new connection to the host"""
+        
+        with self.lock:
+            self.created += 1
+        if not USEHTTPS:
+            return httplib.HTTPConnection(self.host, timeout=POOLTIMEOUT)
+        return httplib.HTTPSConnection(self.host, timeout=POOLTIMEOUT)
+
+    def get(self):
+        """Check out an idle connection or open a new one"""
+        
+        self.slots.acquire()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                conn, since = self.idle.pop()
+            
+            # Drop sockets that were idle too long or closed by the server
+            if time.time() - since > POOLIDLE or isStale(conn):
+                conn.close()
+                continue
+            
+            with self.lock:
+                self.reused += 1
+            return conn, True
+        
+        return self.connect(), False
+
+    def put(self, conn):
+        """Return a connection to the pool"""
+        
+        with self.lock:
+            self.idle.append((conn, time.time()))
+        self.slots.release()
+
+    def discard(self, conn):
+        """Close a broken connection instead of returning it"""
+        
+        conn.close()
+        self.slots.release()
+
+    def close(self):
+        """Close all idle connections"""
+        
+        with self.lock:
+            for conn, _ in self.idle:
+                conn.close()
+            self.idle = []
+
+
+def isStale(conn):
+    """Check if an idle keep-alive socket was half-closed by the server"""
+    
+    if conn.sock is None:
+        return True
+    
+    try:
+        # An idle socket should have nothing to read
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        if not readable:
+            return False
+        
+        # Readable means EOF or garbage from the server, unless it
+        # was only a TLS record like a session ticket
+        conn.sock.setblocking(0)
+        try:
+            conn.sock.recv(1)
+        finally:
+            conn.sock.settimeout(POOLTIMEOUT)
+    except ssl.SSLWantReadError:
+        return False
+    except (select.error, socket.error, ValueError):
+        return True
+    
+    return True
+
+
+def sizePools(workers):
+    """Make room in the pools for a connection of each worker and of 
+    the license and group member queues, so POOLSIZE does not quietly 
+    hold back the workers"""
+    
+    global POOLSIZE
+    
+    size = max(POOLSIZE, workers + 2, LISTWORKERS)
+    if size > POOLSIZE:
+        logging.info("raising the pool size from {0} to {1} for {2} " \
+                        "workers".format(POOLSIZE, size, workers))
+        POOLSIZE = size
+    
+    return
+
+
+def getPool(host):
+    """Get the connection pool of a host"""
+    
+    with POOLS_LOCK:
+        if host not in POOLS:
+            POOLS[host] = ConnectionPool(host, POOLSIZE)
+        return POOLS[host]
+
+
+def httpRequest(host, method, url, body="", headers=None):
+    """Send a request over a pooled keep-alive connection and
+    return the response together with its body, asking for it gzipped"""
+    
+    headers = dict(headers or {})
+    headers.setdefault('Accept-Encoding', 'gzip')
+    
+    pool = getPool(host)
+    conn, reused = pool.get()
+    
+    sent = False
+    
+    try:
+        try:
+            conn.request(method, url, body, headers)
+            sent = True
+            response = conn.getresponse()
+            data = readBody(response)
+        except (httplib.HTTPException, socket.error) as e:
+            conn.close()
+            # Only a fresh connection failing is a real error, and a 
+            # POST that went out may have been done already, so it is 
+            # not sent twice
+            if not reused or (sent and method == "POST"):
+                raise
+            # The server dropped the socket while it was idle, 
+            # so reconnect and send the request again
+            logging.info("reconnecting to {0}: {1}".format(host, e))
+            with pool.lock:
+                pool.reconnects += 1
+            conn = pool.connect()
+            conn.request(method, url, body, headers)
+            response = conn.getresponse()
+            data = readBody(response)
+    except:
+        pool.discard(conn)
+        raise
+    
+    # The server may ask to close the connection after this response
+    if response.will_close:
+        pool.discard(conn)
+    else:
+        pool.put(conn)
+    
+    return response, data
+
+
+def readBody(response):
+    """Read the body of a response, unpacking it while it comes in if it 
+    is gzipped, and keep the bytes that came over the wire in received"""
+    
+    if response.getheader('Content-Encoding', '').lower() != 'gzip':
+        data = response.read()
+        response.received = len(data)
+        return data
+    
+    unpacker = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    chunks = []
+    received = 0
+    
+    while True:
+        chunk = response.read(65536)
+        if not chunk:
+            break
+        received += len(chunk)
+        chunks.append(unpacker.decompress(chunk))
+    chunks.append(unpacker.flush())
+    
+    response.received = received
+    
+    return "".join(chunks)
+
+
+def graphParams(query=None):
+    """Get the query string of a Graph API call, the api-version 
+    part is encoded only once"""
+    
+    if not query:
+        return API_PARAMS
+    
+    return API_PARAMS + "&" + urllib.urlencode(query)
+
+
+def graphUrl(path, query=None):
+    """Get the URL of a Graph API call on O365DOMAIN"""
+    
+    return "/" + O365DOMAIN + path + "?" + graphParams(query)
+
+
+def authHeaders():
+    """Get the headers of a request that does not go through 
+    graphRequest, with a current access token"""
+    
+    graphConnect()
+    
+    return {
+        'Authorization': 'Bearer ' + (ACCESS_TOKEN or ''),
+        'Content-Type': 'application/json; charset=utf-8'
+    }
+
+
+def graphRequest(method, url, body="", headers=None, op="other"):
+    """Send a request to Graph API over a pooled connection with a 
+    current access token, logging in again once if it is rejected.
+    
+    All calls are paced by the rate limiter, and throttled or failed
+    calls are sent again after the Retry-After time or a backoff.
+    Every try is recorded in the metrics under the operation op."""
+    
+    # Renew the token shortly before it expires
+    graphConnect()
+    
+    attempt = 0
+    reauth = False
+    
+    while True:
+        token = ACCESS_TOKEN
+        headers = dict(headers or {})
+        if token:
+            headers['Authorization'] = 'Bearer ' + token
+        
+        LIMITER.acquire()
+        started = time.time()
         
-        if response.status != 204:
-            logging.error("user was not updated in o365: {0}" \
-                    .format(username))
-            print("ERROR: User {0} was not updated in o365" \
-                    .format(username))
-            result = "ERROR: could not update user in o365."
-        else:
-            logging.info("user updated o365: {0}".format(username))
-            print("SUCCESS: User {0} updated in o365".format(username))
-            result = "SUCCESS: user was updated in o365."
-            
-        conn.close()
+        try:
+            if BATCHER is not None:
+                response, data = BATCHER.submit(method, url, body, headers)
+            else:
+                response, data = httpRequest(GRAPH_HOST, method, url, body, 
+                                            headers)
+        except (httplib.HTTPException, socket.error) as e:
+            METRICS.observe(op, "error", time.time() - started, len(body), 0)
+            # Do not send a POST twice, it may have been done already
+            if method == "POST" or attempt >= MAXRETRIES:
+                raise
+            attempt += 1
+            METRICS.retried(op)
+            logging.warning("o365 request failed, re-try {0}: {1}" \
+                            .format(attempt, e))
+            LIMITER.backoff(attempt)
+            continue
         
-    except Exception as e:
-        print("ERROR: Could not update user in o365: {0}".format(e))
-        logging.error("o365 update failed for: {0}: {1}".format(username,e))
-        result = "ERROR: Could not update o365 user."
-        return result
-    
-    return result
+        METRICS.observe(op, response.status, time.time() - started, 
+                        len(body), getattr(response, 'received', len(data)))
+        
+        if response.status == 401 and not reauth:
+            # The token expired early or was revoked
+            logging.warning("o365 rejected the access token, " \
+                            "logging in again")
+            reauth = True
+            graphConnect(token)
+            continue
+        
+        paceResponse(response, started)
+        
+        if response.status in RETRYSTATUS and attempt < MAXRETRIES:
+            attempt += 1
+            METRICS.retried(op)
+            logging.warning("o365 returned {0}, re-try {1}" \
+                            .format(response.status, attempt))
+            LIMITER.backoff(attempt, parseRetryAfter(
+                                        response.getheader('Retry-After')))
+            continue
+        
+        return response, data
 
 
-def delete(username):
-    """This function deletes a user from O365"""
+# Statuses of throttled and transient failures that are tried again
+RETRYSTATUS = (429, 500, 502, 503, 504)
 
-    # Check if the argument is missing
-    if str(username) == "":
-        print("ERROR: unable to delete user because username argument " \
-                "is missing a value")
-        logging.error("unable to delete user because username argument " \
-                        "is missing a value")
-        result = "ERROR: Missing an expected input value for username " \
-                    "in input file."
-        return result
 
-    # Get the Graph API access_token and
-    # Catch any MSFT login failures
-    if not ACCESS_TOKEN:
-        graphConnect()
-        if not ACCESS_TOKEN:
-            result = "ERROR: unable to authenticate to MSFT login service."
-            return result
+def paceResponse(response, started):
+    """Let the rate limiter know how a call sent at started went, a 
+    throttled $batch was already counted once for all its requests"""
     
-    access_token = ACCESS_TOKEN
+    if getattr(response, 'counted', False):
+        return
     
-    # Do a quick check if the user exists
-    upn = username + "@" + O365DOMAIN
+    if response.status in (429, 503):
+        LIMITER.throttled(parseRetryAfter(response.getheader('Retry-After')), 
+                            started)
+    elif response.status < 500:
+        LIMITER.success()
 
-    if not findUser(upn):
-        print("ERROR: user does not exist in o365: {0}".format(username))
-        logging.error("user does not exist in o365: {0}".format(username))
-        result = "ERROR: user could not be found in o365!"
-        return result
+
+class RateLimiter(object):
+    """Paces the calls to Graph API and adapts the pace to throttling.
+    
+    The rate grows a little with every successful call and is halved 
+    when Graph API throttles us, so it settles just under the limit of 
+    the tenant. A Retry-After from Graph API pauses all workers, and 
+    the calls it throttles are tried again once the pause is over 
+    with no backoff of their own. Calls that were on their way when 
+    we slowed down do not slow us down or pause us again."""
+
+    def __init__(self, rate, minRate, maxRate):
+        self.rate = float(rate)
+        self.minRate = float(minRate)
+        self.maxRate = float(maxRate)
+        self.lock = threading.Lock()
+        # Earliest time for the next call, end of a Retry-After pause, 
+        # and times of the last pause and slow down
+        self.next = 0
+        self.pause = 0
+        self.paused = 0
+        self.slowed = 0
+        # Throttling statistics
+        self.calls = 0
+        self.throttles = 0
+        self.retries = 0
+        self.waited = 0.0
+
+    def acquire(self):
+        """Wait for the turn of the next call"""
         
-    # Delete the user if all is OK
-    try:
-         # Build bearer auth header
-        headers = {
-            'Authorization': 'Bearer ' + access_token,
-            'Content-Type': 'application/json'
-        }
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next, self.pause)
+            self.next = start + 1 / self.rate
+            self.calls += 1
+            if start > now:
+                self.waited += start - now
+        
+        if start > now:
+            time.sleep(start - now)
+
+    def success(self):
+        """Speed up a bit, about one call per second every second"""
+        
+        with self.lock:
+            self.rate = min(self.maxRate, self.rate + 1 / self.rate)
+
+    def throttled(self, retryAfter=None, started=None):
+        """Slow down and pause everyone for the Retry-After time, 
+        started is when the throttled call was sent"""
+        
+        with self.lock:
+            now = time.time()
+            if started is None:
+                started = now
+            self.throttles += 1
+            # Calls that were already on their way when we got throttled
+            # should not slow us down again
+            if started >= self.slowed:
+                self.rate = max(self.minRate, self.rate / 2)
+                self.slowed = now
+            if retryAfter and started >= self.paused:
+                self.pause = max(self.pause, now + retryAfter)
+                self.paused = now
+
+    def backoff(self, attempt, retryAfter=None):
+        """Wait before a call is tried again, a call with a Retry-After 
+        waits for the pause of everyone in acquire instead"""
+        
+        with self.lock:
+            self.retries += 1
+        
+        if retryAfter is not None:
+            return
+        
+        delay = backoffDelay(attempt)
+        with self.lock:
+            self.waited += delay
+        time.sleep(delay)
+
+
+def backoffDelay(attempt):
+    """Exponential backoff with full jitter"""
     
-        params = urllib.urlencode({
-            'api-version': API_VERSION,
-        })
+    return random.uniform(0, min(BACKOFFMAX, BACKOFFBASE * 2 ** attempt))
+
+
+def parseRetryAfter(value):
+    """Get the seconds to wait from a Retry-After header, 
+    which is either seconds or a date"""
     
-        # Connect to Graph API
-        conn = httplib.HTTPSConnection('graph.windows.net')
-        conn.request("DELETE", "/" + O365DOMAIN + "/users/" + upn + "?" 
-                        + params, "", headers)
-        response = conn.getresponse()
+    if not value:
+        return None
+    
+    try:
+        return max(0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0, email.utils.mktime_tz(date) - time.time())
 
-        if response.status != 204:
-            logging.error("user was not deleted in o365: {0}" \
-                    .format(username))
-            print("ERROR: User {0} was not deleted in o365" \
-                    .format(username))
-            result = "ERROR: could not delete user in o365."
-        else:
-            logging.info("user deleted in o365: {0}".format(username))
-            print("SUCCESS: User {0} deleted in o365".format(username))
-            result = "SUCCESS: user deleted in o365."
-            
-        conn.close()
 
-    except Exception as e:
-        print("ERROR: unknown error while deleting user: {0}".format(e))
-        logging.error("unknown error while deleting user {0}: {1}" \
-                        .format(username,e))
-        result = "ERROR: Could not delete o365 user."
+def rateStats():
+    """Log and print the throttling statistics"""
     
-    return result
+    logging.info("o365 calls: {0}, throttled: {1}, re-tries: {2}, " \
+                "waited: {3:.1f}s, final rate: {4:.1f}/s".format(
+                LIMITER.calls, LIMITER.throttles, LIMITER.retries, 
+                LIMITER.waited, LIMITER.rate))
+    console("INFO: o365 calls: {0}, throttled: {1}, re-tries: {2}, " \
+                "waited: {3:.1f}s, final rate: {4:.1f}/s".format(
+                LIMITER.calls, LIMITER.throttles, LIMITER.retries, 
+                LIMITER.waited, LIMITER.rate))
+    
+    return
 
 
-def list():
-    """This function lists all users in O365"""
+class BatchResponse(object):
+    """Response of a single request inside a $batch response"""
 
-    # Get the Graph API access_token and
-    # Catch any MSFT login failures
-    if not ACCESS_TOKEN:
-        graphConnect()
-        if not ACCESS_TOKEN:
-            result = "ERROR: unable to authenticate to MSFT login service."
-            return result
+    def __init__(self, status, reason, headers, counted=False):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        # The status of a failed $batch the limiter already counted
+        self.counted = counted
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name.lower(), default)
+
+
+class RequestBatcher(object):
+    """Collects requests of parallel workers and sends them to Graph API 
+    as multipart $batch requests, then hands each worker its response.
     
-    access_token = ACCESS_TOKEN
+    Graph API runs the parts of a batch in order, but it does not support
+    dependencies between them, so the steps of one row (e.g. the user
+    check, the POST and assignLicense) still wait for each other in the
+    worker and only requests of different rows share a batch.
     
-    # Get the list of all users in O365 sorted by username
-    try:
-         # Build bearer auth header
-        headers = {
-            'Authorization': 'Bearer ' + access_token,
-            'Content-Type': 'application/json'
+    If a batch fails, its requests are sent again on their own, except 
+    for the POSTs of a batch that Graph API may have run, which fail 
+    like a POST that got no answer."""
+
+    def __init__(self, size, wait, senders):
+        self.size = size
+        self.wait = wait
+        self.queue = Queue.Queue()
+        self.threads = []
+        # Counters of batches and of requests packed into them
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.requests = 0
+        
+        for _ in range(senders):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, method, url, body, headers):
+        """Queue a request and wait for its response"""
+        
+        item = {
+            "method": method,
+            "url": url,
+            "body": body,
+            "headers": headers or {},
+            "done": threading.Event(),
+            "response": None,
+            "error": None
         }
+        self.queue.put(item)
+        item["done"].wait()
         
-        # Can add optional filters, like '$filter': 'accountEnabled eq false'
-        params = urllib.urlencode({
-            'api-version': API_VERSION,
-            '$top': '999'
-        })
+        if item["error"] is not None:
+            raise item["error"]
         
-        # Connect to Graph API
-        conn = httplib.HTTPSConnection('graph.windows.net')
-
-        # Need to check if we need to get next page of results
-        skipToken = '1'
+        # The batch failed, so send this request on its own
+        if item["response"] is None:
+            return httpRequest(GRAPH_HOST, method, url, body, headers)
         
-        while skipToken:
-            if skipToken == '1':
-                conn.request("GET", "/" + O365DOMAIN + "/users" + "?" 
-                            + params, "", headers)
-            else:
-                conn.request("GET", "/" + O365DOMAIN + "/" + skipToken 
-                            + "&" + params, "", headers)
+        return item["response"]
 
-            response = conn.getresponse()
-            
-            if response.status != 200:
-                logging.error("did not get list of o365 users")
-                print("ERROR: did not get list of o365 users")
-                result = "ERROR: did not get list of o365 users."
+    def run(self):
+        """Sender thread that packs queued requests into batches"""
+        
+        while True:
+            item = self.queue.get()
+            if item is None:
+                # Leave the stop signal for the other senders
+                self.queue.put(None)
                 break
-            else:
-                data = response.read()
-                jsondata = json.loads(data)
-                for userPrincipal in jsondata['value']:
-                    print(userPrincipal['userPrincipalName'])
-                if 'odata.nextLink' not in jsondata:
-                    skipToken = ''
-                else:
-                    skipToken = jsondata['odata.nextLink']
-          
-            logging.info("got the list of o365 users")
-            #print("SUCCESS: Got the list of o365 users")
-            result = "SUCCESS: got the list of o365 users."
             
-        conn.close()
+            # Give other workers a moment to add their requests
+            items = [item]
+            deadline = time.time() + self.wait
+            while len(items) < self.size:
+                try:
+                    item = self.queue.get(True, max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                items.append(item)
+            
+            try:
+                self.send(items)
+            except Exception as e:
+                logging.error("o365 batch request failed: {0}".format(e))
+                failBatch(items, e)
+            finally:
+                for item in items:
+                    item["done"].set()
+        
+        return
 
-    except Exception as e:
-        print("ERROR: unknown error while getting the list of o365 users")
-        logging.error("unknown error while getting the list of o365 users")
-        result = "ERROR: Could not get the list of o365 users."
-    
-    return result
+    def send(self, items):
+        """Send one $batch request and match the responses to the items"""
+        
+        if len(items) == 1:
+            # No point in wrapping a single request
+            items[0]["response"] = httpRequest(GRAPH_HOST, items[0]["method"], 
+                            items[0]["url"], items[0]["body"], 
+                            items[0]["headers"])
+            return
+        
+        if sendBatch(items):
+            with self.lock:
+                self.batches += 1
+                self.requests += len(items)
+        
+        return
 
+    def stop(self):
+        """Stop the sender threads"""
+        
+        self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
 
-def readConfig(config_file):
-    """Function to import the config file"""
+
+def sendBatch(items):
+    """Send one $batch request and match the responses to the items,
+    returns False if Graph API did not answer every request"""
     
-    if config_file[-3:] == ".py":
-        config_file = config_file[:-3]
-    o365settings = __import__(config_file, globals(), locals(), [])
+    boundary = "batch_" + str(uuid.uuid4())
+    data = buildBatch(items, boundary)
     
-    # Read settings and set globals
-    try: 
-        global API_VERSION
-        global CLIENT_ID
-        global CLIENT_KEY
-        global O365DOMAIN
-        global STUPATTERN
-        global STULICENSE
-        global EMPLICENSE
-        global DISABLEDPLANS
-
-        API_VERSION = o365settings.API_VERSION
-        CLIENT_ID = o365settings.CLIENT_ID
-        CLIENT_KEY = o365settings.CLIENT_KEY
-        O365DOMAIN = o365settings.O365DOMAIN
-        STUPATTERN = o365settings.STUPATTERN
-        STULICENSE = o365settings.STULICENSE
-        EMPLICENSE = o365settings.EMPLICENSE
-        DISABLEDPLANS = o365settings.DISABLEDPLANS
-        
-        global ACCESS_TOKEN
-        ACCESS_TOKEN = None
-
-    except Exception as e:
-        logging.error("unable to parse settings file")
-        print("ERROR: unable to parse the settings file: {0}".format(e))
+    headers = {
+        'Authorization': items[0]["headers"].get('Authorization', ''),
+        'Content-Type': 'multipart/mixed; boundary=' + boundary
+    }
+    
+    body = data
+    sent = len(body)
+    retryAfter = None
+    
+    # A throttled or failed batch is one throttle or failure, not one 
+    # for each request in it, and it is sent once more as a whole
+    for attempt in range(2):
+        if attempt:
+            METRICS.retried("batch")
+            LIMITER.backoff(attempt, retryAfter)
+            LIMITER.acquire()
+        started = time.time()
+        response, data = httpRequest(GRAPH_HOST, "POST", 
+                                    graphUrl("/$batch"), body, headers)
+        METRICS.observe("batch", response.status, time.time() - started, 
+                        sent, response.received)
+        if response.status not in RETRYSTATUS:
+            break
+        paceResponse(response, started)
+        retryAfter = parseRetryAfter(response.getheader('Retry-After'))
+    
+    if response.status in RETRYSTATUS:
+        # Let the requests of the batch try again on their own
+        for item in items:
+            item["response"] = (BatchResponse(response.status, 
+                    response.reason, {'retry-after': 
+                    response.getheader('Retry-After')}, True), data)
         return False
-        
+    
+    if response.status == 401:
+        # The token was rejected, so every request of it was
+        for item in items:
+            item["response"] = (BatchResponse(response.status, 
+                                            response.reason, {}), data)
+        return False
+    
+    if response.status not in (200, 202):
+        logging.error("o365 batch request returned: {0}" \
+                        .format(response.status))
+        # A batch that was turned down was not run
+        if not 400 <= response.status < 500:
+            failBatch(items, "status {0}".format(response.status))
+        return False
+    
+    parts = parseMultipart(data, response.getheader('Content-Type', ''))
+    if len(parts) != len(items):
+        logging.error("o365 batch returned {0} responses for {1} " \
+                        "requests".format(len(parts), len(items)))
+        failBatch(items, "{0} responses for {1} requests" \
+                            .format(len(parts), len(items)))
+        return False
+    
+    for item, part in zip(items, parts):
+        item["response"] = part
+    
     return True
 
 
-def getUserType(username):
-    """ Function to determine the type of a user"""
-
-    if STUPATTERN in username:
-        userType = "STU"
-    else:
-        userType = "EMP"
+def failBatch(items, reason):
+    """Fail the POSTs of a batch that may have been run, so they are 
+    not done twice, the other requests of it go again on their own"""
+    
+    for item in items:
+        if item["method"] == "POST" and item["response"] is None:
+            item["error"] = httplib.HTTPException("o365 batch request " \
+                                "failed: {0}".format(reason))
+    
+    return
 
-    return userType
 
+def buildBatch(items, boundary):
+    """Build a multipart $batch body, queries go as plain parts and 
+    each change goes into its own changeset"""
+    
+    lines = []
+    
+    for item in items:
+        request = [
+            "{0} https://{1}{2} HTTP/1.1".format(item["method"], GRAPH_HOST, 
+                                                item["url"]),
+            "Accept: application/json"
+        ]
+        if item["body"]:
+            request.append("Content-Type: " + item["headers"].get(
+                            'Content-Type', 'application/json'))
+        request.append("")
+        request.append(item["body"] or "")
+        
+        part = [
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            ""
+        ] + request
+        
+        lines.append("--" + boundary)
+        if item["method"] == "GET":
+            lines.extend(part)
+        else:
+            changeset = "changeset_" + str(uuid.uuid4())
+            lines.append("Content-Type: multipart/mixed; boundary=" 
+                            + changeset)
+            lines.append("")
+            lines.append("--" + changeset)
+            lines.extend(part)
+            lines.append("--" + changeset + "--")
+        lines.append("")
+    
+    lines.append("--" + boundary + "--")
+    lines.append("")
+    
+    return "\r\n".join(lines)
 
-def graphConnect():
-    """This function gets auth token for Graph API"""
 
-    # Use global ACCESS_TOKEN variable
-    global ACCESS_TOKEN
+def parseMultipart(data, contentType):
+    """Parse a multipart $batch response into a flat list of 
+    (response, body) tuples, with changesets unpacked in place"""
     
-    # Set the connecton parameters
-    params = urllib.urlencode({
-        'api-version': API_VERSION,
-    })
+    boundary = ''
+    for param in contentType.split(';'):
+        param = param.strip()
+        if param.startswith('boundary='):
+            boundary = param[len('boundary='):].strip('"')
+    if not boundary:
+        return []
+    
+    results = []
+    
+    for part in data.split("--" + boundary)[1:]:
+        if part.startswith("--"):
+            break
+        
+        headers, _, body = part.lstrip("\r\n").partition("\r\n\r\n")
+        partType = ''
+        for line in headers.split("\r\n"):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-type':
+                partType = value.strip()
+        
+        if partType.startswith('multipart/mixed'):
+            results.extend(parseMultipart(body, partType))
+        else:
+            results.append(parseHttpPart(body))
+    
+    return results
 
-    # Create the request body
-    body = urllib.urlencode({
-        "redirect_uri" : "http://127.0.0.1:8000",
-        "grant_type": "client_credentials",
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_KEY,
-        "resource": "https://graph.windows.net/"
-    })
 
-    # Create the request headers
-    headers = {
-    }
+def parseHttpPart(part):
+    """Parse one application/http part of a $batch response"""
+    
+    head, _, body = part.partition("\r\n\r\n")
+    lines = head.split("\r\n")
+    
+    # Status line, e.g. HTTP/1.1 201 Created
+    status = lines[0].split(" ", 2)
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+    
+    response = BatchResponse(int(status[1]), 
+                            status[2] if len(status) > 2 else '', headers)
+    
+    return response, body.rstrip("\r\n")
 
-    try:
-        # Open a connection to the MSFT login service
-        conn = httplib.HTTPSConnection('login.windows.net')
-        conn.request("POST", "/" + O365DOMAIN + "/oauth2/token?" + params, body, 
-                        headers)
-        response = conn.getresponse()
 
-        # Get the auth token
-        if response.status == 200:
-            data = response.read()
-            jsondata = json.loads(data)
-            ACCESS_TOKEN = jsondata['access_token']
-        else:
-            print("ERROR: MSFT login service did not respond correctly")
-            logging.error("MSFT login service returned: {0}" \
-                            .format(response.status))
-        conn.close()
-        
-    except Exception as e:
-        print("ERROR: Could not connect to MSFT login service: {0}".format(e))
-        logging.error("problem connecting to MSFT login service: {0}".format(e))
-     
+def startBatcher(workers):
+    """Start packing Graph API requests into $batch requests"""
+    
+    global BATCHER
+    
+    if workers < 2:
+        logging.warning("batch mode needs more than one worker to " \
+                        "fill the batches")
+    
+    # One sender per full batch of workers keeps them all busy
+    senders = max(1, workers // BATCHSIZE)
+    BATCHER = RequestBatcher(BATCHSIZE, BATCHWAIT, senders)
+    
     return
 
 
-def findUser(upn):
-    """Do a quick check if the user already exists"""
+def stopBatcher():
+    """Stop the batch senders and report how well requests were packed"""
     
-    # Grab the access_token to Graph API
-    access_token = ACCESS_TOKEN
+    global BATCHER
     
-    # Build bearer auth header
-    headers = {
-        'Authorization': 'Bearer ' + access_token,
-        'Content-Type': 'application/json'
-    }
+    if BATCHER is None:
+        return
     
-    params = urllib.urlencode({
-        'api-version': API_VERSION,
-    })
+    BATCHER.stop()
+    logging.info("sent {0} requests in {1} batches" \
+                    .format(BATCHER.requests, BATCHER.batches))
+    console("INFO: sent {0} requests in {1} batches" \
+                    .format(BATCHER.requests, BATCHER.batches))
+    BATCHER = None
+    
+    return
 
-    try:
-        # Connect to Graph API
-        conn = httplib.HTTPSConnection('graph.windows.net')
-        conn.request("GET", "/" + O365DOMAIN + "/users/" + upn + "?" 
-                        + params, "", headers)
-        response = conn.getresponse()
-        conn.close()
-        
-        # Check if the user does not exist
-        if response.status != 200:
-            logging.info("user {0} does not exist in o365".format(upn))
-            return False
 
-    except Exception as e:
-        print("ERROR: problem with user search in O365: {0}".format(e))
-        logging.error("problem searching for {0} in O365: {1}".format(upn,e))
-        
-    return True
+def poolStats():
+    """Log and print the connection re-use counters"""
+    
+    for host in sorted(POOLS):
+        pool = POOLS[host]
+        logging.info("connections to {0}: {1} new, {2} reused, " \
+                    "{3} reconnects".format(host, pool.created, 
+                    pool.reused, pool.reconnects))
+        console("INFO: connections to {0}: {1} new, {2} reused, " \
+                    "{3} reconnects".format(host, pool.created, 
+                    pool.reused, pool.reconnects))
+    return
+
+
+def closePools():
+    """Close all pooled connections"""
+    
+    with POOLS_LOCK:
+        for host in POOLS:
+            POOLS[host].close()
+    return
 
 
 if __name__ == "__main__":
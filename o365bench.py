@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""
+Throughput benchmark of o365.py against the local o365mock.py,
+no tenant or network needed.
+
+Usage:
+    python o365bench.py --sizes 1000,10000 --args "-w 8 -b"
+
+Options:
+    -h --help
+    -s --sizes	Numbers of rows to run, comma separated
+    		(default 1000,10000,100000)
+    -a --args	Options passed to o365.py, e.g. "-w 8 -b -p"
+    --latency	Seconds every mock call takes (default 0)
+    --jitter	Random seconds added to the latency (default 0)
+    --throttle	Share of mock calls answered with 429 (default 0)
+    --fail	Share of mock calls answered with 503 (default 0)
+    --json	Also write the results as JSON to this file
+    --keep	Keep the work directory with the feeds, output and log
+
+For each size a synthetic feed is written in a work directory, where
+half the rows create users, a quarter update them and a quarter delete
+them. o365.py runs on it in its own process against a fresh mock,
+with settings that do not hold it back (no rate limit, no license
+delay). The mock runs in this process, so its work is not counted in
+the memory of o365.py.
+
+Output:
+
+One line per size with rows/sec, the number of calls the mock got,
+the p50/p99 latency of calls from the metrics of o365.py, its peak
+memory and the number of rows that did not succeed. The exit code
+is 1 if any row did not succeed.
+"""
+
+from __future__ import print_function
+import time
+import sys
+import os
+import json
+import argparse
+import shlex
+import shutil
+import subprocess
+import tempfile
+
+import o365mock
+
+
+# Settings of o365.py for the benchmark, hosts are added per run
+SETTINGS = """
+API_VERSION = '1.6'
+CLIENT_ID = 'bench'
+CLIENT_KEY = 'bench'
+O365DOMAIN = 'test.edu'
+STUPATTERN = '_'
+STULICENSE = 'sku-stu'
+EMPLICENSE = 'sku-emp'
+DISABLEDPLANS = ['plan-1', 'plan-2']
+RATELIMIT = 100000
+RATEMIN = 1000
+RATEMAX = 100000
+LICENSEDELAY = 0
+USEHTTPS = False
+"""
+
+
+def main(argv):
+    """This is the main body of the script"""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--sizes", "-s", type=str,
+                        default='1000,10000,100000',
+                        help="Numbers of rows to run, comma separated")
+    parser.add_argument("--args", "-a", type=str, default='',
+                        help="Options passed to o365.py")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds every mock call takes")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="Random seconds added to the latency")
+    parser.add_argument("--throttle", type=float, default=0,
+                        help="Share of mock calls answered with 429")
+    parser.add_argument("--fail", type=float, default=0,
+                        help="Share of mock calls answered with 503")
+    parser.add_argument("--json", type=str, default='',
+                        help="Also write the results as JSON to this file")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the work directory")
+
+    args = parser.parse_args(argv[1:])
+
+    try:
+        sizes = [int(size) for size in args.sizes.split(',') if size]
+    except ValueError:
+        print("ERROR: sizes must be numbers: {0}".format(args.sizes))
+        return 2
+
+    workdir = tempfile.mkdtemp(prefix='o365bench')
+    results = []
+
+    print("{0:>8} {1:>9} {2:>9} {3:>8} {4:>9} {5:>9} {6:>9} {7:>7}" \
+            .format("rows", "seconds", "rows/s", "calls", "p50 ms",
+                    "p99 ms", "peak MB", "failed"))
+
+    try:
+        for size in sizes:
+            result = runBenchmark(size, workdir, args)
+            results.append(result)
+            print("{rows:>8} {seconds:>9.2f} {rate:>9.1f} {calls:>8} " \
+                    "{p50:>9.2f} {p99:>9.2f} {peak:>9.1f} {failed:>7}" \
+                    .format(**result))
+    finally:
+        if args.keep:
+            print("INFO: work directory kept in {0}".format(workdir))
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f_json:
+            json.dump({"args": args.args, "results": results}, f_json,
+                        indent=2)
+
+    if any(result["failed"] for result in results):
+        return 1
+
+    return 0
+
+
+def runBenchmark(size, workdir, args):
+    """This function runs o365.py on a feed of size rows against a
+    fresh mock and returns its measurements"""
+
+    feed = os.path.join(workdir, "feed{0}.jsonl".format(size))
+    out = os.path.join(workdir, "out{0}.csv".format(size))
+    metrics = os.path.join(workdir, "metrics{0}.json".format(size))
+    writeFeed(feed, size)
+
+    server = o365mock.startMock(0, latency=args.latency,
+                                jitter=args.jitter, throttle=args.throttle,
+                                fail=args.fail)
+    host = "127.0.0.1:{0}".format(server.server_address[1])
+
+    config = os.path.join(workdir, "bench{0}settings.py".format(size))
+    with open(config, 'w') as f_config:
+        f_config.write(SETTINGS)
+        f_config.write("GRAPHHOST = '{0}'\nLOGINHOST = '{0}'\n" \
+                        .format(host))
+
+    command = [sys.executable,
+                os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'o365.py'),
+                "-f", feed, "-o", out, "--config", config, "-m", metrics]
+    command.extend(shlex.split(args.args))
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            started = time.time()
+            process = subprocess.Popen(command, cwd=workdir,
+                                        stdout=devnull,
+                                        stderr=subprocess.STDOUT)
+            # Resource usage of just this run of o365.py
+            _, status, usage = os.wait4(process.pid, 0)
+            seconds = time.time() - started
+        stats = server.tenant.stats()
+    finally:
+        o365mock.stopMock(server)
+
+    # Latency of the calls as o365.py saw them
+    try:
+        with open(metrics) as f_metrics:
+            latency = json.load(f_metrics)
+    except (IOError, ValueError):
+        latency = {"p50": 0, "p99": 0}
+
+    failed = countFailed(out, size)
+    if status != 0:
+        print("ERROR: o365.py exited with status {0}, see {1}" \
+                .format(status, os.path.join(workdir, 'o365.log')))
+
+    return {
+        "rows": size,
+        "seconds": seconds,
+        "rate": size / seconds if seconds else 0,
+        "calls": stats.get("calls", 0),
+        "throttled": stats.get("status 429", 0),
+        "p50": latency["p50"] * 1000,
+        "p99": latency["p99"] * 1000,
+        # ru_maxrss is in kilobytes on Linux
+        "peak": usage.ru_maxrss / 1024.0,
+        "failed": failed
+    }
+
+
+def writeFeed(path, size):
+    """This function writes a feed of size rows, in groups of four rows
+    that create two users, update the first and delete the second"""
+
+    with open(path, 'w') as f_feed:
+        for number in range(size):
+            group, step = divmod(number, 4)
+            first = "bench{0}".format(group * 2)
+            second = "bench{0}".format(group * 2 + 1)
+            if step == 0:
+                row = newUser(first)
+            elif step == 1:
+                row = newUser(second)
+            elif step == 2:
+                row = newUser(first)
+                row["action"] = "update"
+                row["primO"] = "Chemistry"
+                del row["UDCid"]
+                del row["userPassword"]
+            else:
+                row = {"action": "delete", "username": second}
+            f_feed.write(json.dumps(row) + "\n")
+
+    return
+
+
+def newUser(username):
+    """This function builds the create row of a synthetic user"""
+
+    return {
+        "action": "create",
+        "username": username,
+        "newusername": username,
+        "loginDisabled": "False",
+        "UDCid": "id-" + username,
+        "givenName": "Bench",
+        "fullName": "Bench " + username,
+        "sn": username,
+        "primO": "Biology",
+        "userPassword": "Bench-Pass-1"
+    }
+
+
+def countFailed(path, size):
+    """This function counts the rows of an output file that did not
+    succeed, missing rows and users with no licenses count as failed"""
+
+    done = 0
+    failed = 0
+
+    try:
+        with open(path) as f_out:
+            for line in f_out.readlines()[1:]:
+                done += 1
+                if "SUCCESS" not in line or "with no licenses" in line:
+                    failed += 1
+    except IOError:
+        pass
+
+    return failed + size - done
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
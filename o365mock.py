@@ -0,0 +1,957 @@
+#!/usr/bin/env python
+
+"""
+Local stand-in for the MSFT login service and the Graph API user,
+license, group member, recycle bin, paging and $batch endpoints, to test and benchmark o365.py
+without a tenant or network.
+
+Usage:
+    python o365mock.py -p 8765 --latency 0.05 --throttle 0.01
+
+Options:
+    -h --help
+    -p --port	Port to listen on (default 8765)
+    -u --users	Number of users the directory starts with (default 0)
+    --domain	Domain of those users (default test.edu)
+    --latency	Seconds every call takes (default 0)
+    --jitter	Random seconds added to the latency (default 0)
+    --throttle	Share of calls answered with 429 (default 0)
+    --fail	Share of calls answered with 503 (default 0)
+    --drop	Share of calls whose connection is closed with no answer
+    --retry-after	Retry-After seconds of 429 and 503 answers (default 1)
+    --propagation	Seconds before a new user can get licenses (default 0)
+    --token-life	Seconds an access token is valid (default 3600)
+    --page	Max number of users per page (default 999)
+    --seats	Seats of the subscribed licenses by skuId
+    		(default sku-stu=1000000,sku-emp=1000000)
+    --groups	Names of the groups the directory starts with, 
+    		comma separated (default none)
+
+Point o365.py at the mock with these settings:
+    GRAPHHOST = 'localhost:8765'
+    LOGINHOST = 'localhost:8765'
+    USEHTTPS = False
+
+Any client id and key get a token. assignLicense fails with 400 for a
+license that is not subscribed or has no seats left. The state is kept in memory only.
+Failures are injected into plain calls and into the parts of $batch
+calls alike, but never into logins.
+
+GET /_stats returns the counters of the mock and the percentiles
+of the time it took to answer calls as JSON. Answers are gzipped 
+for clients that send Accept-Encoding: gzip.
+"""
+
+from __future__ import print_function
+import time
+import sys
+import json
+import argparse
+import threading
+import random
+import re
+import uuid
+import urllib
+import urlparse
+import zlib
+import BaseHTTPServer
+import SocketServer
+
+
+# Path of the paged user list in odata.nextLink
+NEXTLINK_PATH = 'directoryObjects/$/Microsoft.DirectoryServices.User'
+
+# Simple $filter clauses, e.g. accountEnabled eq true, optionally narrowed
+# to the users whose names start with a prefix
+FILTER = re.compile(r"^\s*(\w+)\s+eq\s+(true|false|'(?:[^']|'')*')\s*$")
+STARTSWITH = re.compile(r"^\s*startswith\((\w+),('(?:[^']|'')*')\)\s*$")
+AND = re.compile(r"^\s*\((.*)\)\s+and\s+(startswith\(.*\))\s*$")
+
+
+def main(argv):
+    """This is the main body of the script"""
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--port", "-p", type=int, default=8765,
+                        help="Port to listen on")
+    parser.add_argument("--users", "-u", type=int, default=0,
+                        help="Number of users the directory starts with")
+    parser.add_argument("--domain", type=str, default='test.edu',
+                        help="Domain of the users the directory starts with")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds every call takes")
+    parser.add_argument("--jitter", type=float, default=0,
+                        help="Random seconds added to the latency")
+    parser.add_argument("--throttle", type=float, default=0,
+                        help="Share of calls answered with 429")
+    parser.add_argument("--fail", type=float, default=0,
+                        help="Share of calls answered with 503")
+    parser.add_argument("--drop", type=float, default=0,
+                        help="Share of calls whose connection is closed")
+    parser.add_argument("--retry-after", type=int, default=1,
+                        help="Retry-After seconds of 429 and 503 answers")
+    parser.add_argument("--propagation", type=float, default=0,
+                        help="Seconds before a new user can get licenses")
+    parser.add_argument("--token-life", type=int, default=3600,
+                        help="Seconds an access token is valid")
+    parser.add_argument("--page", type=int, default=999,
+                        help="Max number of users per page")
+    parser.add_argument("--seats", type=str,
+                        default='sku-stu=1000000,sku-emp=1000000',
+                        help="Seats of the subscribed licenses by skuId")
+    parser.add_argument("--groups", type=str, default='',
+                        help="Names of the groups the directory starts with")
+
+    args = parser.parse_args(argv[1:])
+
+    try:
+        args.seats = dict((sku, int(count)) for sku, _, count
+                            in [item.partition('=') for item
+                                in args.seats.split(',') if item])
+    except ValueError:
+        print("ERROR: seats must look like sku-stu=100,sku-emp=50")
+        return
+
+    server = startMock(**vars(args))
+    print("INFO: o365 mock listening on port {0}".format(args.port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stopMock(server)
+
+    return
+
+
+def startMock(port=8765, **options):
+    """This function starts the mock in a background thread and returns
+    its server, options are the same as the command line ones"""
+
+    settings = {
+        "users": 0,
+        "domain": 'test.edu',
+        "latency": 0,
+        "jitter": 0,
+        "throttle": 0,
+        "fail": 0,
+        "drop": 0,
+        "retry_after": 1,
+        "propagation": 0,
+        "token_life": 3600,
+        "page": 999,
+        "seats": {"sku-stu": 1000000, "sku-emp": 1000000},
+        "groups": ''
+    }
+    settings.update(options)
+
+    server = MockServer(('127.0.0.1', port), MockHandler)
+    server.settings = settings
+    server.tenant = MockTenant(settings)
+    server.tenant.seed(settings["users"], settings["domain"])
+    server.tenant.seedGroups([name.strip() for name
+                                in settings["groups"].split(',')
+                                if name.strip()])
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    return server
+
+
+def stopMock(server):
+    """This function stops a mock started with startMock"""
+
+    server.shutdown()
+    server.server_close()
+
+    return
+
+
+class MockServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server that answers every connection in its own thread"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MockTenant(object):
+    """In memory directory of one tenant with its tokens and counters"""
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.lock = threading.Lock()
+        # Users by lower case userPrincipalName, with the keys of
+        # their objectIds and immutableIds
+        self.users = {}
+        self.objectIds = {}
+        self.immutableIds = {}
+        # Log of changed objectIds, its length is the delta token
+        self.changes = []
+        self.tokens = {}
+        # Seats in use by skuId
+        self.consumed = {}
+        # Groups by objectId with the objectIds of their members
+        self.groups = {}
+        # Deleted users by objectId, their immutableIds stay taken
+        self.deleted = {}
+        self.deletedIds = {}
+        self.counters = {}
+        self.times = []
+
+    def seed(self, count, domain):
+        """Fill the directory with count users"""
+
+        for number in range(count):
+            upn = "mockuser{0}@{1}".format(number, domain)
+            self.addUser({
+                "userPrincipalName": upn,
+                "accountEnabled": True,
+                "immutableId": "seed{0}".format(number),
+                "givenName": "Mock",
+                "surname": "User{0}".format(number),
+                "displayName": "Mock User{0}".format(number),
+                "mailNickname": "mockuser{0}".format(number),
+                "department": "Mock",
+                "usageLocation": "US",
+                "assignedLicenses": []
+            })
+
+        return
+
+    def seedGroups(self, names):
+        """Add empty groups with these names"""
+
+        with self.lock:
+            for name in names:
+                objectId = str(uuid.uuid4())
+                self.groups[objectId] = {
+                    "objectId": objectId,
+                    "objectType": "Group",
+                    "displayName": name,
+                    "members": set()
+                }
+
+        return
+
+    def count(self, name, value=1):
+        """Add to a counter"""
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+        return
+
+    def took(self, seconds):
+        """Record how long the answer to a call took"""
+
+        with self.lock:
+            self.times.append(seconds)
+
+        return
+
+    def stats(self):
+        """Get the counters and the percentiles of the answer times"""
+
+        with self.lock:
+            result = dict(self.counters)
+            times = sorted(self.times)
+            result["users"] = len(self.users)
+            result["deleted"] = len(self.deleted)
+            result["members"] = sum(len(group["members"])
+                                    for group in self.groups.values())
+
+        for name, share in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+            if times:
+                index = min(len(times) - 1, int(len(times) * share))
+                result[name] = round(times[index], 6)
+            else:
+                result[name] = 0
+
+        return result
+
+    def login(self):
+        """Hand out a new access token"""
+
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.time() + self.settings["token_life"]
+        self.count("logins")
+
+        return 200, {
+            "token_type": "Bearer",
+            "expires_in": str(self.settings["token_life"]),
+            "access_token": token
+        }
+
+    def authorized(self, header):
+        """Check the Bearer token of a call"""
+
+        if not header or not header.startswith('Bearer '):
+            return False
+
+        with self.lock:
+            expires = self.tokens.get(header[len('Bearer '):], 0)
+
+        return expires > time.time()
+
+    def addUser(self, user):
+        """Add a user and return it, or None if the name is taken"""
+
+        key = user["userPrincipalName"].lower()
+
+        with self.lock:
+            if key in self.users:
+                return None
+            if user.get("immutableId") in self.immutableIds or \
+                    user.get("immutableId") in self.deletedIds:
+                return None
+            user["objectId"] = str(uuid.uuid4())
+            user["objectType"] = "User"
+            user.setdefault("assignedLicenses", [])
+            user["created"] = time.time()
+            self.users[key] = user
+            self.objectIds[user["objectId"]] = key
+            if user.get("immutableId"):
+                self.immutableIds[user["immutableId"]] = key
+            self.changes.append(user["objectId"])
+
+        return user
+
+    def findUser(self, name):
+        """Get the key of a user by userPrincipalName or objectId"""
+
+        name = urllib.unquote(name).lower()
+
+        with self.lock:
+            if name in self.users:
+                return name
+            return self.objectIds.get(name)
+
+    def call(self, method, path, query, body):
+        """Answer one Graph API call with a status and a JSON object"""
+
+        parts = [part for part in path.split('/') if part]
+        if len(parts) < 2:
+            return 404, graphError("Request_ResourceNotFound", "Not found")
+
+        # Drop the tenant
+        resource = '/'.join(parts[1:])
+
+        if resource == 'subscribedSkus' and method == 'GET':
+            return self.subscribedSkus()
+
+        if resource in ('users', NEXTLINK_PATH):
+            if method == 'GET' and 'deltaLink' in query:
+                return self.delta(query, parts[0])
+            if method == 'GET':
+                return self.listUsers(query, parts[0])
+            if method == 'POST' and resource == 'users':
+                return self.createUser(body)
+            return 405, graphError("Request_BadRequest", "Bad method")
+
+        if parts[1] == 'groups':
+            return self.groupCall(method, parts[2:], query, body)
+
+        if parts[1] == 'deletedDirectoryObjects':
+            return self.deletedCall(method, parts[2:], query)
+
+        if parts[1] != 'users' or len(parts) not in (3, 4):
+            return 404, graphError("Request_ResourceNotFound", "Not found")
+
+        key = self.findUser(parts[2])
+        if key is None:
+            return 404, graphError("Request_ResourceNotFound",
+                                    "Resource '{0}' does not exist" \
+                                    .format(parts[2]))
+
+        if len(parts) == 4:
+            if parts[3] == 'assignLicense' and method == 'POST':
+                return self.assignLicense(key, body)
+            return 404, graphError("Request_ResourceNotFound", "Not found")
+
+        if method == 'GET':
+            with self.lock:
+                user = self.users[key]
+            return 200, project(user, query.get('$select', ''))
+        if method == 'PATCH':
+            return self.updateUser(key, body)
+        if method == 'DELETE':
+            with self.lock:
+                user = self.users.pop(key)
+                for item in user["assignedLicenses"]:
+                    skuId = item.get("skuId")
+                    self.consumed[skuId] = self.consumed.get(skuId, 0) - 1
+                del self.objectIds[user["objectId"]]
+                for group in self.groups.values():
+                    group["members"].discard(user["objectId"])
+                self.immutableIds.pop(user.get("immutableId"), None)
+                self.changes.append(user["objectId"])
+                # Into the recycle bin
+                self.deleted[user["objectId"]] = user
+                if user.get("immutableId"):
+                    self.deletedIds[user["immutableId"]] = user["objectId"]
+            return 204, None
+
+        return 405, graphError("Request_BadRequest", "Bad method")
+
+    def groupCall(self, method, parts, query, body):
+        """Answer a call on groups: the list, or the $links of members"""
+
+        if not parts:
+            if method != 'GET':
+                return 405, graphError("Request_BadRequest", "Bad method")
+            test = parseFilter(query.get('$filter', ''))
+            if test is None:
+                return 400, graphError("Request_UnsupportedQuery",
+                                        "Unsupported filter")
+            with self.lock:
+                groups = [dict((name, value) for name, value
+                                in group.items() if name != "members")
+                            for group in self.groups.values()]
+            select = query.get('$select', '')
+            return 200, {"value": [project(group, select) for group
+                                    in groups if test(group)]}
+
+        if parts[1:3] != ['$links', 'members'] or len(parts) not in (3, 4):
+            return 404, graphError("Request_ResourceNotFound", "Not found")
+
+        with self.lock:
+            group = self.groups.get(parts[0].lower())
+            if group is None:
+                return 404, graphError("Request_ResourceNotFound",
+                                        "Resource '{0}' does not exist" \
+                                        .format(parts[0]))
+
+            if method == 'POST' and len(parts) == 3:
+                try:
+                    objectId = json.loads(body)["url"].rstrip('/') \
+                                .split('/')[-1].lower()
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    return 400, graphError("Request_BadRequest",
+                                            "Invalid reference")
+                key = self.objectIds.get(objectId)
+                # A new user shows up late for other services too
+                if key is None or time.time() - self.users[key]["created"] \
+                        < self.settings["propagation"]:
+                    return 404, graphError("Request_ResourceNotFound",
+                                    "Resource '{0}' does not exist" \
+                                    .format(objectId))
+                if objectId in group["members"]:
+                    return 400, graphError("Request_BadRequest",
+                                "One or more added object references " \
+                                "already exist for the following " \
+                                "modified properties: 'members'.")
+                group["members"].add(objectId)
+                return 204, None
+
+            if method == 'DELETE' and len(parts) == 4:
+                objectId = parts[3].lower()
+                if objectId not in group["members"]:
+                    return 404, graphError("Request_ResourceNotFound",
+                                    "Resource '{0}' does not exist" \
+                                    .format(objectId))
+                group["members"].discard(objectId)
+                return 204, None
+
+        return 405, graphError("Request_BadRequest", "Bad method")
+
+    def deletedCall(self, method, parts, query):
+        """Answer a call on the recycle bin: the list of deleted users,
+        restoring one or deleting one for good"""
+
+        if not parts:
+            if method != 'GET':
+                return 405, graphError("Request_BadRequest", "Bad method")
+            size = min(int(query.get('$top', '100')), self.settings["page"])
+            after = query.get('$skiptoken', '')
+            with self.lock:
+                keys = sorted(key for key in self.deleted if key > after)
+                # Deleted users get their objectId in front of their UPN
+                users = [dict(self.deleted[key], userPrincipalName=key
+                                .replace('-', '') + self.deleted[key]
+                                ["userPrincipalName"])
+                            for key in keys[:size]]
+            select = query.get('$select', '')
+            result = {"value": [project(user, select) for user in users]}
+            if len(keys) > size:
+                result["odata.nextLink"] = "deletedDirectoryObjects?" + \
+                            urllib.urlencode({'$skiptoken': keys[size - 1]})
+            return 200, result
+
+        objectId = parts[0].lower()
+        with self.lock:
+            user = self.deleted.get(objectId)
+            if user is None:
+                return 404, graphError("Request_ResourceNotFound",
+                                        "Resource '{0}' does not exist" \
+                                        .format(objectId))
+
+            if method == 'DELETE' and len(parts) == 1:
+                del self.deleted[objectId]
+                self.deletedIds.pop(user.get("immutableId"), None)
+                return 204, None
+
+            if method == 'POST' and parts[1:] == ['restore']:
+                key = user["userPrincipalName"].lower()
+                if key in self.users:
+                    return 400, graphError("Request_BadRequest",
+                                    "Another object with the same value " \
+                                    "for property userPrincipalName " \
+                                    "already exists.")
+                del self.deleted[objectId]
+                self.deletedIds.pop(user.get("immutableId"), None)
+                self.users[key] = user
+                self.objectIds[objectId] = key
+                if user.get("immutableId"):
+                    self.immutableIds[user["immutableId"]] = key
+                # It gets its licenses back
+                for item in user["assignedLicenses"]:
+                    skuId = item.get("skuId")
+                    self.consumed[skuId] = self.consumed.get(skuId, 0) + 1
+                self.changes.append(objectId)
+                return 200, project(user, '')
+
+        return 405, graphError("Request_BadRequest", "Bad method")
+
+    def createUser(self, body):
+        """Create a user from the body of a POST"""
+
+        try:
+            user = json.loads(body)
+        except ValueError:
+            return 400, graphError("Request_BadRequest", "Invalid user")
+
+        if not isinstance(user, dict) or "userPrincipalName" not in user:
+            return 400, graphError("Request_BadRequest", "Invalid user")
+
+        if self.addUser(user) is None:
+            return 400, graphError("Request_BadRequest",
+                                    "Another object with the same value " \
+                                    "for property userPrincipalName or " \
+                                    "immutableId already exists.")
+
+        return 201, user
+
+    def updateUser(self, key, body):
+        """Change a user with the body of a PATCH"""
+
+        try:
+            changes = json.loads(body)
+        except ValueError:
+            return 400, graphError("Request_BadRequest", "Invalid body")
+
+        with self.lock:
+            newKey = changes.get("userPrincipalName", key).lower()
+            if newKey != key and newKey in self.users:
+                return 400, graphError("Request_BadRequest",
+                                        "Another object with the same " \
+                                        "value for property " \
+                                        "userPrincipalName already exists.")
+            user = self.users.pop(key)
+            self.immutableIds.pop(user.get("immutableId"), None)
+            user.update(changes)
+            self.users[newKey] = user
+            self.objectIds[user["objectId"]] = newKey
+            if user.get("immutableId"):
+                self.immutableIds[user["immutableId"]] = newKey
+            self.changes.append(user["objectId"])
+
+        return 204, None
+
+    def assignLicense(self, key, body):
+        """Add and remove licenses of a user"""
+
+        try:
+            request = json.loads(body)
+        except ValueError:
+            return 400, graphError("Request_BadRequest", "Invalid body")
+
+        with self.lock:
+            user = self.users[key]
+            # A new user shows up late in the license service
+            if time.time() - user["created"] < self.settings["propagation"]:
+                return 404, graphError("Request_ResourceNotFound",
+                                        "User not found")
+
+            seats = self.settings["seats"]
+            held = set(item.get("skuId") for item in user["assignedLicenses"])
+            for item in request.get("addLicenses") or []:
+                skuId = item.get("skuId")
+                if skuId not in seats:
+                    return 400, graphError("Request_BadRequest",
+                                "License {0} is not subscribed." \
+                                .format(skuId))
+                if skuId not in held and \
+                        self.consumed.get(skuId, 0) >= seats[skuId]:
+                    return 400, graphError("Request_BadRequest",
+                                "Subscription {0} does not have any " \
+                                "available licenses.".format(skuId))
+
+            removed = set(request.get("removeLicenses") or [])
+            licenses = [item for item in user["assignedLicenses"]
+                        if item.get("skuId") not in removed]
+            for item in request.get("addLicenses") or []:
+                licenses = [old for old in licenses
+                            if old.get("skuId") != item.get("skuId")]
+                licenses.append(item)
+            user["assignedLicenses"] = licenses
+
+            for skuId in held:
+                self.consumed[skuId] -= 1
+            for item in licenses:
+                skuId = item.get("skuId")
+                self.consumed[skuId] = self.consumed.get(skuId, 0) + 1
+            self.changes.append(user["objectId"])
+
+        return 200, user
+
+    def subscribedSkus(self):
+        """Get the subscribed licenses with their seats"""
+
+        with self.lock:
+            skus = [{
+                "skuId": skuId,
+                "skuPartNumber": skuId.upper(),
+                "capabilityStatus": "Enabled",
+                "consumedUnits": self.consumed.get(skuId, 0),
+                "prepaidUnits": {"enabled": seats, "suspended": 0,
+                                    "warning": 0}
+            } for skuId, seats in sorted(self.settings["seats"].items())]
+
+        return 200, {"value": skus}
+
+    def listUsers(self, query, tenant):
+        """Get a page of users in the order of their names"""
+
+        test = parseFilter(query.get('$filter', ''))
+        if test is None:
+            return 400, graphError("Request_UnsupportedQuery",
+                                    "Unsupported filter")
+
+        size = min(int(query.get('$top', '100')), self.settings["page"])
+        after = query.get('$skiptoken', '')
+
+        with self.lock:
+            keys = sorted(key for key in self.users if key > after)
+            users = []
+            for key in keys:
+                if test(self.users[key]):
+                    users.append(self.users[key])
+                    if len(users) > size:
+                        break
+
+        select = query.get('$select', '')
+        result = {"value": [project(user, select) for user in users[:size]]}
+
+        if len(users) > size:
+            last = users[size - 1]["userPrincipalName"].lower()
+            result["odata.nextLink"] = NEXTLINK_PATH + '?' + \
+                                        urllib.urlencode({'$skiptoken': last})
+
+        return 200, result
+
+    def delta(self, query, tenant):
+        """Get the users changed since a delta token, all of them for
+        the first query"""
+
+        token = query.get('deltaLink', '')
+
+        with self.lock:
+            if token == '':
+                users = self.users.values()
+                position = len(self.changes)
+            else:
+                try:
+                    position = int(token)
+                except ValueError:
+                    return 400, graphError("Directory_ExpiredPageToken",
+                                            "Expired delta token")
+                changed = set(self.changes[position:])
+                position = len(self.changes)
+                users = []
+                for objectId in changed:
+                    key = self.objectIds.get(objectId)
+                    if key is None:
+                        users.append({"objectId": objectId,
+                                        "aad.isDeleted": True})
+                    else:
+                        users.append(self.users[key])
+            users = [dict(user) for user in users]
+
+        link = "https://graph.windows.net/{0}/users?{1}".format(tenant,
+                    urllib.urlencode({'deltaLink': str(position)}))
+
+        return 200, {"value": users, "aad.deltaLink": link}
+
+
+class MockHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the calls of o365.py with the state of the tenant"""
+
+    protocol_version = 'HTTP/1.1'
+    # Send each answer in one piece, not header by header
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        """Keep quiet, the mock is called a lot"""
+
+        return
+
+    def do_GET(self):
+        self.answer('GET')
+
+    def do_POST(self):
+        self.answer('POST')
+
+    def do_PATCH(self):
+        self.answer('PATCH')
+
+    def do_DELETE(self):
+        self.answer('DELETE')
+
+    def answer(self, method):
+        """Answer one call, injecting the configured failures"""
+
+        started = time.time()
+        tenant = self.server.tenant
+        settings = self.server.settings
+
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = self.rfile.read(length) if length else ''
+
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        tenant.count("calls")
+
+        if url.path == '/_stats':
+            self.send(200, 'application/json', json.dumps(tenant.stats()))
+            return
+
+        wait = settings["latency"] + random.random() * settings["jitter"]
+        if wait:
+            time.sleep(wait)
+
+        if url.path.endswith('/oauth2/token'):
+            status, result = tenant.login()
+            self.send(status, 'application/json', json.dumps(result))
+            tenant.count("status {0}".format(status))
+            return
+
+        if not tenant.authorized(self.headers.getheader('Authorization')):
+            tenant.count("status 401")
+            self.send(401, 'application/json', json.dumps(graphError(
+                        "Authentication_ExpiredToken", "Invalid token")))
+            return
+
+        if random.random() < settings["drop"]:
+            tenant.count("dropped")
+            self.close_connection = 1
+            return
+
+        failure = injectFailure(settings)
+        if failure:
+            status, headers, result = failure
+        elif url.path.endswith('/$batch'):
+            tenant.count("batches")
+            status, headers, result = self.batch(body)
+        else:
+            status, result = tenant.call(method, url.path, query, body)
+            headers = {}
+            if result is not None:
+                result = json.dumps(result)
+
+        tenant.count("status {0}".format(status))
+        self.send(status, headers.pop('Content-Type', 'application/json'),
+                    result or '', headers)
+        tenant.took(time.time() - started)
+
+        return
+
+    def batch(self, body):
+        """Answer each part of a $batch call in a multipart response"""
+
+        tenant = self.server.tenant
+        contentType = self.headers.getheader('Content-Type', '')
+        requests = parseBatch(body, contentType)
+        if requests is None:
+            return 400, {}, json.dumps(graphError("Request_BadRequest",
+                                                    "Invalid batch"))
+
+        boundary = "batchresponse_" + uuid.uuid4().hex
+        lines = []
+
+        for method, url, partBody in requests:
+            tenant.count("batch parts")
+            failure = injectFailure(self.server.settings)
+            if failure:
+                status, headers, result = failure
+            else:
+                url = urlparse.urlparse(url)
+                query = dict(urlparse.parse_qsl(url.query,
+                                                keep_blank_values=True))
+                status, result = tenant.call(method, url.path, query,
+                                                partBody)
+                headers = {}
+                if result is not None:
+                    result = json.dumps(result)
+
+            lines.append("--" + boundary)
+            lines.append("Content-Type: application/http")
+            lines.append("Content-Transfer-Encoding: binary")
+            lines.append("")
+            lines.append("HTTP/1.1 {0} {1}".format(status,
+                            BaseHTTPServer.BaseHTTPRequestHandler \
+                            .responses.get(status, ('Unknown',))[0]))
+            for name, value in headers.items():
+                lines.append("{0}: {1}".format(name, value))
+            lines.append("Content-Type: application/json")
+            lines.append("")
+            lines.append(result or '')
+
+        lines.append("--" + boundary + "--")
+        lines.append("")
+
+        return 202, {'Content-Type': "multipart/mixed; boundary=" +
+                        boundary}, "\r\n".join(lines)
+
+    def send(self, status, contentType, data, headers=None):
+        """Send an answer with a body, gzipped if the client asks"""
+
+        accept = self.headers.getheader('Accept-Encoding') or ''
+        if data and 'gzip' in accept.lower():
+            packer = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = packer.compress(data) + packer.flush()
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.server.tenant.count("bytes sent", len(data))
+
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+        return
+
+
+def injectFailure(settings):
+    """This function draws a 429 or 503 answer with the configured odds,
+    returns None if the call goes through"""
+
+    draw = random.random()
+    headers = {'Retry-After': str(settings["retry_after"])}
+
+    if draw < settings["throttle"]:
+        return 429, headers, json.dumps(graphError(
+                    "Request_ThrottledTemporarily", "Too many requests"))
+    if draw < settings["throttle"] + settings["fail"]:
+        return 503, headers, json.dumps(graphError(
+                    "Service_InternalServerError", "Service unavailable"))
+
+    return None
+
+
+def parseBatch(body, contentType):
+    """This function gets the (method, url, body) of each part of a
+    multipart $batch body, with changesets unpacked in place"""
+
+    boundary = ''
+    for param in contentType.split(';'):
+        param = param.strip()
+        if param.startswith('boundary='):
+            boundary = param[len('boundary='):].strip('"')
+    if not boundary:
+        return None
+
+    requests = []
+
+    for part in body.split("--" + boundary)[1:]:
+        if part.startswith("--"):
+            break
+
+        headers, _, content = part.lstrip("\r\n").partition("\r\n\r\n")
+        partType = ''
+        for line in headers.split("\r\n"):
+            name, _, value = line.partition(':')
+            if name.strip().lower() == 'content-type':
+                partType = value.strip()
+
+        if partType.startswith('multipart/mixed'):
+            inner = parseBatch(content, partType)
+            if inner is None:
+                return None
+            requests.extend(inner)
+            continue
+
+        head, _, partBody = content.partition("\r\n\r\n")
+        request = head.split("\r\n")[0].split(" ")
+        if len(request) < 2:
+            return None
+        requests.append((request[0], request[1], partBody.rstrip("\r\n")))
+
+    return requests
+
+
+def parseFilter(text):
+    """This function turns a simple $filter into a test of a user,
+    returns None if the filter is not supported"""
+
+    if not text:
+        return lambda user: True
+
+    # A filter narrowed to one segment of the user names
+    match = AND.match(text)
+    if match:
+        first = parseFilter(match.group(1))
+        second = parseFilter(match.group(2))
+        if first is None or second is None:
+            return None
+        return lambda user: first(user) and second(user)
+
+    match = STARTSWITH.match(text)
+    if match:
+        field, value = match.groups()
+        value = value[1:-1].replace("''", "'").lower()
+        return lambda user: (user.get(field) or '').lower() \
+                                .startswith(value)
+
+    match = FILTER.match(text)
+    if not match:
+        return None
+
+    field, value = match.groups()
+    if value in ('true', 'false'):
+        value = value == 'true'
+    else:
+        value = value[1:-1].replace("''", "'")
+
+    return lambda user: user.get(field) == value
+
+
+def project(user, select):
+    """This function keeps only the $select fields of a user"""
+
+    user = dict((name, value) for name, value in user.items()
+                if name != "created")
+    if not select:
+        return user
+
+    fields = [field.strip() for field in select.split(',')]
+
+    return dict((field, user.get(field)) for field in fields)
+
+
+def graphError(code, message):
+    """This function builds a Graph API error object"""
+
+    return {"odata.error": {"code": code, "message": {"lang": "en",
+                                                    "value": message}}}
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -19,3 +19,70 @@ STULICENSE = ''
 EMPLICENSE = ''
 # Disabled plans, e.g. skuId of MCOSTANDARD and EXCHANGE_S_STANDARD
 DISABLEDPLANS = ['', '']
+# Max number of keep-alive connections per host, a run raises it to the
+# number of its workers plus two, so it never holds back MAXWORKERS
+POOLSIZE = 4
+# Seconds an idle connection is kept before it is re-opened
+POOLIDLE = 60
+# Socket timeout in seconds
+POOLTIMEOUT = 60
+# Max number of parallel workers, keep it under the throttling limits
+MAXWORKERS = 8
+# Max number of requests in a $batch request (Graph API allows 5)
+BATCHSIZE = 5
+# Seconds to wait for more requests before a batch is sent
+BATCHWAIT = 0.05
+# Local replica of the o365 users used with --replica
+REPLICAFILE = 'o365replica.db'
+# Seconds after which the replica is synced again with a delta query
+REPLICAMAXAGE = 300
+# Seconds after which the daemon or an O365Client loads the users, license
+# seats and deleted users again
+CLIENTREFRESH = 300
+# Seconds before the access token expires when it is renewed
+TOKENMARGIN = 300
+# File to keep the access token in between runs, e.g. .o365token
+# (readable only by its owner), leave empty to log in every run
+TOKENCACHE = ''
+# Calls per second to start with, the rate then adapts to throttling
+# between RATEMIN and RATEMAX
+RATELIMIT = 10
+RATEMIN = 1
+RATEMAX = 100
+# Times a throttled or failed call is tried again
+MAXRETRIES = 5
+# Backoff in seconds for the first re-try and the longest backoff
+BACKOFFBASE = 1
+BACKOFFMAX = 60
+# Seconds to wait before licenses are assigned to a new user
+LICENSEDELAY = 2
+# Times a license assignment is tried again while the new user is not
+# ready for it, throttled and failed calls have MAXRETRIES of their own
+LICENSERETRIES = 5
+# Seconds group membership changes wait for more to share a $batch request
+GROUPDELAY = 1
+# Number of segments of all users that list and --prefetch page at the same
+# time (1 pages all users one after another) and the segments, by the
+# first characters of the user names, each character is one segment or
+# give a list of prefixes that do not overlap. Every segment costs at 
+# least one call, so this only pays off with some 100000 users or more.
+# Each segment is sorted in memory, LISTWORKERS * 2 segments at most
+LISTWORKERS = 1
+SEGMENTS = "abcdefghijklmnopqrstuvwxyz0123456789'.-_!#^~"
+# Hosts of the Graph API and the MSFT login service, e.g. 'localhost:8765'
+# with USEHTTPS = False to run against o365mock.py
+GRAPHHOST = 'graph.windows.net'
+LOGINHOST = 'login.windows.net'
+USEHTTPS = True
+# Other tenants, e.g. affiliates, by name with the settings they do not
+# share with the tenant above, e.g.
+# {'affiliate': {'O365DOMAIN': 'affiliate.edu', 'CLIENT_ID': '',
+#                'CLIENT_KEY': '', 'STULICENSE': '', 'EMPLICENSE': ''}}
+# Rows pick one with "tenant": "affiliate"
+TENANTS = {}
+# Count the free seats of the licenses from subscribedSkus and fail
+# creates right away when a license has no seats left
+SEATCHECK = True
+# Restore a deleted user from the recycle bin when a create row has its
+# UDCid, instead of failing on the immutableId it still holds
+RESTOREDELETED = True
@@ -0,0 +1,1128 @@
+#!/usr/bin/env python
+
+"""
+Tests of o365.py against the local o365mock.py, no tenant or network
+needed.
+
+Usage:
+    python -m unittest -v o365test
+
+The tests of whole runs start o365.py in its own process on a small
+feed against a fresh mock, with the settings of o365bench.py. The
+others call its functions in this process.
+"""
+
+from __future__ import print_function
+import time
+import sys
+import os
+import csv
+import json
+import signal
+import logging
+import socket
+import httplib
+import threading
+import SocketServer
+import BaseHTTPServer
+import shutil
+import subprocess
+import tempfile
+import StringIO
+import urlparse
+import unittest
+
+import o365
+import o365mock
+import o365bench
+
+# The tests that run o365.py in this process do not need its log
+logging.getLogger().addHandler(logging.NullHandler())
+
+
+class O365TestCase(unittest.TestCase):
+    """Work directory and mock of a test"""
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='o365test')
+        self.server = None
+        o365.QUIET = True
+
+    def tearDown(self):
+        if self.server is not None:
+            o365mock.stopMock(self.server)
+        o365.closePools()
+        o365.POOLS.clear()
+        o365.QUIET = False
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def startMock(self, settings='', **options):
+        """Start a fresh mock and write the settings that point to it,
+        with more settings of o365.py if given"""
+
+        self.server = o365mock.startMock(0, **options)
+        host = "127.0.0.1:{0}".format(self.server.server_address[1])
+        self.writeConfig("GRAPHHOST = '{0}'\nLOGINHOST = '{0}'\n" \
+                            .format(host) + settings)
+
+        return self.server
+
+    def writeConfig(self, settings=''):
+        """Write the settings of the benchmark with more settings,
+        named after the work directory so each test imports its own"""
+
+        self.config = os.path.join(self.workdir,
+                                    os.path.basename(self.workdir) + ".py")
+        with open(self.config, 'w') as f_config:
+            f_config.write(o365bench.SETTINGS)
+            f_config.write(settings)
+
+    def readConfig(self, settings=''):
+        """Set the globals of o365.py from the settings in this process"""
+
+        if settings or not hasattr(self, 'config'):
+            self.writeConfig(settings)
+        self.assertTrue(o365.readConfig(self.config))
+
+    def writeFeed(self, rows):
+        """Write rows to an ndjson feed and return its path"""
+
+        path = os.path.join(self.workdir, "feed.jsonl")
+        with open(path, 'w') as f_feed:
+            for row in rows:
+                f_feed.write(json.dumps(row) + "\n")
+
+        return path
+
+    def startRun(self, feed, out, *args):
+        """Start o365.py on a feed and return its process"""
+
+        return self.startScript("-f", feed, "-o", out, *args)
+
+    def startScript(self, *args):
+        """Start o365.py with the settings and return its process"""
+
+        command = [sys.executable,
+                    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'o365.py'),
+                    "--config", self.config]
+        command.extend(args)
+
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.Popen(command, cwd=self.workdir,
+                                    stdout=devnull,
+                                    stderr=subprocess.STDOUT)
+
+    def readOutput(self, out):
+        """Get the lines of an output file without its header"""
+
+        with open(out, 'rb') as f_out:
+            return [line for line in csv.reader(f_out)][1:]
+
+
+def countLines(path):
+    """Count the lines of a file, 0 if it is not there yet"""
+
+    try:
+        with open(path, 'rb') as f_in:
+            return sum(1 for _ in f_in)
+    except IOError:
+        return 0
+
+
+class ResumeTest(O365TestCase):
+
+    def test_stopped_worker_run_resumes(self):
+        """A worker run stopped mid-flight journals every row it ran,
+        so --resume runs each of the other rows exactly once"""
+
+        server = self.startMock(latency=0.05)
+        size = 40
+        feed = self.writeFeed([o365bench.newUser("test{0}".format(number))
+                                for number in range(size)])
+        out = os.path.join(self.workdir, "out.csv")
+        journal = out + ".journal"
+
+        process = self.startRun(feed, out, "-w", "4")
+        # The first line of the journal is the fingerprint
+        deadline = time.time() + 30
+        while countLines(journal) < 6 and time.time() < deadline:
+            time.sleep(0.01)
+        process.send_signal(signal.SIGTERM)
+        process.wait()
+
+        journaled = countLines(journal) - 1
+        self.assertTrue(0 < journaled < size)
+        # Every user the stopped run created has its row journaled
+        self.assertEqual(server.tenant.stats()["users"], journaled)
+
+        process = self.startRun(feed, out, "-w", "4", "--resume")
+        process.wait()
+
+        lines = self.readOutput(out)
+        self.assertEqual(len(lines), size)
+        for line in lines:
+            self.assertTrue(line[2].startswith("SUCCESS"), line)
+        self.assertEqual(server.tenant.stats()["users"], size)
+
+    def test_resume_of_other_input_keeps_output(self):
+        """--resume with an input the journal is not of fails and
+        leaves the output of the earlier run alone"""
+
+        self.startMock()
+        feed = self.writeFeed([o365bench.newUser("testa")])
+        out = os.path.join(self.workdir, "out.csv")
+        self.startRun(feed, out).wait()
+        with open(out, 'rb') as f_out:
+            before = f_out.read()
+
+        feed = self.writeFeed([o365bench.newUser("testb")])
+        process = self.startRun(feed, out, "--resume")
+
+        self.assertNotEqual(process.wait(), 0)
+        with open(out, 'rb') as f_out:
+            self.assertEqual(f_out.read(), before)
+
+
+class DaemonTest(O365TestCase):
+
+    def test_stopped_daemon_sends_back_rows_in_flight(self):
+        """A SIGTERM to the daemon in the middle of a batch still sends
+        back the line of every row it ran"""
+
+        server = self.startMock(latency=0.05)
+        size = 40
+        feed = self.writeFeed([o365bench.newUser("test{0}".format(number))
+                                for number in range(size)])
+        out = os.path.join(self.workdir, "out.csv")
+        address = os.path.join(self.workdir, "o365.sock")
+
+        daemon = self.startScript("--serve", address, "-w", "4")
+        deadline = time.time() + 30
+        while not os.path.exists(address) and time.time() < deadline:
+            time.sleep(0.01)
+        sender = self.startRun(feed, out, "--send", address)
+        while server.tenant.stats()["users"] < 5 \
+                and time.time() < deadline:
+            time.sleep(0.01)
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait()
+        sender.wait()
+
+        created = server.tenant.stats()["users"]
+        self.assertTrue(0 < created < size)
+        lines = self.readOutput(out)
+        self.assertEqual(len(lines), created)
+        for line in lines:
+            self.assertTrue(line[2].startswith("SUCCESS"), line)
+        self.assertFalse(os.path.exists(address))
+
+
+class RestoreTest(O365TestCase):
+
+    def test_restore_waits_for_delete_of_same_udcid(self):
+        """A create that restores a user deleted earlier in the run
+        waits for that delete, also with workers, batches and shards"""
+
+        for args in (["-w", "4"], ["-w", "4", "-b", "-p"], ["-s", "2"]):
+            server = self.startMock(latency=0.02)
+            first = o365bench.newUser("testa")
+            second = o365bench.newUser("testb")
+            second["UDCid"] = first["UDCid"]
+            feed = self.writeFeed([first,
+                                    {"action": "delete", "username": "testa"},
+                                    second])
+            out = os.path.join(self.workdir, "out.csv")
+
+            self.startRun(feed, out, *args).wait()
+
+            results = [line[2] for line in self.readOutput(out)]
+            self.assertEqual(results,
+                                ["SUCCESS: user was created in o365.",
+                                "SUCCESS: user deleted in o365.",
+                                "SUCCESS: user was restored in o365."],
+                                args)
+            o365mock.stopMock(server)
+            self.server = None
+
+
+class ListTest(O365TestCase):
+
+    def test_segmented_list_has_every_user_once(self):
+        """A list in segments writes every user into the file once,
+        sorted by name"""
+
+        server = self.startMock("LISTWORKERS = 4\n", users=3000, page=100)
+        for name in ("zeta", "alpha", "0number"):
+            server.tenant.addUser({"userPrincipalName": name + "@test.edu",
+                                    "accountEnabled": True,
+                                    "mailNickname": name})
+        users = os.path.join(self.workdir, "users.csv")
+        feed = self.writeFeed([{"action": "list", "username": "list",
+                                "select": "userPrincipalName,department",
+                                "outfile": users}])
+        out = os.path.join(self.workdir, "out.csv")
+
+        self.startRun(feed, out).wait()
+
+        self.assertEqual(self.readOutput(out)[0][2],
+                            "SUCCESS: got the list of o365 users.")
+        names = [line[0] for line in self.readOutput(users)]
+        self.assertEqual(len(names), 3003)
+        self.assertEqual(names, sorted(set(names)))
+
+
+class SegmentTest(O365TestCase):
+
+    # Pages of each segment, out of order and with a user twice
+    PAGES = {
+        "a": [["ab", "aa"], ["aa", "ac"]],
+        "b": [["bb"], ["ba"]],
+        "c": []
+    }
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.readConfig("LISTWORKERS = 2\nSEGMENTS = 'cab'\n")
+        self.getUserPages = o365.getUserPages
+        o365.getUserPages = self.segmentPages
+
+    def tearDown(self):
+        o365.getUserPages = self.getUserPages
+        O365TestCase.tearDown(self)
+
+    def segmentPages(self, params, headers):
+        test = urlparse.parse_qs(params)["$filter"][0]
+        for page in self.PAGES[test.split("'")[1]]:
+            yield [{"userPrincipalName": name + "@test.edu"}
+                    for name in page]
+
+    def test_segments_merge_sorted_without_duplicates(self):
+        """Users of all segments come out once each, sorted by name"""
+
+        names = [user["userPrincipalName"] for page
+                    in o365.getSegmentPages({}, {}) for user in page]
+
+        self.assertEqual(names, ["aa@test.edu", "ab@test.edu",
+                                "ac@test.edu", "ba@test.edu",
+                                "bb@test.edu"])
+
+    def test_stopped_list_lets_the_readers_go(self):
+        """Closing the pages early stops and joins the readers"""
+
+        threads = threading.active_count()
+        pages = o365.getSegmentPages({}, {})
+
+        next(pages)
+        pages.close()
+
+        self.assertEqual(threading.active_count(), threads)
+
+
+class SeatTest(O365TestCase):
+
+    def test_delete_of_licensed_user_frees_its_seat(self):
+        """Deleting a user that had a license before the run frees its
+        seat for a create, also with the prefetched users or replica"""
+
+        for args in (["-p"], ["-r"], []):
+            server = self.startMock(seats={"sku-stu": 10, "sku-emp": 1})
+            user = o365bench.newUser("testold")
+            server.tenant.addUser({
+                "userPrincipalName": "testold@test.edu",
+                "accountEnabled": True,
+                "immutableId": user["UDCid"],
+                "mailNickname": "testold",
+                "assignedLicenses": [{"skuId": "sku-emp",
+                                        "disabledPlans": []}]
+            })
+            server.tenant.consumed["sku-emp"] = 1
+            feed = self.writeFeed([{"action": "delete",
+                                    "username": "testold"},
+                                    o365bench.newUser("testnew")])
+            out = os.path.join(self.workdir, "out.csv")
+
+            self.startRun(feed, out, *args).wait()
+
+            results = [line[2] for line in self.readOutput(out)]
+            self.assertEqual(results, ["SUCCESS: user deleted in o365.",
+                                        "SUCCESS: user was created in o365."],
+                                args)
+            o365mock.stopMock(server)
+            self.server = None
+
+
+class LicenseTest(O365TestCase):
+
+    def test_licenses_of_deleted_user_are_no_failure(self):
+        """Licenses dropped because the user was deleted before it got
+        them are not reported as a failed assignment"""
+
+        self.startMock("LICENSEDELAY = 1\n")
+        feed = self.writeFeed([o365bench.newUser("testa"),
+                                {"action": "delete", "username": "testa"}])
+        out = os.path.join(self.workdir, "out.csv")
+
+        self.startRun(feed, out).wait()
+
+        results = [line[2] for line in self.readOutput(out)]
+        self.assertEqual(results, ["SUCCESS: user was created in o365, "
+                                    "deleted before it got licenses.",
+                                    "SUCCESS: user deleted in o365."])
+        with open(os.path.join(self.workdir, "o365.log")) as f_log:
+            log = f_log.read()
+        self.assertNotIn("licenses not assigned", log)
+        self.assertIn("licenses of deleted users dropped: 1", log)
+
+
+class LogTest(O365TestCase):
+
+    def test_json_log_is_the_only_log(self):
+        """A JSON log run writes o365.jsonl and no empty o365.log, and
+        its metrics have percentiles of the calls themselves"""
+
+        self.startMock(latency=0.01, jitter=0.02)
+        feed = self.writeFeed([o365bench.newUser("test{0}".format(number))
+                                for number in range(20)])
+        out = os.path.join(self.workdir, "out.csv")
+        metrics = os.path.join(self.workdir, "metrics.json")
+
+        self.startRun(feed, out, "--log-format", "json",
+                        "-m", metrics).wait()
+
+        self.assertTrue(os.path.exists(os.path.join(self.workdir,
+                                                    "o365.jsonl")))
+        self.assertFalse(os.path.exists(os.path.join(self.workdir,
+                                                        "o365.log")))
+        with open(metrics) as f_metrics:
+            snapshot = json.load(f_metrics)
+        create = snapshot["ops"]["create"]
+        self.assertTrue(0.01 <= create["p50"] <= create["p99"] <= 0.1,
+                        create)
+
+
+class PartsTest(O365TestCase):
+
+    def test_tenant_parts_use_their_replicas(self):
+        """Each tenant of a mixed run looks up users in its own replica"""
+
+        self.startMock("TENANTS = {'other': {'O365DOMAIN': 'other.edu'}}\n")
+        other = o365bench.newUser("testother")
+        other["tenant"] = "other"
+        feed = self.writeFeed([o365bench.newUser("testmain"), other])
+        out = os.path.join(self.workdir, "out.csv")
+
+        self.startRun(feed, out, "-r").wait()
+
+        results = [line[2] for line in self.readOutput(out)]
+        self.assertEqual(results, ["SUCCESS: user was created in o365."] * 2)
+        for name in ("o365replica.db", "o365replica.db.other"):
+            self.assertTrue(os.path.exists(os.path.join(self.workdir, name)),
+                            name)
+
+    def test_sharded_audit_keeps_every_line(self):
+        """An audit in a shard keeps the line of every user it audited
+        before its own line, in input order"""
+
+        self.startMock(users=5)
+        feed = self.writeFeed([o365bench.newUser("testa"),
+                                {"action": "audit-licenses",
+                                "username": "audit"},
+                                o365bench.newUser("testb")])
+        out = os.path.join(self.workdir, "out.csv")
+
+        self.assertEqual(self.startRun(feed, out, "-s", "2").wait(), 0)
+
+        lines = self.readOutput(out)
+        self.assertEqual(lines[0], ["create", "testa",
+                                    "SUCCESS: user was created in o365."])
+        self.assertEqual(lines[-1], ["create", "testb",
+                                    "SUCCESS: user was created in o365."])
+        audit = lines[1:-1]
+        self.assertTrue(audit[-1][2].startswith(
+                        "SUCCESS: audited {0} users".format(len(audit) - 1)),
+                        audit)
+        self.assertTrue(len(audit) > 5, audit)
+        for line in audit:
+            self.assertEqual(line[0], "audit-licenses")
+
+    def test_resync_with_shards_is_refused(self):
+        """Shards would all fill their shared replica from scratch"""
+
+        self.startMock()
+        feed = self.writeFeed([o365bench.newUser("testmain")])
+        out = os.path.join(self.workdir, "out.csv")
+
+        self.startRun(feed, out, "-s", "2", "--resync").wait()
+
+        self.assertFalse(os.path.exists(out))
+
+    def test_purge_with_shards_is_refused(self):
+        """Shards cannot wait for each other, so purge is no barrier"""
+
+        self.startMock()
+        feed = self.writeFeed([o365bench.newUser("testmain"),
+                                {"action": "purge", "username": "recyclebin"}])
+        out = os.path.join(self.workdir, "out.csv")
+
+        process = self.startRun(feed, out, "-s", "2")
+
+        self.assertNotEqual(process.wait(), 0)
+        self.assertFalse(os.path.exists(out))
+        self.assertEqual(self.server.tenant.stats()["users"], 0)
+
+
+class Response(object):
+    """Stands in for the response of a Graph API call"""
+
+    def __init__(self, status):
+        self.status = status
+
+
+class UpdateTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.readConfig()
+        o365.ACCESS_TOKEN = "token"
+        self.users = {}
+        self.calls = []
+        self.getUser = o365.getUser
+        self.graphRequest = o365.graphRequest
+        o365.getUser = lambda upn, select=None: self.users.get(upn)
+        o365.graphRequest = self.sendRequest
+
+    def tearDown(self):
+        o365.getUser = self.getUser
+        o365.graphRequest = self.graphRequest
+        O365TestCase.tearDown(self)
+
+    def sendRequest(self, method, url, body="", headers=None, op="other"):
+        self.calls.append((method, json.loads(body)))
+        return Response(204), ""
+
+    def update(self, newusername="testa", **fields):
+        row = userRow("update", "testa", newusername, **fields)
+        return o365.update(row["username"], row["newusername"],
+                            row["loginDisabled"], row["givenName"],
+                            row["fullName"], row["sn"], row["primO"])
+
+    def test_failed_lookup_changes_nothing(self):
+        """A user that could not be looked up is not patched"""
+
+        self.users["testa@test.edu"] = {}
+
+        self.assertEqual(self.update(),
+                            "ERROR: could not look up user in o365.")
+        self.assertEqual(self.calls, [])
+
+    def test_failed_check_of_new_name_is_no_taken_name(self):
+        """A new name that could not be looked up is not reported as
+        taken and the user is not renamed"""
+
+        self.users["testa@test.edu"] = {"objectId": "1"}
+        self.users["testb@test.edu"] = {}
+
+        self.assertEqual(self.update("testb"), "ERROR: could not check if "
+                            "the new username is taken in o365.")
+        self.assertEqual(self.calls, [])
+
+    def test_rename_sends_only_changes(self):
+        """A rename to a free name patches only what changed"""
+
+        row = userRow("update", "testa")
+        self.users["testa@test.edu"] = {
+            "userPrincipalName": "testa@test.edu",
+            "accountEnabled": True,
+            "givenName": row["givenName"],
+            "displayName": row["fullName"],
+            "surname": row["sn"],
+            "mailNickname": "testa",
+            "department": row["primO"]
+        }
+        self.users["testc@test.edu"] = {"objectId": "2"}
+
+        self.assertEqual(self.update("testc"),
+                            "ERROR: username already taken!")
+        self.assertEqual(self.update("testb"),
+                            "SUCCESS: user was updated in o365.")
+        self.assertEqual(self.calls, [("PATCH", {
+                            "userPrincipalName": "testb@test.edu",
+                            "mailNickname": "testb"})])
+
+
+class ReplicaTest(O365TestCase):
+
+    def test_rename_onto_a_stale_name_replaces_it(self):
+        """A rename onto a name the replica still has for another user
+        replaces that user"""
+
+        replica = o365.DirectoryReplica(os.path.join(self.workdir,
+                                                    "replica.db"))
+        try:
+            replica.add("testa@test.edu", {"objectId": "1"})
+            replica.add("testb@test.edu", {"objectId": "2"})
+
+            replica.update("testa@test.edu", "testb@test.edu",
+                            {"mailNickname": "testb"})
+
+            self.assertEqual(len(replica), 1)
+            self.assertIsNone(replica.get("testa@test.edu"))
+            self.assertEqual(replica.get("testb@test.edu").objectId, "1")
+        finally:
+            replica.close()
+
+
+class ReauthTest(O365TestCase):
+
+    def test_rejected_token_of_queued_changes_logs_in_again(self):
+        """Changes sent by the queues log in again once their token is
+        rejected, on their own and in a $batch"""
+
+        server = self.startMock(users=2)
+        self.readConfig()
+        self.assertTrue(o365.graphConnect())
+
+        for count in (1, 2):
+            token = o365.ACCESS_TOKEN
+            # Revoke the tokens the mock gave out
+            server.tenant.tokens.clear()
+            requests = [o365.licenseRequest(
+                        server.tenant.users["mockuser{0}@test.edu" \
+                                            .format(number)]["objectId"],
+                        o365.licenseBody(["sku-stu"]))
+                        for number in range(count)]
+
+            o365.postRequests(requests, "assignLicense")
+
+            self.assertEqual([request["response"][0].status
+                                for request in requests], [200] * count)
+            self.assertNotEqual(o365.ACCESS_TOKEN, token)
+
+
+class DropHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers keep-alive requests, but drops the connection instead
+    of answering the second one"""
+
+    protocol_version = "HTTP/1.1"
+
+    def answer(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        self.server.requests += 1
+        if self.server.requests == 2:
+            self.close_connection = 1
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write("{}")
+
+    do_GET = do_POST = answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DropServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+
+class PoolTest(O365TestCase):
+
+    def sendTwice(self, method):
+        """Send two requests over one pooled connection to a server
+        that drops the second, returns the result of the second"""
+
+        server = DropServer(('127.0.0.1', 0), DropHandler)
+        server.requests = 0
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        host = "127.0.0.1:{0}".format(server.server_address[1])
+
+        try:
+            response, _ = o365.httpRequest(host, method, "/", "{}")
+            self.assertEqual(response.status, 200)
+            try:
+                response, _ = o365.httpRequest(host, method, "/", "{}")
+            except (httplib.HTTPException, socket.error):
+                response = None
+            return response, server.requests
+        finally:
+            o365.closePools()
+            server.shutdown()
+            server.server_close()
+
+    def test_dropped_post_is_not_sent_again(self):
+        """A POST the server may have done is not sent twice"""
+
+        self.readConfig()
+
+        response, requests = self.sendTwice("POST")
+
+        self.assertIsNone(response)
+        self.assertEqual(requests, 2)
+
+    def test_dropped_get_is_sent_again(self):
+        """A GET on a dropped keep-alive connection goes again on a
+        fresh one"""
+
+        self.readConfig()
+
+        response, requests = self.sendTwice("GET")
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(requests, 3)
+
+
+class BatchHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers a $batch request with the status and body of the server
+    and other requests with 200"""
+
+    protocol_version = "HTTP/1.1"
+
+    def answer(self):
+        self.rfile.read(int(self.headers.getheader('Content-Length') or 0))
+        if "$batch" in self.path:
+            self.server.batches += 1
+            status, data = self.server.status, self.server.data
+        else:
+            self.server.single.append(self.command)
+            status, data = 200, "{}"
+        self.send_response(status)
+        self.send_header('Content-Type',
+                        'multipart/mixed; boundary=batchresponse_1')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = answer
+
+    def log_message(self, format, *args):
+        pass
+
+
+# A $batch response with a plain part and a changeset
+BATCHRESPONSE = "\r\n".join([
+    "--batchresponse_1",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "",
+    "HTTP/1.1 200 OK",
+    "Content-Type: application/json",
+    "",
+    '{"objectId": "1"}',
+    "--batchresponse_1",
+    "Content-Type: multipart/mixed; boundary=changesetresponse_2",
+    "",
+    "--changesetresponse_2",
+    "Content-Type: application/http",
+    "Content-Transfer-Encoding: binary",
+    "",
+    "HTTP/1.1 429 Too Many Requests",
+    "Retry-After: 3",
+    "",
+    "",
+    "--changesetresponse_2--",
+    "--batchresponse_1--",
+    ""])
+
+
+class BatchTest(O365TestCase):
+
+    def batchItems(self):
+        return [{"method": "GET", "url": "/users/testa", "body": "",
+                "headers": {}},
+                {"method": "POST", "url": "/users", "body": '{"a": 1}',
+                "headers": {'Content-Type': 'application/json'}}]
+
+    def test_batch_puts_changes_in_changesets(self):
+        """Queries are plain parts and each change is a changeset"""
+
+        self.readConfig()
+
+        data = o365.buildBatch(self.batchItems(), "batch_1")
+
+        parts = data.split("--batch_1")
+        self.assertEqual(len(parts), 4)
+        self.assertIn("GET https://{0}/users/testa HTTP/1.1" \
+                        .format(o365.GRAPH_HOST), parts[1])
+        self.assertNotIn("changeset", parts[1])
+        self.assertIn("Content-Type: multipart/mixed; boundary=changeset_",
+                        parts[2])
+        self.assertIn("POST https://{0}/users HTTP/1.1" \
+                        .format(o365.GRAPH_HOST), parts[2])
+        self.assertIn('{"a": 1}', parts[2])
+        self.assertEqual(parts[3], "--\r\n")
+
+    def test_batch_response_unpacks_changesets(self):
+        """Responses in changesets come out in place, with headers"""
+
+        parts = o365.parseMultipart(BATCHRESPONSE,
+                        'multipart/mixed; boundary="batchresponse_1"')
+
+        self.assertEqual([part[0].status for part in parts], [200, 429])
+        self.assertEqual(parts[0][1], '{"objectId": "1"}')
+        self.assertEqual(parts[1][0].getheader('Retry-After'), '3')
+        self.assertEqual(o365.parseMultipart(BATCHRESPONSE, 'text/plain'),
+                        [])
+
+    def submitBoth(self, status, data=""):
+        """Submit a GET and a POST that share a batch the server answers
+        with status and data, returns their results and the requests
+        the server got on their own"""
+
+        server = DropServer(('127.0.0.1', 0), BatchHandler)
+        server.batches = 0
+        server.single = []
+        server.status, server.data = status, data
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.readConfig("GRAPHHOST = '127.0.0.1:{0}'\n" \
+                        .format(server.server_address[1]))
+
+        batcher = o365.RequestBatcher(2, 1, 1)
+        results = {}
+
+        def submit(item):
+            try:
+                results[item["method"]] = batcher.submit(item["method"],
+                                item["url"], item["body"], item["headers"])
+            except httplib.HTTPException as e:
+                results[item["method"]] = e
+
+        threads = [threading.Thread(target=submit, args=(item,))
+                    for item in self.batchItems()]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            batcher.stop()
+            o365.closePools()
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(server.batches, 1)
+        return results, sorted(server.single)
+
+    def test_turned_down_batch_is_sent_again(self):
+        """A batch that Graph API did not run goes again request by
+        request"""
+
+        results, single = self.submitBoth(400)
+
+        self.assertEqual(single, ["GET", "POST"])
+        self.assertEqual(results["POST"][0].status, 200)
+
+    def test_unmatched_batch_does_not_post_twice(self):
+        """The POST of a batch that may have run fails instead of going
+        again, the GET goes again"""
+
+        results, single = self.submitBoth(200, "\r\n".join([
+                            "--batchresponse_1",
+                            "Content-Type: application/http", "",
+                            "HTTP/1.1 200 OK", "", "{}",
+                            "--batchresponse_1--", ""]))
+
+        self.assertEqual(single, ["GET"])
+        self.assertEqual(results["GET"][0].status, 200)
+        self.assertIsInstance(results["POST"], httplib.HTTPException)
+
+
+class ReadRowsTest(unittest.TestCase):
+
+    ROWS = [{"action": "delete", "username": "testa"},
+            {"action": "list", "username": "list",
+            "filter": "department eq 'a],[\\\"b'"},
+            {"action": "delete", "username": u"test\u00e9"}]
+
+    def test_json_rows_cut_by_chunks(self):
+        """Rows come out whole however the chunks cut the file"""
+
+        data = json.dumps({"other": [1, 2], "useractions": self.ROWS},
+                            indent=2)
+
+        for size in (1, 7, 65536):
+            rows = [row for row
+                    in o365.readRows(StringIO.StringIO(data), 'json', size)]
+            self.assertEqual(rows, self.ROWS, size)
+
+    def test_ndjson_rows_skip_blank_lines(self):
+        """Each line is a row and blank lines are left out"""
+
+        data = "\n".join([json.dumps(row) for row in self.ROWS] + ["", ""])
+
+        rows = [row for row
+                in o365.readRows(StringIO.StringIO(data), 'ndjson')]
+
+        self.assertEqual(rows, self.ROWS)
+
+    def test_bad_json_input_fails(self):
+        """A file with no useractions or cut off is an error"""
+
+        for data in ('{"rows": []}',
+                        '{"useractions": [{"action": "delete"}, {"act'):
+            with self.assertRaises(ValueError):
+                for _ in o365.readRows(StringIO.StringIO(data), 'json', 8):
+                    pass
+
+
+class DiffUserTest(unittest.TestCase):
+
+    def test_only_changed_fields_are_sent(self):
+        """Values equal to the user's in Graph API form are left out"""
+
+        user = {"accountEnabled": True, "givenName": u"Jos\u00e9",
+                "surname": "Old", "department": None}
+        body = {"accountEnabled": "True",
+                "givenName": u"Jos\u00e9".encode('utf-8'),
+                "surname": "New", "department": "Biology"}
+
+        self.assertEqual(o365.diffUser(user, body),
+                            {"surname": "New", "department": "Biology"})
+
+    def test_unknown_user_gets_every_field(self):
+        """Without the current values all of them are sent"""
+
+        body = {"accountEnabled": "False", "surname": "New"}
+
+        self.assertEqual(o365.diffUser({}, body), body)
+
+
+class RateLimiterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = o365.RateLimiter(10, 2, 20)
+
+    def test_throttle_slows_down_once(self):
+        """Calls sent before the slow down do not slow it down again"""
+
+        sent = time.time() - 1
+        self.limiter.throttled(None, sent)
+        self.limiter.throttled(None, sent)
+        self.assertEqual(self.limiter.rate, 5)
+
+        self.limiter.throttled(None, time.time())
+        self.limiter.throttled(None, time.time())
+        self.assertEqual(self.limiter.rate, 2)
+        self.assertEqual(self.limiter.throttles, 4)
+
+    def test_success_speeds_up_to_the_limit(self):
+        """The rate grows with every call up to the maximum"""
+
+        for _ in range(1000):
+            self.limiter.success()
+
+        self.assertEqual(self.limiter.rate, 20)
+
+    def test_retry_after_pauses_everyone(self):
+        """The next call waits for the Retry-After of a throttled one,
+        and a call with a Retry-After does not back off on its own"""
+
+        self.limiter.throttled(0.2, time.time())
+        started = time.time()
+        self.limiter.backoff(1, 0.2)
+        self.limiter.acquire()
+
+        self.assertTrue(0.15 <= time.time() - started < 1)
+        self.assertEqual(self.limiter.retries, 1)
+
+    def test_retry_after_is_seconds_or_a_date(self):
+        """Retry-After headers give the seconds to wait"""
+
+        self.assertEqual(o365.parseRetryAfter("3"), 3)
+        self.assertEqual(o365.parseRetryAfter("Tue, 01 Jan 2019 "
+                                                "00:00:00 GMT"), 0)
+        self.assertIsNone(o365.parseRetryAfter(""))
+        self.assertIsNone(o365.parseRetryAfter("soon"))
+
+
+class TokenCacheTest(O365TestCase):
+
+    def setUp(self):
+        O365TestCase.setUp(self)
+        self.cache = os.path.join(self.workdir, "token.json")
+        self.readConfig("TOKENCACHE = {0!r}\nTOKENMARGIN = 300\n" \
+                        .format(self.cache))
+
+    def saveToken(self, life):
+        o365.ACCESS_TOKEN = "token"
+        o365.TOKEN_EXPIRES = time.time() + life
+        o365.saveToken()
+        o365.ACCESS_TOKEN = None
+        o365.TOKEN_EXPIRES = 0
+
+    def test_saved_token_is_used_again(self):
+        """A token saved only for the owner is loaded by the next run"""
+
+        self.saveToken(3600)
+
+        self.assertEqual(os.stat(self.cache).st_mode & 0o777, 0o600)
+        self.assertTrue(o365.loadToken())
+        self.assertEqual(o365.ACCESS_TOKEN, "token")
+
+    def test_expiring_token_is_not_used(self):
+        """A token that expires within TOKENMARGIN is not loaded"""
+
+        self.saveToken(200)
+
+        self.assertFalse(o365.loadToken())
+        self.assertIsNone(o365.ACCESS_TOKEN)
+
+    def test_token_of_others_is_not_used(self):
+        """A token of another tenant or in a file others can read is
+        not loaded"""
+
+        self.saveToken(3600)
+        os.chmod(self.cache, 0o644)
+        self.assertFalse(o365.loadToken())
+
+        os.chmod(self.cache, 0o600)
+        o365.O365DOMAIN = "other.edu"
+        self.assertFalse(o365.loadToken())
+        self.assertIsNone(o365.ACCESS_TOKEN)
+
+
+def userRow(action, username, newusername=None, **fields):
+    """Get an input row with all the fields of a create or update"""
+
+    row = o365bench.newUser(username)
+    row.update(action=action, newusername=newusername or username)
+    row.update(fields)
+    return row
+
+
+class CoalesceTest(unittest.TestCase):
+
+    def setUp(self):
+        o365.QUIET = True
+        self.processRow = o365.processRow
+        o365.processRow = lambda row: "SUCCESS: {0} {1}".format(
+                                        row["action"], row["username"])
+
+    def tearDown(self):
+        o365.processRow = self.processRow
+        o365.QUIET = False
+
+    def test_other_actions_are_never_merged(self):
+        """A delete after an addgroup is not merged into it, nor into
+        the create before it"""
+
+        rows = [userRow("create", "testa"),
+                {"action": "addgroup", "username": "testa"},
+                {"action": "delete", "username": "testa"}]
+
+        actions, owners = o365.planRows(rows)
+
+        self.assertEqual([action["action"] for action in actions],
+                            ["create", "addgroup", "delete"])
+        self.assertEqual(owners, [0, 1, 2])
+
+    def test_update_merges_into_create(self):
+        """A create takes over the name and fields of an update"""
+
+        rows = [userRow("create", "testa"),
+                userRow("update", "testa", "testb", sn="Other")]
+
+        actions, owners = o365.planRows(rows)
+
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]["action"], "create")
+        self.assertEqual(actions[0]["username"], "testb")
+        self.assertEqual(actions[0]["sn"], "Other")
+        self.assertEqual(owners, [0, 0])
+
+    def test_block_is_not_merged_into_create(self):
+        """create ignores loginDisabled, so a block stays an update"""
+
+        rows = [userRow("create", "testa"),
+                userRow("update", "testa", loginDisabled="True")]
+
+        actions, owners = o365.planRows(rows)
+
+        self.assertEqual(owners, [0, 1])
+
+    def test_rename_chain_merges(self):
+        """Renames a to b to c become one rename a to c"""
+
+        rows = [userRow("update", "testa", "testb"),
+                userRow("update", "testb", "testc")]
+
+        actions, owners = o365.planRows(rows)
+
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(o365.rowNames(actions[0]), ("testa", "testc"))
+        self.assertEqual(owners, [0, 0])
+
+    def test_rename_onto_a_touched_name_stays(self):
+        """A rename onto a name another row used since is not moved
+        before that row"""
+
+        rows = [userRow("update", "testa", "testb"),
+                userRow("create", "testc"),
+                userRow("update", "testb", "testc")]
+
+        actions, owners = o365.planRows(rows)
+
+        self.assertEqual(owners, [0, 1, 2])
+        self.assertEqual(o365.rowNames(actions[0]), ("testa", "testb"))
+
+    def test_update_then_delete_is_a_delete(self):
+        """A delete after a rename deletes the user by its old name"""
+
+        rows = [userRow("update", "testa", "testb"),
+                {"action": "delete", "username": "testb"}]
+
+        actions, owners = o365.planRows(rows)
+
+        self.assertEqual(len(actions), 1)
+        self.assertEqual(actions[0]["action"], "delete")
+        self.assertEqual(actions[0]["username"], "testa")
+        self.assertEqual(owners, [0, 0])
+
+    def test_cancelled_create_takes_nothing(self):
+        """A create and delete cancel out and a later row on the user
+        is not merged into them"""
+
+        rows = [userRow("create", "testa"),
+                {"action": "delete", "username": "testa"},
+                userRow("update", "testa", sn="Other"),
+                userRow("create", "testb")]
+
+        actions, owners = o365.planRows(rows)
+
+        self.assertEqual([action["action"] for action in actions],
+                            ["update", "create"])
+        self.assertEqual(owners, [None, None, 0, 1])
+
+    def test_coalesced_rows_get_their_results(self):
+        """Each row gets the result of the action that did its work,
+        with workers too"""
+
+        rows = [userRow("create", "testa"),
+                userRow("update", "testa", sn="Other"),
+                userRow("create", "testb"),
+                {"action": "addgroup", "username": "testb"},
+                {"action": "delete", "username": "testb"},
+                userRow("create", "testc"),
+                {"action": "delete", "username": "testc"}]
+
+        for workers in (1, 4):
+            results = [result for _, result
+                        in o365.coalesceRows(iter(rows), workers)]
+
+            self.assertEqual(results[:5],
+                                ["SUCCESS: create testa"] * 2 +
+                                ["SUCCESS: create testb",
+                                "SUCCESS: addgroup testb",
+                                "SUCCESS: delete testb"])
+            self.assertTrue(results[5].startswith("SUCCESS: no change"))
+            self.assertEqual(results[5], results[6])
+
+
+if __name__ == "__main__":
+    unittest.main()